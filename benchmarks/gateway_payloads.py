@@ -0,0 +1,44 @@
+"""
+Пропускная способность разбора тел запросов от сервисов на записанных
+примерах(``tests/payloads``). Сравнивается скомпилированная схема шлюза и
+разбор вручную. Запуск::
+
+    python -m benchmarks.gateway_payloads
+"""
+import json
+import os
+import timeit
+
+from oneweb_helpdesk_chat.gateways import Message, WhatsappPayload
+
+PAYLOADS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "tests", "payloads"
+)
+
+
+def parse_by_hand(body: bytes):
+    messages = []
+    for entry in json.loads(body).get("entry", []):
+        for change in entry.get("changes", []):
+            for item in change.get("value", {}).get("messages", []):
+                if item.get("type") != "text":
+                    continue
+                messages.append(Message(
+                    phone_number=str(item["from"]), text=item["text"]["body"]
+                ))
+    return messages
+
+
+def run(name: str, schema, number: int = 20000):
+    with open(os.path.join(PAYLOADS_DIR, name), "rb") as payload_file:
+        body = payload_file.read()
+    count = len(schema.loads(body))
+    for title, parse in (("schema", schema.loads), ("by hand", parse_by_hand)):
+        elapsed = timeit.timeit(lambda: parse(body), number=number)
+        print("{:<24} {:<8} {:>10.0f} payloads/s {:>10.0f} messages/s".format(
+            name, title, number / elapsed, number * count / elapsed
+        ))
+
+
+if __name__ == "__main__":
+    run("whatsapp_batch.json", WhatsappPayload)
@@ -0,0 +1,83 @@
+"""
+Стоимость сохранения одного сообщения от сервиса в зависимости от размера
+пакета: сообщения сохраняются по одному(как при вызове handle_message на каждое
+сообщение) и пакетом через handle_messages. Половина сообщений пакета приходит
+от новых клиентов. Используется бд из DB_URL, таблицы создаются, если их нет,
+поэтому запускать нужно на тестовой бд::
+
+    DB_URL=postgresql://... python -m benchmarks.ingestion
+    DB_URL=sqlite:// python -m benchmarks.ingestion
+
+С хранилищем в памяти измеряется стоимость самого конвейера без бд::
+
+    STORAGE_BACKEND=memory python -m benchmarks.ingestion
+"""
+import asyncio
+import itertools
+import time
+
+from oneweb_helpdesk_chat import config, gateways, storage
+from oneweb_helpdesk_chat.storage import database
+from oneweb_helpdesk_chat.storage.domain import Channel
+
+phone_numbers = ("+7{:010d}".format(i) for i in itertools.count())
+
+
+class BenchmarkGateway(gateways.Gateway):
+    def get_channel(self):
+        return Channel.WHATSAPP
+
+    def send_message(self, message):
+        pass
+
+
+def make_batch(size: int, known: list) -> list:
+    batch = []
+    for i in range(size):
+        if i % 2 and known:
+            phone_number = known[i % len(known)]
+        else:
+            phone_number = next(phone_numbers)
+            known.append(phone_number)
+        batch.append(gateways.Message(phone_number, "text", "Customer"))
+    return batch
+
+
+async def measure(gateway: gateways.Gateway, size: int, messages: int = 500):
+    known = []
+    batches = [make_batch(size, known) for _ in range(max(1, messages // size))]
+    total = sum(len(batch) for batch in batches)
+
+    started = time.perf_counter()
+    for batch in batches:
+        for raw_message in batch:
+            await gateway.ingest_messages([raw_message])
+    one_by_one = (time.perf_counter() - started) / total
+
+    batches = [make_batch(size, known) for _ in range(len(batches))]
+    started = time.perf_counter()
+    for batch in batches:
+        await gateway.ingest_messages(batch)
+    batched = (time.perf_counter() - started) / total
+
+    print("batch {:>4}: one by one {:>8.3f} ms/message, batched {:>8.3f} "
+          "ms/message".format(size, one_by_one * 1000, batched * 1000))
+
+
+def main():
+    if config.STORAGE_BACKEND != "memory":
+        database.Base.metadata.create_all(database.engine())
+        database.ScopedAppSession.configure(bind=database.engine())
+    gateway = BenchmarkGateway(
+        storage.default_customer_repository(),
+        storage.default_dialogs_repository()
+    )
+    loop = asyncio.new_event_loop()
+    for size in (1, 10, 100):
+        loop.run_until_complete(measure(gateway, size))
+        database.ScopedAppSession.remove()
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Накладные расходы логгирования на доставку одного сообщения: публикация
+сообщения в реестре соединений с несколькими подписчиками без логгирования, с
+логгированием на уровне INFO(отладочные события отбрасываются) и на уровне
+DEBUG с выборкой событий. Записи пишутся в /dev/null фоновым потоком::
+
+    python -m benchmarks.logging_overhead
+"""
+import asyncio
+import datetime
+import logging
+import os
+import time
+from unittest import mock
+
+from oneweb_helpdesk_chat import connections, logs, queues
+from oneweb_helpdesk_chat.chat import MessageEncoder
+from oneweb_helpdesk_chat.storage import Customer, Dialog, Message
+
+MESSAGES = 50000
+SUBSCRIBERS = 5
+
+
+def make_registry() -> connections.ConnectionRegistry:
+    registry = connections.ConnectionRegistry(
+        queues.TailRepository(), MessageEncoder().default
+    )
+    for i in range(SUBSCRIBERS):
+        connection = connections.Connection(None, user_id=i, outbox_limit=0)
+        registry.register(connection, events=False)
+        registry.dialogs.setdefault("1", set()).add(connection)
+    return registry
+
+
+def run(loop, registry) -> float:
+    message = Message(
+        dialog=Dialog(id=1, customer=Customer(id=1, name="Customer")),
+        text="text", created_at=datetime.datetime.now()
+    )
+
+    async def publish():
+        logs.correlation_id.set(logs.new_correlation_id())
+        for seq in range(MESSAGES):
+            message.seq = seq
+            await registry.publish_message("1", message)
+        for connection in registry.connections:
+            connection.outbox = asyncio.Queue()
+
+    started = time.perf_counter()
+    loop.run_until_complete(publish())
+    return (time.perf_counter() - started) / MESSAGES * 1e6
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    registry = make_registry()
+    logging.getLogger(logs.ROOT_LOGGER).disabled = True
+    baseline = run(loop, registry)
+    print("без логов: {:.2f} мкс/сообщение".format(baseline))
+    logging.getLogger(logs.ROOT_LOGGER).disabled = False
+
+    with open(os.devnull, "w") as devnull:
+        for level, rate in (("INFO", 0.01), ("DEBUG", 0.01), ("DEBUG", 1)):
+            logs.setup(level=level, path="", stream=devnull)
+            with mock.patch.object(
+                    connections.logger, "sample_rate", rate
+            ):
+                cost = run(loop, registry)
+            logs.shutdown()
+            print("{} sample_rate={}: {:.2f} мкс/сообщение(+{:.2f})".format(
+                level, rate, cost, cost - baseline
+            ))
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
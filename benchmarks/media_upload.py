@@ -0,0 +1,46 @@
+"""
+Пиковое потребление памяти и скорость сохранения вложения в хранилище
+вложений при потоковой записи по фрагментам(как при скачивании у сервиса).
+Пик памяти не должен зависеть от размера вложения::
+
+    python -m benchmarks.media_upload
+"""
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+
+from oneweb_helpdesk_chat import config
+from oneweb_helpdesk_chat.storage import media
+
+SIZES_MB = (1, 10, 50)
+
+
+async def chunks(size: int):
+    chunk = os.urandom(config.MEDIA_CHUNK_SIZE)
+    for _ in range(size // len(chunk)):
+        yield chunk
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    with tempfile.TemporaryDirectory() as directory:
+        store = media.MediaStore(directory)
+        for size_mb in SIZES_MB:
+            tracemalloc.start()
+            started = time.perf_counter()
+            loop.run_until_complete(
+                store.save(chunks(size_mb * 1024 * 1024), "video/mp4")
+            )
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("{:>3} МБ: пик памяти {:7.1f} КБ, {:6.1f} МБ/с".format(
+                size_mb, peak / 1024, size_mb / elapsed
+            ))
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
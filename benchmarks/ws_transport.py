@@ -0,0 +1,81 @@
+"""
+Объем и стоимость кодирования сообщений диалогов, отправляемых в
+мультиплексированное соединение, для разных подпротоколов(см.
+:mod:`oneweb_helpdesk_chat.framing`): без сжатия и со сжатием
+permessage-deflate, по одному кадру в сообщении и пакетами. Сжатие
+воспроизводит то, что делает aiohttp: raw deflate с общим для соединения
+контекстом и Z_SYNC_FLUSH после каждого сообщения::
+
+    python -m benchmarks.ws_transport
+"""
+import datetime
+import time
+import zlib
+
+from oneweb_helpdesk_chat import framing
+from oneweb_helpdesk_chat.chat import MessageEncoder
+from oneweb_helpdesk_chat.storage import Customer, Dialog, Message
+
+MESSAGES = 20000
+BATCH_SIZE = 10
+DIALOGS = 20
+
+
+def make_frames() -> list:
+    encode = MessageEncoder().default
+    dialogs = [
+        Dialog(id=i, customer=Customer(id=i, name="Customer {}".format(i)))
+        for i in range(DIALOGS)
+    ]
+    started_at = datetime.datetime(2020, 1, 1)
+    frames = []
+    for i in range(MESSAGES):
+        dialog = dialogs[i % DIALOGS]
+        message = Message(
+            id=i, seq=i // DIALOGS + 1, dialog=dialog,
+            text="Здравствуйте, заказ {} еще не доставлен".format(i * 7919),
+            created_at=started_at + datetime.timedelta(seconds=i)
+        )
+        frames.append({
+            "type": "message", "dialog_id": dialog.id,
+            "message": encode(message)
+        })
+    return frames
+
+
+def run(frames: list, codec: framing.Codec, compress: bool):
+    """
+    :return: Байт на сообщение и микросекунд на сообщение
+    """
+    size = BATCH_SIZE if codec.batching else 1
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    total = 0
+    started = time.perf_counter()
+    for i in range(0, len(frames), size):
+        data = codec.encode(frames[i:i + size])
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        if compress:
+            data = compressor.compress(data) + compressor.flush(
+                zlib.Z_SYNC_FLUSH
+            )
+            data = data[:-4]
+        total += len(data)
+    elapsed = time.perf_counter() - started
+    return total / len(frames), elapsed / len(frames) * 1e6
+
+
+def main():
+    frames = make_frames()
+    codecs = [framing.default_codec] + list(framing.codecs.values())
+    for codec in codecs:
+        for compress in (False, True):
+            size, cost = run(frames, codec, compress)
+            print("{:<18} {:<8} {:7.1f} байт/сообщение {:6.2f} мкс".format(
+                codec.protocol or "json", "deflate" if compress else "-",
+                size, cost
+            ))
+
+
+if __name__ == "__main__":
+    main()
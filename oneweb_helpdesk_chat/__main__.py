@@ -0,0 +1,3 @@
+from oneweb_helpdesk_chat.server import main
+
+main()
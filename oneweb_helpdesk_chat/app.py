@@ -1,47 +1,177 @@
 import asyncio
+import datetime
+import os
+import secrets
+import signal
 
 from aiohttp import web
 from aiohttp_session import get_session, setup, SimpleCookieStorage
-from oneweb_helpdesk_chat import events, gateways, storage, security
-from oneweb_helpdesk_chat.chat import ChatHandler
+from oneweb_helpdesk_chat import (
+    gateways, storage, security, config, connections, metrics, limits, logs,
+    tracing, watchdog, broker as app_broker, export as app_export,
+    inbox as app_inbox, signals, canned
+)
+from oneweb_helpdesk_chat.profiler import profiler
+from oneweb_helpdesk_chat.chat import ChatHandler, MessageEncoder
 from . import events as app_events
 from . import queues
 
 
 routes = web.RouteTableDef()
 
+logger = logs.get_logger(__name__)
 
-# маппинг очередей сообщений для отдельных диалогов. В качестве ключей исполь
-# зуется идентификатор диалога в нашей бд, в качестве значений - очередь
-# сообщений. Каждый раз, когда приходит новое сообщение в диалог, оно будет
-# добавлено в очередь для этого диалога. Этот объект должен реализовывать
-# интерфейс словаря(методы __set__, __get__ и get()).
-# todo: это нужно будет перепилить для меньшего потребления памяти
-dialogs_queues = queues.DictRepository()
+# заголовок с идентификатором корреляции запроса
+REQUEST_ID_HEADER = "X-Request-Id"
+
+
+@web.middleware
+async def correlation_middleware(request: web.Request, handler):
+    """
+    Назначает запросу идентификатор корреляции: берется из заголовка
+    X-Request-Id, если его передал балансировщик, иначе генерируется. Все
+    записи логов, сделанные при обработке запроса, содержат этот
+    идентификатор, он же возвращается в ответе
+    :param request:
+    :param handler:
+    :return:
+    """
+    request_id = (request.headers.get(REQUEST_ID_HEADER)
+                  or logs.new_correlation_id())
+    token = logs.correlation_id.set(request_id)
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        e.headers[REQUEST_ID_HEADER] = request_id
+        raise
+    except Exception:
+        logger.exception(
+            "request.failed", method=request.method, path=request.path
+        )
+        raise
+    finally:
+        logs.correlation_id.reset(token)
+    if not response.prepared:
+        response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+
+@web.middleware
+async def tracing_middleware(request: web.Request, handler):
+    """
+    Начинает трассу запроса. Вебсокет-соединения не трассируются целиком:
+    они живут долго, вместо этого трассируется отправка и прием отдельных
+    кадров
+    :param request:
+    :param handler:
+    :return:
+    """
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        return await handler(request)
+    with tracing.tracer.trace(
+            "http.request", method=request.method,
+            route=request.match_info.route.name or request.path
+    ) as span:
+        response = await handler(request)
+        if span is not None:
+            span.set_attribute("status", response.status)
+        return response
+
+
+# хвосты последних сообщений диалогов. Каждое новое сообщение добавляется в
+# хвост своего диалога, после переподключения клиенту досылаются сообщения из
+# хвоста, а если их там уже нет -- из бд
+dialogs_tails = queues.TailRepository()
+
+
+async def load_messages_since(dialog_id: int, seq: int, limit: int):
+    return await storage.default_dialogs_repository().get_messages_since(
+        dialog_id, seq, limit
+    )
+
+
+# реестр вебсокет-соединений, через него сообщения и события доставляются
+# подписанным клиентам
+connection_registry = connections.ConnectionRegistry(
+    dialogs_tails, MessageEncoder().default, load_messages_since
+)
+
+
+async def mark_read_many(receipts):
+    await storage.default_dialogs_repository().mark_read_many(receipts)
+
+
+# эфемерные сигналы "печатает" и "прочитано", отметки о прочтении пишутся в бд
+# пачками
+read_receipts = signals.ReadReceipts(mark_read_many)
+signal_hub = signals.SignalHub(connection_registry, read_receipts)
+connection_registry.signals = signal_hub
+
+# скомпилированные шаблоны ответов, периодически перезагружаются из бд
+canned_responses = canned.CannedResponses()
+
+# ограничители частоты запросов к хуку шлюзов и логину и контроль нагрузки на
+# пул для работы с бд
+gateway_limiter = limits.RateLimiter(
+    "gateway", config.GATEWAY_RATE_LIMIT, config.GATEWAY_RATE_BURST
+)
+gateway_ip_limiter = limits.RateLimiter(
+    "gateway_ip", config.IP_RATE_LIMIT, config.IP_RATE_BURST
+)
+login_ip_limiter = limits.RateLimiter(
+    "login_ip", config.LOGIN_IP_RATE_LIMIT, config.LOGIN_IP_RATE_BURST
+)
+login_limiter = limits.RateLimiter(
+    "login", config.LOGIN_RATE_LIMIT, config.LOGIN_RATE_BURST
+)
+rate_limiters = [
+    gateway_limiter, gateway_ip_limiter, login_ip_limiter, login_limiter
+]
+client_addresses = limits.ClientAddressResolver(config.TRUSTED_PROXIES)
+admission = limits.AdmissionController(
+    storage.database.executor_backlog, storage.database.pool_usage
+)
 
 
 @routes.route("*", "/gateways/{gateway_alias}", name="gateway-hook")
 async def gateway_hook(request: web.Request):
     """
-    Хук для сообщения от im-сервиса. Сообщение преобразуется в наш внутренний
-    формат и привязывается к имеющемуся диалогу, если диалога нет, то он будет
-    создан. Если в диалоге не указан ответственный, то при каждом новом
-    сообщении будет отправлено уведомление о событии в шину событий
+    Хук для сообщений от im-сервиса. Один запрос может содержать несколько
+    сообщений, они преобразуются в наш внутренний формат и привязываются к
+    имеющимся диалогам, если диалога нет, то он будет создан. Если в диалоге не
+    указан ответственный, то будет отправлено уведомление о событии в шину
+    событий, одно на диалог
     :param request: Запрос
     :return:
     """
-    gateway = gateways.repository.get_gateway(
-        request.match_info["gateway_alias"]
-    )
+    gateway_alias = request.match_info["gateway_alias"]
+    # неизвестный шлюз отсекается до чтения тела запроса
+    try:
+        gateway = gateways.repository.get_gateway(gateway_alias)
+    except gateways.GatewayNotFound:
+        raise web.HTTPNotFound()
+    gateway_limiter.check(gateway_alias)
+    gateway_ip_limiter.check(client_addresses.resolve(request))
+    admission.check()
     # асинхронный вызов, т.к. обработка может быть довольно длительной
-    message = await gateway.handle_message(request)
+    messages = await gateway.handle_messages(request)
+    logger.info(
+        "gateway.messages_received", gateway=gateway_alias,
+        count=len(messages)
+    )
 
-    await dialogs_queues.put(str(message.dialog_id), message)
+    unassigned_dialogs = {}
+    for message in messages:
+        await connection_registry.publish_message(
+            str(message.dialog_id), message
+        )
+        request.app["search_indexer"].submit(message)
+        if not message.dialog.assigned_user:
+            unassigned_dialogs[message.dialog.id] = message.dialog
 
-    if not message.dialog.assigned_user:
-        await app_events.events_queue.put(app_events.Event(
-            app_events.EventType.NEW_UNASSIGNED_DIALOG_MESSAGE,
-            message.dialog.id
+    for dialog_id in unassigned_dialogs:
+        connection_registry.publish_event(app_events.Event(
+            app_events.EventType.NEW_UNASSIGNED_DIALOG_MESSAGE, dialog_id
         ))
 
     return web.Response()
@@ -51,11 +181,14 @@ async def gateway_hook(request: web.Request):
 async def login(request: web.Request):
     """
     Производит логин пользователя и сохраняет его идентификатор в сессии, если
-    успешно
+    успешно. Попытки логина ограничиваются как по ip, так и по логину
     :param request:
     :return:
     """
+    login_ip_limiter.check(client_addresses.resolve(request))
+    admission.check()
     post_data = await request.post()
+    login_limiter.check(post_data.get('login', ''))
     user = await storage.default_user_repository().get_by_login(
         post_data['login']
     )
@@ -66,9 +199,477 @@ async def login(request: web.Request):
         raise web.HTTPUnauthorized()
     sess = await get_session(request)
     sess["user_id"] = user.id
+    # команда нужна для подсказок шаблонов ответов на каждое нажатие клавиши,
+    # поэтому хранится в сессии, а не читается из бд
+    sess["team"] = user.team
+    return web.Response()
+
+
+async def get_user_id(request: web.Request) -> int:
+    """
+    Возвращает идентификатор залогиненного пользователя из сессии
+    :param request: Запрос
+    :return:
+    :raises web.HTTPUnauthorized: Если пользователь не залогинен
+    """
+    sess = await get_session(request)
+    if "user_id" not in sess:
+        raise web.HTTPUnauthorized()
+    return sess["user_id"]
+
+
+@routes.route("GET", "/inbox/", name="inbox")
+async def inbox(request: web.Request):
+    """
+    Список диалогов, отсортированный по времени последнего сообщения, с
+    количеством непрочитанных сообщений для текущего пользователя. Поддерживает
+    параметры:
+
+    * limit: размер страницы
+    * cursor: курсор следующей страницы из предыдущего ответа
+    * assigned: "me" -- только диалоги текущего пользователя, "none" -- только
+      диалоги без ответственного
+    * closed: "1" -- закрытые диалоги вместо незакрытых
+    :param request:
+    :return:
+    """
+    user_id = await get_user_id(request)
+    try:
+        limit = min(
+            int(request.query.get("limit", config.INBOX_PAGE_SIZE)),
+            app_inbox.MAX_PAGE_SIZE
+        )
+        cursor = request.query.get("cursor")
+        before = app_inbox.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    assigned = request.query.get("assigned")
+    items = await storage.default_dialogs_repository().get_inbox(
+        user_id, limit=limit, before=before,
+        assigned_user_id=user_id if assigned == "me" else None,
+        unassigned=assigned == "none",
+        closed=request.query.get("closed") == "1"
+    )
+
+    next_cursor = None
+    if len(items) == limit:
+        next_cursor = app_inbox.encode_cursor(items[-1][0])
+    return web.json_response({
+        "items": [
+            app_inbox.dialog_summary(dialog, unread_count)
+            for dialog, unread_count in items
+        ],
+        "next_cursor": next_cursor,
+    })
+
+
+@routes.route("POST", "/inbox/{dialog_id}/read", name="inbox-read")
+async def inbox_read(request: web.Request):
+    """
+    Помечает все сообщения диалога прочитанными текущим пользователем
+    :param request:
+    :return:
+    """
+    user_id = await get_user_id(request)
+    repository = storage.default_dialogs_repository()
+    dialog = await repository.get_by_id(request.match_info["dialog_id"])
+    if not dialog:
+        raise web.HTTPNotFound()
+    await repository.mark_read(dialog, user_id)
+    return web.Response()
+
+
+@routes.route("POST", "/inbox/{dialog_id}/close", name="inbox-close")
+async def inbox_close(request: web.Request):
+    """
+    Закрывает диалог. Следующее сообщение клиента откроет новый диалог
+    :param request:
+    :return:
+    """
+    await get_user_id(request)
+    repository = storage.default_dialogs_repository()
+    dialog = await repository.get_by_id(request.match_info["dialog_id"])
+    if not dialog:
+        raise web.HTTPNotFound()
+    if not dialog.is_closed:
+        await repository.close(dialog)
+        connection_registry.close_dialogs([str(dialog.id)])
     return web.Response()
 
 
+@routes.route("POST", "/inbox/{dialog_id}/transfer", name="inbox-transfer")
+async def inbox_transfer(request: web.Request):
+    """
+    Передает диалог другому пользователю. Тело запроса -- json с полями:
+
+    * user_id: новый пользователь, null -- снять привязку диалога
+    * expected_user_id: необязательный, текущий пользователь диалога. Если
+      указан и диалог к этому времени уже передан другому, то передача не
+      выполняется
+
+    Если диалог закрыт или передан одновременно с этим запросом, то
+    возвращается 409
+    :param request:
+    :return: Запись журнала назначений
+    """
+    user_id = await get_user_id(request)
+    try:
+        data = await request.json()
+        to_user_id = data["user_id"]
+        if to_user_id is not None and not isinstance(to_user_id, int):
+            raise TypeError(to_user_id)
+        kwargs = {}
+        if "expected_user_id" in data:
+            kwargs["expected_user_id"] = data["expected_user_id"]
+    except (ValueError, TypeError, KeyError):
+        raise web.HTTPBadRequest()
+    repository = storage.default_dialogs_repository()
+    dialog = await repository.get_by_id(request.match_info["dialog_id"])
+    if not dialog:
+        raise web.HTTPNotFound()
+    to_user = None
+    if to_user_id is not None:
+        to_user = await storage.default_user_repository().get_by_id(
+            to_user_id
+        )
+        if not to_user:
+            raise web.HTTPBadRequest(text="unknown user")
+    try:
+        assignment = await repository.transfer(
+            dialog, to_user, user_id, **kwargs
+        )
+    except storage.AssignmentConflict:
+        raise web.HTTPConflict(text="dialog is closed or already transferred")
+    connection_registry.publish_event(app_events.Event(
+        app_events.EventType.DIALOG_TRANSFERRED, {
+            "dialog_id": dialog.id,
+            "from_user_id": assignment.from_user_id,
+            "to_user_id": assignment.to_user_id,
+        }
+    ))
+    return web.json_response(app_inbox.assignment_summary(assignment))
+
+
+@routes.route("GET", "/inbox/{dialog_id}/assignments",
+              name="inbox-assignments")
+async def inbox_assignments(request: web.Request):
+    """
+    Журнал назначений диалога от старых записей к новым
+    :param request:
+    :return:
+    """
+    await get_user_id(request)
+    repository = storage.default_dialogs_repository()
+    dialog = await repository.get_by_id(request.match_info["dialog_id"])
+    if not dialog:
+        raise web.HTTPNotFound()
+    return web.json_response({"items": [
+        app_inbox.assignment_summary(assignment)
+        for assignment in await repository.get_assignments(dialog.id)
+    ]})
+
+
+@routes.route("GET", "/canned/", name="canned-responses")
+async def canned_responses_view(request: web.Request):
+    """
+    Подсказки шаблонов ответов команды пользователя по мере набора короткого
+    имени. Поддерживает параметры:
+
+    * prefix: начало короткого имени
+    * limit: максимальное количество шаблонов
+    :param request:
+    :return:
+    """
+    await get_user_id(request)
+    sess = await get_session(request)
+    try:
+        limit = min(
+            int(request.query.get("limit", 10)), app_inbox.MAX_PAGE_SIZE
+        )
+    except ValueError:
+        raise web.HTTPBadRequest()
+    templates = canned_responses.complete(
+        sess.get("team"), request.query.get("prefix", ""), limit
+    )
+    return web.json_response({"items": [
+        {"shortcut": template.shortcut, "text": template.text}
+        for template in templates
+    ]})
+
+
+@routes.route("GET", "/search/", name="search")
+async def search(request: web.Request):
+    """
+    Полнотекстовый поиск по истории сообщений. Поддерживает параметры:
+
+    * q: строка поиска, обязательный
+    * channel: канал
+    * customer_id: идентификатор клиента
+    * date_from, date_to: диапазон дат создания сообщения в формате ISO 8601
+    * limit, offset: постраничная навигация
+    Результаты отсортированы по релевантности
+    :param request:
+    :return:
+    """
+    await get_user_id(request)
+    params = request.query
+    if not params.get("q"):
+        raise web.HTTPBadRequest()
+    try:
+        query = storage.SearchQuery(
+            text=params["q"],
+            channel=(
+                storage.domain.Channel(params["channel"])
+                if "channel" in params else None
+            ),
+            customer_id=(
+                int(params["customer_id"]) if "customer_id" in params else None
+            ),
+            date_from=(
+                datetime.datetime.fromisoformat(params["date_from"])
+                if "date_from" in params else None
+            ),
+            date_to=(
+                datetime.datetime.fromisoformat(params["date_to"])
+                if "date_to" in params else None
+            ),
+            limit=min(int(params.get("limit", 20)), app_inbox.MAX_PAGE_SIZE),
+            offset=int(params.get("offset", 0))
+        )
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    results = await storage.default_search_index().search(query)
+    encoder = MessageEncoder()
+    return web.json_response({"items": [
+        dict(
+            encoder.default(message),
+            id=message.id, dialog_id=message.dialog_id, rank=rank
+        )
+        for message, rank in results
+    ]})
+
+
+@routes.route("GET", "/export/messages", name="export-messages")
+async def export_messages(request: web.Request):
+    """
+    Выгрузка сообщений для аналитики. Ответ отправляется частями по мере
+    чтения из бд. Поддерживает параметры:
+
+    * format: ndjson(по умолчанию) или csv
+    * date_from, date_to: диапазон дат создания сообщения в формате ISO 8601
+    * channel: канал
+    :param request:
+    :return:
+    """
+    await get_user_id(request)
+    params = request.query
+    try:
+        writer = app_export.WRITERS[params.get("format", "ndjson")]()
+        query = app_export.ExportQuery(
+            date_from=(
+                datetime.datetime.fromisoformat(params["date_from"])
+                if "date_from" in params else None
+            ),
+            date_to=(
+                datetime.datetime.fromisoformat(params["date_to"])
+                if "date_to" in params else None
+            ),
+            channel=(
+                storage.domain.Channel(params["channel"])
+                if "channel" in params else None
+            )
+        )
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest()
+
+    response = web.StreamResponse(headers={
+        "Content-Type": writer.content_type,
+        "Content-Disposition": "attachment",
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    # если клиент отключился, то курсор и соединение с бд освобождаются сразу,
+    # а не при сборке мусора
+    chunks = app_export.stream(query, writer)
+    try:
+        async for chunk in chunks:
+            if chunk:
+                await response.write(chunk)
+    finally:
+        await chunks.aclose()
+    await response.write_eof()
+    return response
+
+
+# вложения адресуются по содержимому и не меняются
+MEDIA_HEADERS = {"Cache-Control": "private, max-age=31536000, immutable"}
+
+
+@routes.route("GET", "/media/{key}", name="media")
+async def media(request: web.Request):
+    """
+    Содержимое вложения сообщения по его ключу(см.
+    :func:`~oneweb_helpdesk_chat.storage.media.key`). Файл отдается через
+    sendfile, поддерживаются range-запросы. Содержимое по ключу никогда не
+    меняется, поэтому ответ кешируется без ограничения срока
+    :param request:
+    :return:
+    """
+    await get_user_id(request)
+    key = request.match_info["key"]
+    if not storage.media.KEY_RE.fullmatch(key):
+        raise web.HTTPNotFound()
+    return media_file_response(storage.default_media_store().path(key))
+
+
+@routes.route("GET", "/media/{key}/thumbnail", name="media-thumbnail")
+async def media_thumbnail(request: web.Request):
+    """
+    Миниатюра изображения из вложения. Генерируется при первом запросе
+    :param request:
+    :return:
+    """
+    await get_user_id(request)
+    key = request.match_info["key"]
+    if not storage.media.KEY_RE.fullmatch(key):
+        raise web.HTTPNotFound()
+    path = await storage.default_media_store().thumbnail(key)
+    if path is None:
+        raise web.HTTPNotFound()
+    return media_file_response(path)
+
+
+def media_file_response(path: str) -> web.FileResponse:
+    """
+    Ответ с файлом из хранилища вложений. Отсутствие файла проверяется до
+    создания ответа: FileResponse открывает файл только при отправке, и
+    ключ, которого нет в хранилище, привел бы к ошибке 500
+    :param path: Путь к файлу
+    :return:
+    :raises web.HTTPNotFound: Если файла нет
+    """
+    if not os.path.isfile(path):
+        raise web.HTTPNotFound()
+    return web.FileResponse(path, headers=MEDIA_HEADERS)
+
+
+@routes.route("GET", "/chat/{dialog_id}/history", name="chat-history")
+async def chat_history(request: web.Request):
+    """
+    История сообщений диалога, начиная с самых свежих. Включает как сообщения
+    из бд, так и перенесенные в архив. Поддерживает параметры:
+
+    * limit: размер страницы
+    * before_id: вернуть сообщения старше указанного
+    :param request:
+    :return:
+    """
+    await get_user_id(request)
+    repository = storage.default_dialogs_repository()
+    dialog = await repository.get_by_id(request.match_info["dialog_id"])
+    if not dialog:
+        raise web.HTTPNotFound()
+    try:
+        limit = min(
+            int(request.query.get("limit", 50)), app_inbox.MAX_PAGE_SIZE
+        )
+        before_id = request.query.get("before_id")
+        before_id = int(before_id) if before_id else None
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    messages = await repository.get_history(
+        dialog, limit=limit, before_id=before_id
+    )
+    encoder = MessageEncoder()
+    return web.json_response({"items": [
+        dict(encoder.default(message), id=message.id)
+        for message in messages
+    ]})
+
+
+@routes.route("GET", "/metrics/", name="metrics")
+async def metrics_view(request: web.Request):
+    """
+    Метрики процесса в текстовом формате prometheus
+    :param request:
+    :return:
+    """
+    return web.Response(text=metrics.registry.render())
+
+
+def check_admin(request: web.Request):
+    """
+    Проверяет токен административного эндпоинта из заголовка Authorization
+    :param request:
+    :return:
+    :raises web.HTTPNotFound: Если токен не задан в настройках
+    :raises web.HTTPForbidden: Если токен неверный
+    """
+    if not config.ADMIN_TOKEN:
+        raise web.HTTPNotFound()
+    expected = "Bearer {}".format(config.ADMIN_TOKEN)
+    if not secrets.compare_digest(
+            request.headers.get("Authorization", "").encode(),
+            expected.encode()
+    ):
+        raise web.HTTPForbidden()
+
+
+@routes.route("POST", "/admin/profiler/start", name="profiler-start")
+async def profiler_start(request: web.Request):
+    """
+    Включает семплирующий профилировщик потока цикла событий. Поддерживает
+    параметр interval -- интервал между снимками стека в секундах
+    :param request:
+    :return:
+    """
+    check_admin(request)
+    if profiler.running:
+        raise web.HTTPConflict(text="profiler is already running")
+    try:
+        interval = float(request.query.get("interval", profiler.interval))
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if interval <= 0:
+        raise web.HTTPBadRequest()
+    profiler.interval = interval
+    profiler.start()
+    return web.Response()
+
+
+@routes.route("POST", "/admin/profiler/stop", name="profiler-stop")
+async def profiler_stop(request: web.Request):
+    """
+    Выключает профилировщик и возвращает результат в формате свернутых
+    стеков
+    :param request:
+    :return:
+    """
+    check_admin(request)
+    if not profiler.running:
+        raise web.HTTPConflict(text="profiler is not running")
+    await asyncio.get_event_loop().run_in_executor(None, profiler.stop)
+    return web.Response(text=profiler.collapsed())
+
+
+@routes.route("GET", "/admin/watchdog", name="watchdog")
+async def watchdog_view(request: web.Request):
+    """
+    Задержка цикла событий, последние зависания цикла со стеками
+    блокирующих вызовов и последние медленные запросы к бд
+    :param request:
+    :return:
+    """
+    check_admin(request)
+    return web.json_response({
+        "loop": request.app["loop_watchdog"].as_json(),
+        "slow_queries": list(storage.querylog.slow_queries),
+    })
+
+
 @routes.route("GET", "/events/")
 async def events(request: web.Request):
     """
@@ -77,17 +678,12 @@ async def events(request: web.Request):
     :param request:
     :return:
     """
-    ws = web.WebSocketResponse()
+    user_id = await get_user_id(request)
+    ws = connections.websocket_response()
     await ws.prepare(request)
-
-    while True:
-        event = await events.events_queue.get()  # type: events.Event
-        try:
-            await ws.send_json(event.as_json())
-        except:
-            # todo: log error here
-            break
-
+    await connection_registry.serve(
+        connections.Connection(ws, user_id, multiplexed=False)
+    )
     return ws
 
 
@@ -95,50 +691,253 @@ async def events(request: web.Request):
 async def chat(request: web.Request):
     """
     Непосредственно чат между кастомером и работником тп. В данном случае
-    клиентом будет всегда клиентское устройство работника т.п.
+    клиентом будет всегда клиентское устройство работника т.п. Каждый кадр
+    клиента -- ответ кастомеру: ``{"text": "..."}`` или ``{"canned": "..."}``.
+    При переподключении клиент передает в параметре last_seq порядковый номер
+    последнего полученного сообщения, пропущенные сообщения будут досланы
     :param request:
     :return:
     """
     # todo: здесь нужна проверка на то, саассайнен ли пользователь на диалог
-    ws = web.WebSocketResponse()
-    await  ws.prepare(request)
+    user_id = await get_user_id(request)
+    try:
+        last_seq = request.query.get("last_seq")
+        last_seq = int(last_seq) if last_seq is not None else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="invalid last_seq")
     dialog = await storage.default_dialogs_repository().get_by_id(
         request.match_info["dialog_id"]
     )
     if not dialog:
-        raise web.HTTPNotFound
+        raise web.HTTPNotFound()
+    user = await storage.default_user_repository().get_by_id(user_id)
 
-    sess = await get_session(request)
-    user = await storage.default_user_repository().get_by_id(sess['id'])
+    ws = connections.websocket_response()
+    await ws.prepare(request)
     handler = ChatHandler(
-        ws=ws, dialog=dialog, user=user
-    )
-    await asyncio.gather(
-        handler.read_from_customer(await dialogs_queues.get(dialog.id))
+        ws=ws, dialog=dialog, user=user, registry=connection_registry,
+        canned_responses=canned_responses,
+        search_indexer=request.app["search_indexer"]
     )
+    await handler.read_from_customer(last_seq)
+    return ws
+
 
-    # dialog = await storage_to_change.fetch_results(
-    #     storage_to_change.session().query(storage_to_change.Dialog).filter(storage_to_change.Dialog.id == request.match_info["dialog_id"]),
-    #     "one"
-    # ) # type: storage_to_change.Dialog
-    # if not dialog:
-    #     raise web.HTTPNotFound()
-    #
-    # messages = dialogs_queues[dialog.id]
-    # user_id = get_session(request)["id"]
-    # user = await storage_to_change.fetch_results(
-    #     storage_to_change.session().query(storage_to_change.User).filter(storage_to_change.User.id == user_id)
-    # )
-    #
-    # handler = ChatHandler(ws=ws, dialog=dialog, user=user)
-    #
-    # await asyncio.gather(handler.read_from_customer(messages), handler.write_to_customer())
+@routes.route("GET", "/ws/", name="ws")
+async def multiplexed_ws(request: web.Request):
+    """
+    Единое соединение для сессии пользователя: события и сообщения всех
+    диалогов, на которые клиент подписался командами subscribe/unsubscribe
+    (см. модуль :mod:`~oneweb_helpdesk_chat.connections`). Ответы кастомерам
+    отправляются командой send
+    :param request:
+    :return:
+    """
+    user_id = await get_user_id(request)
+    ws = connections.websocket_response()
+    await ws.prepare(request)
+
+    async def send_to_customer(connection: connections.Connection,
+                               dialog_id: str, data: dict):
+        user = await storage.default_user_repository().get_by_id(user_id)
+        # диалог загружается самим хендлером при отправке
+        handler = ChatHandler(
+            ws=ws, dialog=None, user=user, registry=connection_registry,
+            canned_responses=canned_responses,
+            search_indexer=request.app["search_indexer"]
+        )
+        await handler.send_to_customer(connection, dialog_id, data)
 
+    connection = connections.Connection(ws, user_id)
+    connection.send_handler = send_to_customer
+    await connection_registry.serve(connection)
     return ws
 
 
-async def make_app():
-    app = web.Application()
+async def load_identity_index():
+    """
+    Загружает индекс известных идентификаторов клиентов. Пока индекс не
+    загружен, шлюзы ищут всех клиентов в бд
+    :return:
+    """
+    try:
+        await storage.default_customer_repository().load_identity_index()
+    except Exception:
+        logger.exception("storage.identity_index_failed")
+
+
+async def reload_canned_responses(
+        interval: float = config.CANNED_RESPONSES_RELOAD_INTERVAL
+):
+    """
+    Периодически перезагружает шаблоны ответов, чтобы изменения шаблонов в
+    бд доходили до всех процессов-воркеров
+    :param interval: Интервал между загрузками в секундах
+    :return:
+    """
+    repository = storage.default_canned_responses_repository()
+    while True:
+        try:
+            await canned_responses.reload(repository)
+        except Exception:
+            logger.exception("canned.reload_failed")
+        await asyncio.sleep(interval)
+
+
+async def close_inactive_dialogs(inactivity: datetime.timedelta):
+    """
+    Закрывает диалоги без сообщений дольше inactivity и убирает их из памяти
+    :param inactivity:
+    :return:
+    """
+    repository = storage.default_dialogs_repository()
+    older_than = datetime.datetime.now() - inactivity
+    while True:
+        dialog_ids = await repository.close_inactive(older_than)
+        if not dialog_ids:
+            break
+        connection_registry.close_dialogs(
+            str(dialog_id) for dialog_id in dialog_ids
+        )
+        logger.info("dialogs.closed", count=len(dialog_ids))
+
+
+async def storage_maintenance(interval: float = 3600):
+    """
+    Периодическое обслуживание хранилища: создание партиций сообщений на
+    следующие месяцы, закрытие неактивных диалогов и перенос старых
+    диалогов в архив
+    :param interval: Интервал между запусками в секундах
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        # шаги независимы: ошибка одного не должна останавливать остальные
+        if config.MESSAGES_PARTITIONED:
+            try:
+                await loop.run_in_executor(
+                    storage.database.executor,
+                    storage.partitions.ensure_partitions,
+                    storage.database.engine()
+                )
+            except Exception:
+                logger.exception("storage.partitions_failed")
+        if config.DIALOG_CLOSE_AFTER_HOURS:
+            try:
+                await close_inactive_dialogs(datetime.timedelta(
+                    hours=config.DIALOG_CLOSE_AFTER_HOURS
+                ))
+            except Exception:
+                logger.exception("storage.close_inactive_failed")
+        if config.ARCHIVE_AFTER_DAYS:
+            try:
+                older_than = datetime.datetime.now() - datetime.timedelta(
+                    days=config.ARCHIVE_AFTER_DAYS
+                )
+                repository = storage.default_dialogs_repository()
+                while await repository.archive_dialogs(older_than):
+                    pass
+            except Exception:
+                logger.exception("storage.archive_failed")
+        await asyncio.sleep(interval)
+
+
+async def reload_gateways():
+    """
+    Перечитывает настройки шлюзов и применяет их
+    :return:
+    """
+    try:
+        await gateways.repository.load(
+            gateways.read_config(config.GATEWAYS_CONFIG)
+        )
+    except Exception:
+        logger.exception("gateways.reload_failed")
+    else:
+        logger.info("gateways.reloaded")
+
+
+async def start_background_tasks(app: web.Application):
+    if config.GATEWAYS_CONFIG:
+        await gateways.repository.load(
+            gateways.read_config(config.GATEWAYS_CONFIG)
+        )
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_event_loop().add_signal_handler(
+                signal.SIGHUP,
+                lambda: asyncio.ensure_future(reload_gateways())
+            )
+    # сообщения и события из других процессов-воркеров
+    connection_registry.broker = app["broker"]
+    await app["broker"].start(
+        connection_registry.handle_broker_frame,
+        connection_registry.handle_broker_reconnect
+    )
+    app["loop_watchdog"] = watchdog.LoopWatchdog()
+    app["loop_watchdog"].start()
+    # фоновая индексация сообщений для полнотекстового поиска
+    app["search_indexer"] = storage.Indexer(storage.default_search_index())
+    app["search_indexer"].start()
+    # обслуживание хранилища выполняется только в одном процессе, иначе
+    # воркеры одновременно архивировали бы одни и те же диалоги
+    app["storage_maintenance"] = None
+    if app["maintenance"]:
+        app["storage_maintenance"] = asyncio.ensure_future(
+            storage_maintenance()
+        )
+    app["identity_index_loader"] = asyncio.ensure_future(load_identity_index())
+    app["connections_reaper"] = asyncio.ensure_future(
+        connection_registry.reap_loop()
+    )
+    app["signal_hub"] = asyncio.ensure_future(signal_hub.run())
+    app["read_receipts"] = asyncio.ensure_future(read_receipts.run())
+    app["canned_responses_loader"] = asyncio.ensure_future(
+        reload_canned_responses()
+    )
+
+
+async def stop_background_tasks(app: web.Application):
+    await app["search_indexer"].stop()
+    await app["loop_watchdog"].stop()
+    if app["storage_maintenance"] is not None:
+        app["storage_maintenance"].cancel()
+    app["identity_index_loader"].cancel()
+    app["connections_reaper"].cancel()
+    app["signal_hub"].cancel()
+    app["read_receipts"].cancel()
+    app["canned_responses_loader"].cancel()
+    # накопленные отметки о прочтении не должны теряться при остановке
+    await read_receipts.flush()
+    await app["broker"].stop()
+    connection_registry.broker = None
+    if config.GATEWAYS_CONFIG and hasattr(signal, "SIGHUP"):
+        asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+    await gateways.repository.stop()
+
+
+async def make_app(broker: app_broker.Broker = None,
+                   maintenance: bool = True, workers: int = 1):
+    """
+    Создает приложение
+    :param broker: Брокер для обмена сообщениями с другими процессами, если
+      приложение запускается в нескольких процессах
+    :param maintenance: Выполнять ли периодическое обслуживание хранилища(см.
+      :func:`storage_maintenance`). При запуске в несколько процессов
+      включается только в одном из них
+    :param workers: Количество процессов-воркеров. Ограничения частоты
+      запросов заданы на весь сервис, поэтому каждый воркер получает свою
+      долю(см. :meth:`limits.RateLimiter.split`)
+    :return:
+    """
+    for limiter in rate_limiters:
+        limiter.split(workers)
+    app = web.Application(
+        middlewares=[correlation_middleware, tracing_middleware]
+    )
+    app["broker"] = broker or app_broker.LocalBroker()
+    app["maintenance"] = maintenance
     setup(app, SimpleCookieStorage())
     app.add_routes(routes)
+    app.on_startup.append(start_background_tasks)
+    app.on_cleanup.append(stop_background_tasks)
     return app
@@ -0,0 +1,221 @@
+"""
+Обмен сообщениями и событиями между процессами-воркерами. Вебсокет оператора и
+хук шлюза для одного и того же диалога могут попасть в разные процессы, поэтому
+каждое сообщение, опубликованное в реестре соединений одного воркера,
+пересылается через брокер реестрам всех остальных воркеров.
+
+Кадры брокера -- словари, сериализуемые в json:
+
+.. code-block:: text
+
+    {"type": "message", "dialog_id": "1", "seq": 10, "payload": {...}}
+    {"type": "event", "payload": {...}}
+
+Брокер не гарантирует доставку: кадры, которые не удалось отправить или
+получить(например, во время переподключения), теряются. После
+переподключения брокер вызывает обработчик переподключения, и реестр
+соединений досылает подключенным клиентам пропущенные сообщения по порядковым
+номерам из бд(см.
+:meth:`~oneweb_helpdesk_chat.connections.ConnectionRegistry.resync`)
+"""
+import asyncio
+import json
+import os
+import typing
+from abc import ABCMeta, abstractmethod
+
+from oneweb_helpdesk_chat import logs, metrics
+
+logger = logs.get_logger(__name__)
+
+FrameHandler = typing.Callable[[dict], None]
+ReconnectHandler = typing.Callable[[], None]
+
+# максимальный размер одного кадра в байтах
+FRAME_LIMIT = 1024 * 1024
+
+dropped_counter = metrics.registry.counter(
+    "broker_dropped_frames_total", "Broker frames dropped while disconnected"
+)
+
+
+class Broker(metaclass=ABCMeta):
+    """
+    Канал для обмена кадрами между процессами
+    """
+
+    @abstractmethod
+    async def start(self, handler: FrameHandler,
+                    on_reconnect: ReconnectHandler = None):
+        """
+        Подключается к каналу
+        :param handler: Обработчик кадров, полученных от других процессов
+        :param on_reconnect: Вызывается после восстановления разорванного
+          соединения с каналом, т.е. когда часть кадров могла быть потеряна
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def publish(self, frame: dict):
+        """
+        Отправляет кадр всем остальным процессам. Метод не ждет отправки
+        :param frame:
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    async def stop(self):
+        pass
+
+
+class LocalBroker(Broker):
+    """
+    Брокер для работы в одном процессе: пересылать кадры некому
+    """
+
+    async def start(self, handler: FrameHandler,
+                    on_reconnect: ReconnectHandler = None):
+        pass
+
+    def publish(self, frame: dict):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class UnixSocketBroker(Broker):
+    """
+    Клиент брокера, работающего на локальном unix-сокете(см.
+    :class:`BrokerServer`). Кадры передаются построчно в виде json. При
+    разрыве соединения клиент переподключается
+    """
+
+    def __init__(self, path: str, reconnect_interval: float = 0.5) -> None:
+        super().__init__()
+        self.path = path
+        self.reconnect_interval = reconnect_interval
+        self.writer = None  # type: typing.Optional[asyncio.StreamWriter]
+        self.connected = asyncio.Event()
+        self.task = None  # type: typing.Optional[asyncio.Task]
+
+    async def start(self, handler: FrameHandler,
+                    on_reconnect: ReconnectHandler = None):
+        self.task = asyncio.ensure_future(self.run(handler, on_reconnect))
+
+    async def run(self, handler: FrameHandler,
+                  on_reconnect: ReconnectHandler = None):
+        """
+        Задача чтения кадров из брокера. Ошибка обработки отдельного кадра
+        записывается в лог и не прерывает чтение следующих
+        :param handler:
+        :param on_reconnect:
+        :return:
+        """
+        reconnecting = False
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(
+                    self.path, limit=FRAME_LIMIT
+                )
+            except OSError:
+                await asyncio.sleep(self.reconnect_interval)
+                continue
+            self.connected.set()
+            if reconnecting and on_reconnect is not None:
+                on_reconnect()
+            reconnecting = True
+            try:
+                async for line in reader:
+                    try:
+                        handler(json.loads(line))
+                    except Exception:
+                        logger.exception("broker.frame_failed")
+            except (ConnectionError, ValueError):
+                pass
+            finally:
+                self.connected.clear()
+                self.writer.close()
+                self.writer = None
+
+    def publish(self, frame: dict):
+        if self.writer is None:
+            dropped_counter.inc()
+            return
+        self.writer.write(json.dumps(frame).encode("utf8") + b"\n")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+class BrokerServer:
+    """
+    Брокер на локальном unix-сокете. Каждый полученный от клиента кадр
+    пересылается всем остальным подключенным клиентам. Клиент, который не
+    успевает читать кадры, отключается
+    """
+
+    def __init__(self, path: str, buffer_limit: int = 16 * 1024 * 1024) -> None:
+        """
+        :param path: Путь к сокету
+        :param buffer_limit: Максимальный размер неотправленных клиенту данных
+        """
+        super().__init__()
+        self.path = path
+        self.buffer_limit = buffer_limit
+        self.clients = set()  # type: typing.Set[asyncio.StreamWriter]
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(
+            self.handle, self.path, limit=FRAME_LIMIT
+        )
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+        try:
+            async for line in reader:
+                for client in list(self.clients):
+                    if client is writer:
+                        continue
+                    transport = client.transport
+                    if transport.get_write_buffer_size() > self.buffer_limit:
+                        self.clients.discard(client)
+                        client.close()
+                        continue
+                    client.write(line)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for client in list(self.clients):
+            client.close()
+        self.clients.clear()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_broker(path: str):
+    """
+    Запускает брокер и обслуживает клиентов до завершения процесса
+    :param path: Путь к сокету
+    :return:
+    """
+    async def serve():
+        server = BrokerServer(path)
+        await server.start()
+        await server.server.serve_forever()
+
+    asyncio.run(serve())
@@ -0,0 +1,236 @@
+"""
+Шаблоны ответов: сотрудник тп вставляет в диалог заготовленный текст по
+короткому имени шаблона. Шаблоны хранятся в бд(см.
+:class:`~oneweb_helpdesk_chat.storage.database.CannedResponse`) отдельно для
+каждой команды сотрудников, общие шаблоны -- без команды. Шаблон команды
+перекрывает общий шаблон с тем же коротким именем.
+
+Текст шаблона может содержать подстановки в фигурных скобках(см.
+:data:`PLACEHOLDERS`), фигурная скобка в тексте удваивается::
+
+    Здравствуйте, {customer.name}! Меня зовут {user.name}, номер вашего
+    обращения {dialog.id}
+
+Шаблоны загружаются в память целиком и при загрузке компилируются в функции
+по аналогии со схемами(:mod:`oneweb_helpdesk_chat.schema`): генерируется код,
+который склеивает части текста со значениями полей уже загруженных диалога,
+клиента и пользователя. Подстановка не обращается к бд и не разбирает шаблон.
+Подсказки по мере набора короткого имени ищутся по префиксному дереву
+"""
+import string
+import typing
+
+from oneweb_helpdesk_chat import logs, storage
+
+logger = logs.get_logger(__name__)
+
+# подстановки шаблонов и выражения, которыми они вычисляются
+PLACEHOLDERS = {
+    "customer.name": "dialog.customer.name",
+    "customer.phone": "dialog.customer.phone_number",
+    "dialog.id": "dialog.id",
+    "user.name": "user.name",
+}
+
+Render = typing.Callable[[storage.Dialog, storage.User], str]
+
+
+class TemplateError(ValueError):
+    """
+    Шаблон содержит неизвестную подстановку или непарную фигурную скобку
+    """
+
+
+class CannedResponseNotFound(KeyError):
+    """
+    Шаблона с указанным коротким именем нет
+    """
+
+
+def _text(value) -> str:
+    return "" if value is None else str(value)
+
+
+def compile_template(text: str) -> Render:
+    """
+    Компилирует текст шаблона в функцию подстановки
+    :param text: Текст шаблона
+    :return: Функция, принимающая диалог и пользователя и возвращающая текст
+      ответа
+    :raises TemplateError:
+    """
+    try:
+        parsed = list(string.Formatter().parse(text))
+    except ValueError as e:
+        raise TemplateError(str(e)) from None
+    parts = []
+    for literal, field, format_spec, conversion in parsed:
+        if literal:
+            parts.append(repr(literal))
+        if field is None:
+            continue
+        if format_spec or conversion or field not in PLACEHOLDERS:
+            raise TemplateError("unknown placeholder: {{{}}}".format(field))
+        parts.append("_text({})".format(PLACEHOLDERS[field]))
+
+    namespace = {"_text": _text}
+    exec("def render(dialog, user):\n    return ''.join(({},))".format(
+        ", ".join(parts) or "''"
+    ), namespace)
+    return namespace["render"]
+
+
+class Template(typing.NamedTuple):
+    """
+    Скомпилированный шаблон
+    """
+    shortcut: str
+    text: str
+    render: Render
+
+
+class _Node:
+    __slots__ = ("children", "template")
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.children = {}  # type: typing.Dict[str, _Node]
+        self.template = None  # type: typing.Optional[Template]
+
+
+class ShortcutTrie:
+    """
+    Префиксное дерево шаблонов по коротким именам. Поиск по префиксу
+    проходит только по узлам префикса и найденным шаблонам, а не по всем
+    шаблонам команды
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.root = _Node()
+
+    def add(self, template: Template):
+        node = self.root
+        for char in template.shortcut:
+            node = node.children.setdefault(char, _Node())
+        node.template = template
+
+    def get(self, shortcut: str) -> typing.Optional[Template]:
+        node = self._find(shortcut)
+        return node.template if node is not None else None
+
+    def complete(self, prefix: str, limit: int) -> typing.List[Template]:
+        """
+        Шаблоны, короткие имена которых начинаются с prefix, в
+        лексикографическом порядке
+        :param prefix:
+        :param limit: Максимальное количество шаблонов
+        :return:
+        """
+        node = self._find(prefix)
+        templates = []
+        stack = [node] if node is not None else []
+        while stack and len(templates) < limit:
+            node = stack.pop()
+            if node.template is not None:
+                templates.append(node.template)
+            stack.extend(
+                node.children[char]
+                for char in sorted(node.children, reverse=True)
+            )
+        return templates
+
+    def _find(self, prefix: str) -> typing.Optional[_Node]:
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+
+class CannedResponses:
+    """
+    Скомпилированные шаблоны ответов всех команд
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        # деревья шаблонов по командам, общие шаблоны -- под ключом None
+        self.teams = {
+        }  # type: typing.Dict[typing.Optional[str], ShortcutTrie]
+
+    def load(self, responses: typing.Iterable[storage.CannedResponse]):
+        """
+        Компилирует шаблоны и заменяет ими загруженные ранее. Шаблоны с
+        ошибками пропускаются
+        :param responses:
+        :return:
+        """
+        teams = {}
+        for response in responses:
+            try:
+                render = compile_template(response.text)
+            except TemplateError as e:
+                logger.warning(
+                    "canned.invalid_template", team=response.team,
+                    shortcut=response.shortcut, error=str(e)
+                )
+                continue
+            teams.setdefault(response.team, ShortcutTrie()).add(
+                Template(response.shortcut, response.text, render)
+            )
+        self.teams = teams
+
+    async def reload(self, repository: storage.CannedResponseRepository):
+        self.load(await repository.get_all())
+
+    def _tries(self, team: typing.Optional[str]) -> typing.List[ShortcutTrie]:
+        # дерево команды идет первым, ее шаблоны перекрывают общие
+        return [
+            self.teams[key] for key in dict.fromkeys((team, None))
+            if key in self.teams
+        ]
+
+    def get(self, team: typing.Optional[str], shortcut: str) -> Template:
+        """
+        Шаблон, доступный команде
+        :param team:
+        :param shortcut:
+        :return:
+        :raises CannedResponseNotFound:
+        """
+        for trie in self._tries(team):
+            template = trie.get(shortcut)
+            if template is not None:
+                return template
+        raise CannedResponseNotFound(shortcut)
+
+    def complete(self, team: typing.Optional[str], prefix: str,
+                 limit: int = 10) -> typing.List[Template]:
+        """
+        Шаблоны команды и общие шаблоны, короткие имена которых начинаются с
+        prefix, в лексикографическом порядке
+        :param team:
+        :param prefix:
+        :param limit:
+        :return:
+        """
+        templates = {}
+        for trie in self._tries(team):
+            for template in trie.complete(prefix, limit):
+                templates.setdefault(template.shortcut, template)
+        return [templates[shortcut] for shortcut in sorted(templates)][:limit]
+
+    def render(self, team: typing.Optional[str], shortcut: str,
+               dialog: storage.Dialog, user: storage.User) -> str:
+        """
+        Текст ответа по шаблону
+        :param team: Команда пользователя
+        :param shortcut: Короткое имя шаблона
+        :param dialog: Диалог с загруженным клиентом
+        :param user: Пользователь, отправляющий ответ
+        :return:
+        :raises CannedResponseNotFound:
+        """
+        return self.get(team, shortcut).render(dialog, user)
@@ -1,17 +1,18 @@
 """
 Специфичные для чата компоненты
 """
-from asyncio import Queue
-
 from aiohttp import web
 
-from oneweb_helpdesk_chat import gateways
-from oneweb_helpdesk_chat.queues import DictRepository
+from oneweb_helpdesk_chat import canned, gateways, logs, storage
+from oneweb_helpdesk_chat.connections import Connection, ConnectionRegistry
 from oneweb_helpdesk_chat.storage import Message, Dialog, User
+from oneweb_helpdesk_chat.tracing import tracer
 import json
 
 DEFAULT_DT_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+logger = logs.get_logger(__name__)
+
 
 class MessageEncoder(json.JSONEncoder):
     """
@@ -21,12 +22,32 @@ class MessageEncoder(json.JSONEncoder):
 
     def default(self, o: Message):
         return {
+            "id": o.id,
+            "seq": o.seq,
             "text": o.text,
             "customer": {
                 "id": o.dialog.customer.id,
                 "name": o.dialog.customer.name
             },
-            "datetime": o.datetime.strftime(DEFAULT_DT_FORMAT)
+            "datetime": o.created_at.strftime(DEFAULT_DT_FORMAT),
+            "attachment": self.encode_attachment(o.attachment),
+        }
+
+    @staticmethod
+    def encode_attachment(attachment: storage.Attachment):
+        """
+        Вложение сообщения. Содержимое доступно по адресу
+        ``/media/{key}``, миниатюра изображения -- ``/media/{key}/thumbnail``
+        :param attachment:
+        :return:
+        """
+        if attachment is None:
+            return None
+        return {
+            "key": storage.media.key(attachment),
+            "content_type": attachment.content_type,
+            "size": attachment.size,
+            "filename": attachment.filename,
         }
 
 
@@ -36,57 +57,120 @@ class MessageDecoder(json.JSONDecoder):
     """
 
     def decode(self, s, *args):
-        obj = super().decode(s, *args)
-        message = Message(text=obj["text"])
-        return message
+        return self.from_dict(super().decode(s, *args))
+
+    @staticmethod
+    def from_dict(obj: dict) -> Message:
+        return Message(text=obj["text"])
 
 
 class ChatHandler:
     """
     Хендлер для обработки чтения сообщения от клиента и отправки их ему же.
     Это просто класс, который объединяет в себе задачу чтения сообщения от
-    клиента и задачу отправки.
+    клиента и обработку ответов сотрудника, пришедших по тому же вебсокету.
+
+    Вместо текста сообщения сотрудник может прислать короткое имя шаблона
+    ответа: ``{"canned": "greeting"}``, текст будет подставлен из шаблона(см.
+    :mod:`oneweb_helpdesk_chat.canned`)
     """
 
     def __init__(
             self, ws: web.WebSocketResponse, dialog: Dialog, user: User,
-            queues_repository: DictRepository
+            registry: ConnectionRegistry,
+            canned_responses: canned.CannedResponses = None,
+            search_indexer: storage.Indexer = None
     ) -> None:
         super().__init__()
         self.ws = ws
         self.dialog = dialog
         self.user = user
-        self.queues_repository = queues_repository
+        self.registry = registry
+        self.canned_responses = canned_responses or canned.CannedResponses()
+        self.search_indexer = search_indexer
 
-    async def read_from_customer(self):
+    async def read_from_customer(self, last_seq: int = None):
+        """
+        Таска, которая доставляет сообщения от клиента в открытый в данный
+        момент вебсокет и принимает из него ответы сотрудника. Вебсокет
+        регистрируется в реестре соединений с подпиской на текущий диалог,
+        обслуживание прекращается, когда соединение с вебсокетом разрывается.
+        :param last_seq: Порядковый номер последнего сообщения, полученного
+          клиентом до переподключения
         """
-        Таска, которая обрабатывает сообщения от клиента и пишет их в открытый
-        в данный момент вебсокет. Чтение  прекращается, когда соединение с
-        вебсокетом разрывается.
+        connection = Connection(self.ws, self.user.id, multiplexed=False)
+        connection.send_handler = self.send_to_customer
+        await self.registry.serve(
+            connection, dialog_ids=[str(self.dialog.id)], events=False,
+            last_seq=last_seq
+        )
+
+    async def send_to_customer(self, connection: Connection, dialog_id: str,
+                               data: dict):
+        """
+        Обработка отправки сообщения клиенту, обработчик команды ``send``
+        соединения(см. :meth:`ConnectionRegistry.handle_command`). Ответ
+        сотрудника сохраняется в диалоге(диалог переходит в состояние
+        PENDING), доставляется подписчикам диалога и отправляется клиенту
+        через шлюз канала последнего сообщения диалога, в том числе
+        заархивированного
+        :param connection: Соединение, из которого пришел ответ
+        :param dialog_id: Идентификатор диалога, совпадает с диалогом хендлера
+        :param data: Разобранный json команды
+        :return:
         """
+        repository = storage.default_dialogs_repository()
+        # диалог перечитывается запросом в пуле потоков: после предыдущего
+        # коммита его атрибуты устарели, и обращение к ним загружало бы их
+        # из бд в цикле событий
+        dialog = await repository.get_by_id(dialog_id)
+        if not dialog:
+            connection.put({"type": "error", "error": "unknown dialog"})
+            return
+        self.dialog = dialog
         try:
-            while not self.ws.closed:
-                message = await self.queues_repository.get(
-                    str(self.dialog.id)
-                )  # type: Message
-                await self.ws.send_json(
-                    message, dumps=lambda x: json.dumps(x, cls=MessageEncoder)
+            message = self.build_message(data)
+        except canned.CannedResponseNotFound:
+            connection.put(
+                {"type": "error", "error": "unknown canned response"}
+            )
+            return
+        except KeyError:
+            connection.put({"type": "error", "error": "invalid command"})
+            return
+        message.channel = await repository.get_channel(int(dialog_id))
+        if message.channel is None:
+            # канал диалога определяется по сообщениям клиента
+            connection.put({"type": "error", "error": "unknown channel"})
+            return
+
+        message.user_id = self.user.id
+        with tracer.trace("ws.receive", dialog_id=dialog_id):
+            self.dialog.add_message(message)
+            await repository.save_all([self.dialog])
+            await self.registry.publish_message(dialog_id, message)
+            if self.search_indexer is not None:
+                self.search_indexer.submit(message)
+            try:
+                gateway = gateways.repository.get_by_channel(message.channel)
+                await gateway.send(message)
+            except Exception:
+                logger.exception(
+                    "chat.send_failed", dialog_id=dialog_id,
+                    channel=message.channel.value
                 )
-        except:
-            # todo: добавить сюда логгирование исключения
-            raise
+                connection.put({"type": "error", "error": "send failed"})
 
-    async def write_to_customer(self):
+    def build_message(self, data: dict) -> Message:
         """
-        Обработка отправки сообщения клиенту. Эта таска читает сообщение от
-        клиента пользователя(сотрудника тп), сохраняет его в бд и отправляет
-        через шлюз клиенту
+        Создает сообщение из команды сотрудника: из текста или по шаблону
+        ответа
+        :param data: Разобранный json команды
         :return:
+        :raises canned.CannedResponseNotFound: Если шаблона нет
         """
-        while not self.ws.closed:
-            message = await self.ws.receive_json(
-                loads=lambda x: json.loads(x, cls=MessageDecoder)
-            )
-            message.dialog = self.dialog
-            gateway = gateways.repository.get_gateway(message.channel)
-            gateway.send_message(message)
+        if "canned" not in data:
+            return MessageDecoder.from_dict(data)
+        return Message(text=self.canned_responses.render(
+            self.user.team, data["canned"], self.dialog, self.user
+        ))
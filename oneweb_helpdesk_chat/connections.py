@@ -0,0 +1,711 @@
+"""
+Реестр вебсокет-соединений пользователей. Реестр хранит, какие соединения
+подписаны на какие диалоги, и доставляет в них новые сообщения и события.
+
+Соединение бывает двух видов:
+
+* мультиплексированное(эндпоинт ``/ws/``) -- одно соединение на сессию
+  пользователя, по которому идут и события, и сообщения любых диалогов.
+  Клиент управляет подписками командами::
+
+    {"command": "subscribe", "dialog_id": 1, "last_seq": 10}
+    {"command": "subscribe", "dialog_id": 2, "mode": "monitor"}
+    {"command": "unsubscribe", "dialog_id": 1}
+    {"command": "send", "dialog_id": 1, "text": "..."}
+
+  Если при подписке указан last_seq(порядковый номер последнего полученного
+  клиентом сообщения), то сначала будут досланы все сообщения после него:
+  из хвоста последних сообщений в памяти, либо из бд, если хвост уже вытеснен.
+  Если разрыв больше :data:`~oneweb_helpdesk_chat.config.WS_REPLAY_LIMIT` или
+  часть сообщений уже недоступна, клиент получит кадр ``{"type": "reset",
+  "dialog_id": 1}`` и должен перезагрузить историю диалога
+
+  Сервер отправляет кадры вида ``{"type": "message", "dialog_id": 1,
+  "message": {...}}`` и ``{"type": "event", "event": {...}}``. Когда диалог
+  закрывается, подписки на него снимаются, а клиент получает кадр
+  ``{"type": "closed", "dialog_id": 1}``.
+
+  Подписка в режиме monitor -- наблюдение руководителя за диалогом: такое
+  соединение получает те же кадры из того же потока сообщений, что и
+  остальные подписчики, но по этому диалогу не может отправлять сигналы.
+  Отдельной очереди для наблюдателей нет, поэтому наблюдение ничего не
+  добавляет к стоимости доставки сообщения. Команды ``typing`` и ``read`` и
+  кадры ``{"type": "signal", ...}`` -- эфемерные сигналы, см.
+  :mod:`~oneweb_helpdesk_chat.signals`
+
+  Командой ``send`` сотрудник отвечает клиенту в диалоге, на который
+  подписано соединение, ответ приходит подписчикам диалога обычным кадром
+  сообщения(см.
+  :meth:`~oneweb_helpdesk_chat.chat.ChatHandler.send_to_customer`)
+* одноцелевое(эндпоинты ``/events/`` и ``/chat/{dialog_id}``) -- соединение
+  подписано либо на события, либо на один диалог, кадры содержат только само
+  сообщение или событие. Каждый входящий кадр соединения ``/chat/{dialog_id}``
+  -- ответ клиенту, т.е. команда ``send`` без полей command и dialog_id
+
+Формат отправляемых сервером сообщений, их сжатие и пакетная отправка
+нескольких кадров одним сообщением описаны в модуле
+:mod:`~oneweb_helpdesk_chat.framing`
+
+Реестр периодически отправляет ping во все соединения и закрывает соединения,
+от которых давно не было входящих кадров, а также соединения, которые не
+успевают читать отправляемые им кадры. Количество закрытых соединений
+отражается в метрике ``ws_reaped_total``
+
+При запуске в несколько процессов(см. :mod:`oneweb_helpdesk_chat.server`)
+сообщения и события, опубликованные в реестре одного процесса, пересылаются
+реестрам остальных процессов через :mod:`брокер <oneweb_helpdesk_chat.broker>`
+"""
+import asyncio
+import json
+import time
+import typing
+
+from aiohttp import web, WSMsgType, WSCloseCode
+
+from oneweb_helpdesk_chat import config, framing, logs, metrics
+from oneweb_helpdesk_chat.events import Event, EventType
+from oneweb_helpdesk_chat.broker import Broker
+from oneweb_helpdesk_chat.queues import TailRepository
+from oneweb_helpdesk_chat.storage import Message
+from oneweb_helpdesk_chat.tracing import tracer
+
+logger = logs.get_logger(__name__)
+
+
+class Connection:
+    """
+    Отдельное вебсокет-соединение. Все кадры для соединения складываются в его
+    очередь и отправляются одной задачей :meth:`send_loop`, поэтому на
+    соединение приходится одна задача отправки независимо от количества
+    открытых диалогов. Если подпротокол соединения допускает пакетную
+    отправку, то кадры, накопившиеся в очереди за batch_window, отправляются
+    одним сообщением
+
+    :ivar typing.Set[str] dialogs: Диалоги, на которые подписано соединение
+    :ivar typing.Set[str] monitored: Диалоги из dialogs, на которые соединение
+      подписано в режиме наблюдения(только чтение)
+    :ivar dict catching_up: Диалоги, для которых идет досылка сообщений из бд,
+      новые сообщения этих диалогов откладываются до ее окончания
+    :ivar dict last_seqs: Порядковый номер последнего отправленного в
+      соединение сообщения каждого диалога, с него продолжается досылка
+      после переподключения к брокеру
+    :ivar send_handler: Асинхронный обработчик команды ``send``(аргументы:
+      соединение, идентификатор диалога, команда), без него команда не
+      принимается
+    :ivar float last_seen: Время последнего входящего кадра(time.monotonic)
+    :ivar str reaped: Причина принудительного закрытия соединения реестром
+    :ivar framing.Codec codec: Кодировщик кадров выбранного подпротокола
+    """
+
+    def __init__(self, ws: web.WebSocketResponse, user_id: int,
+                 multiplexed: bool = True,
+                 outbox_limit: int = config.WS_OUTBOX_LIMIT,
+                 batch_window: float = config.WS_BATCH_WINDOW,
+                 batch_size: int = config.WS_BATCH_SIZE) -> None:
+        super().__init__()
+        self.ws = ws
+        self.user_id = user_id
+        self.multiplexed = multiplexed
+        self.codec = framing.for_protocol(getattr(ws, "ws_protocol", None))
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.dialogs = set()  # type: typing.Set[str]
+        self.monitored = set()  # type: typing.Set[str]
+        self.catching_up = {}  # type: typing.Dict[str, typing.List[dict]]
+        self.last_seqs = {}  # type: typing.Dict[str, int]
+        self.send_handler = None  # type: typing.Optional[typing.Callable]
+        self.outbox = asyncio.Queue(outbox_limit)
+        self.last_seen = time.monotonic()
+        self.overflowed = False
+        self.reaped = None  # type: typing.Optional[str]
+        self.task = None  # type: typing.Optional[asyncio.Task]
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    @property
+    def congested(self) -> bool:
+        """
+        Соединение не успевает читать кадры: очередь заполнена наполовину.
+        Необязательные кадры таким соединениям не отправляются
+        :return:
+        """
+        return 0 < self.outbox.maxsize <= self.outbox.qsize() * 2
+
+    def put(self, frame: dict):
+        """
+        Ставит кадр в очередь на отправку. Если очередь переполнена, кадр
+        отбрасывается, а соединение помечается для закрытия
+        :param frame:
+        :return:
+        """
+        try:
+            self.outbox.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def ping(self):
+        try:
+            await self.ws.ping()
+        except Exception:
+            # соединение уже мертво, его закроет реестр
+            pass
+
+    def send_message(self, dialog_id: str, payload: dict):
+        """
+        Ставит сообщение диалога в очередь на отправку
+        :param dialog_id: Идентификатор диалога
+        :param payload: Сообщение, преобразованное в dict
+        :return:
+        """
+        if dialog_id in self.catching_up:
+            self.catching_up[dialog_id].append(payload)
+            return
+        seq = payload.get("seq")
+        if seq is not None:
+            self.last_seqs[dialog_id] = max(
+                seq, self.last_seqs.get(dialog_id, seq)
+            )
+        if self.multiplexed:
+            payload = {
+                "type": "message", "dialog_id": int(dialog_id),
+                "message": payload
+            }
+        self.put(payload)
+
+    def send_event(self, payload: dict):
+        """
+        Ставит событие в очередь на отправку
+        :param payload: Событие, преобразованное в dict
+        :return:
+        """
+        if self.multiplexed:
+            payload = {"type": "event", "event": payload}
+        self.put(payload)
+
+    async def send_loop(self):
+        """
+        Задача отправки кадров из очереди соединения в вебсокет
+        :return:
+        """
+        while not self.ws.closed:
+            frames = [await self.outbox.get()]
+            if self.codec.batching:
+                if self.batch_window > 0:
+                    await asyncio.sleep(self.batch_window)
+                while (len(frames) < self.batch_size
+                       and not self.outbox.empty()):
+                    frames.append(self.outbox.get_nowait())
+            # каждая отправка -- отдельная трасса, т.к. соединение живет
+            # дольше запросов, в которых были опубликованы сообщения
+            with tracer.trace("ws.send", user_id=self.user_id,
+                              queued=self.outbox.qsize(),
+                              frames=len(frames)):
+                data = self.codec.encode(frames)
+                if isinstance(data, bytes):
+                    await self.ws.send_bytes(data)
+                else:
+                    await self.ws.send_str(data)
+
+
+class ConnectionRegistry:
+    """
+    Реестр соединений. Последние сообщения каждого диалога сохраняются в
+    хвостах независимо от наличия подписчиков, при подписке с указанием
+    last_seq недостающие сообщения досылаются из хвоста или из бд
+    """
+
+    def __init__(self, tails: TailRepository,
+                 encode_message: typing.Callable[[Message], dict],
+                 history_loader: typing.Callable[
+                     [int, int, int], typing.Awaitable[typing.List[Message]]
+                 ] = None,
+                 heartbeat_interval: float = config.WS_HEARTBEAT_INTERVAL,
+                 idle_timeout: float = config.WS_IDLE_TIMEOUT,
+                 replay_limit: int = config.WS_REPLAY_LIMIT) -> None:
+        """
+        :param tails: Хвосты последних сообщений диалогов
+        :param encode_message: Функция преобразования сообщения в dict, один
+          раз для всех подписчиков
+        :param history_loader: Асинхронная функция загрузки сообщений диалога
+          из бд с порядковым номером больше указанного(аргументы:
+          идентификатор диалога, порядковый номер, лимит)
+        :param heartbeat_interval: Интервал отправки ping и проверки соединений
+        :param idle_timeout: Время без входящих кадров, после которого
+          соединение закрывается
+        :param replay_limit: Максимальное количество сообщений, досылаемых из
+          бд при подписке
+        """
+        super().__init__()
+        self.tails = tails
+        self.encode_message = encode_message
+        # брокер для пересылки сообщений и событий реестрам других процессов
+        self.broker = None  # type: typing.Optional[Broker]
+        # эфемерные сигналы, oneweb_helpdesk_chat.signals.SignalHub
+        self.signals = None
+        self.history_loader = history_loader
+        self.replay_limit = replay_limit
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.connections = set()  # type: typing.Set[Connection]
+        self.events_subscribers = set()  # type: typing.Set[Connection]
+        self.dialogs = {}  # type: typing.Dict[str, typing.Set[Connection]]
+
+        self.reaped_counter = metrics.registry.counter(
+            "ws_reaped_total", "Websocket connections closed by the reaper"
+        )
+        metrics.registry.gauge(
+            "ws_connections", "Open websocket connections",
+            lambda: len(self.connections)
+        )
+        metrics.registry.gauge(
+            "ws_subscribed_dialogs", "Dialogs with at least one subscriber",
+            lambda: len(self.dialogs)
+        )
+        metrics.registry.gauge(
+            "dialog_tails", "Dialogs with recent messages kept in memory",
+            lambda: len(self.tails.dict)
+        )
+        self.replayed_counter = metrics.registry.counter(
+            "ws_replayed_messages_total",
+            "Messages resent after reconnect, by source"
+        )
+
+    def register(self, connection: Connection, events: bool = True):
+        """
+        Регистрирует соединение
+        :param connection: Соединение
+        :param events: Подписать ли соединение на события
+        :return:
+        """
+        self.connections.add(connection)
+        if events:
+            self.events_subscribers.add(connection)
+
+    def unregister(self, connection: Connection):
+        """
+        Убирает соединение и все его подписки из реестра
+        :param connection:
+        :return:
+        """
+        for dialog_id in list(connection.dialogs):
+            self.unsubscribe(connection, dialog_id)
+        self.events_subscribers.discard(connection)
+        self.connections.discard(connection)
+
+    async def subscribe(self, connection: Connection, dialog_id: str,
+                        last_seq: int = None, monitor: bool = False):
+        """
+        Подписывает соединение на сообщения диалога. Если указан last_seq, то
+        сначала в соединение досылаются сообщения после него
+        :param connection:
+        :param dialog_id:
+        :param last_seq: Порядковый номер последнего полученного сообщения
+        :param monitor: Подписка в режиме наблюдения
+        :return:
+        """
+        self.dialogs.setdefault(dialog_id, set()).add(connection)
+        connection.dialogs.add(dialog_id)
+        if monitor:
+            connection.monitored.add(dialog_id)
+        else:
+            connection.monitored.discard(dialog_id)
+        if last_seq is None:
+            return
+        connection.last_seqs[dialog_id] = max(
+            last_seq, connection.last_seqs.get(dialog_id, last_seq)
+        )
+
+        payloads = self.tails.since(dialog_id, last_seq)
+        if payloads is not None:
+            self.replayed_counter.inc(len(payloads), source="memory")
+            for payload in payloads:
+                connection.send_message(dialog_id, payload)
+            return
+
+        # пока сообщения загружаются из бд, новые сообщения диалога
+        # откладываются, чтобы не нарушить порядок
+        connection.catching_up[dialog_id] = []
+        try:
+            payloads = await self._load_since(dialog_id, last_seq)
+        finally:
+            pending = connection.catching_up.pop(dialog_id, [])
+
+        if payloads is None:
+            connection.put({"type": "reset", "dialog_id": int(dialog_id)})
+            payloads = []
+        else:
+            self.replayed_counter.inc(len(payloads), source="storage")
+        for payload in payloads:
+            connection.send_message(dialog_id, payload)
+        # отложенные сообщения могли попасть и в выборку из бд
+        last_sent = payloads[-1]["seq"] if payloads else last_seq
+        for payload in pending:
+            if payload["seq"] is None or payload["seq"] > last_sent:
+                connection.send_message(dialog_id, payload)
+
+    async def _load_since(
+            self, dialog_id: str, last_seq: int
+    ) -> typing.Optional[typing.List[dict]]:
+        """
+        Загружает из бд сообщения диалога после last_seq
+        :return: Сообщения или None, если досылка невозможна: разрыв слишком
+          большой или часть сообщений недоступна в бд
+        """
+        if self.history_loader is None:
+            return None
+        messages = await self.history_loader(
+            int(dialog_id), last_seq, self.replay_limit + 1
+        )
+        if len(messages) > self.replay_limit or (
+                messages and messages[0].seq != last_seq + 1):
+            return None
+        return [self.encode_message(message) for message in messages]
+
+    def unsubscribe(self, connection: Connection, dialog_id: str):
+        """
+        Отписывает соединение от сообщений диалога
+        :param connection:
+        :param dialog_id:
+        :return:
+        """
+        connection.dialogs.discard(dialog_id)
+        connection.monitored.discard(dialog_id)
+        connection.last_seqs.pop(dialog_id, None)
+        subscribers = self.dialogs.get(dialog_id)
+        if subscribers is not None:
+            subscribers.discard(connection)
+            if not subscribers:
+                del self.dialogs[dialog_id]
+
+    async def publish_message(self, dialog_id: str, message: Message):
+        """
+        Сохраняет сообщение в хвосте диалога и доставляет его всем
+        соединениям, подписанным на диалог
+        :param dialog_id: Идентификатор диалога
+        :param message: Сообщение
+        :return:
+        """
+        with tracer.span("ws.encode"):
+            payload = self.encode_message(message)
+        self.deliver_message(dialog_id, message.seq, payload)
+        if self.broker is not None:
+            self.broker.publish({
+                "type": "message", "dialog_id": dialog_id,
+                "seq": message.seq, "payload": payload,
+                "correlation_id": logs.correlation_id.get()
+            })
+
+    def deliver_message(self, dialog_id: str, seq: typing.Optional[int],
+                        payload: dict):
+        """
+        Доставляет уже преобразованное сообщение подписчикам этого процесса
+        :param dialog_id: Идентификатор диалога
+        :param seq: Порядковый номер сообщения
+        :param payload: Сообщение, преобразованное в dict
+        :return:
+        """
+        if seq is not None:
+            with tracer.span("tail.append"):
+                if not self.tails.append(dialog_id, seq, payload):
+                    logger.info("tail.gap", dialog_id=dialog_id, seq=seq)
+        subscribers = self.dialogs.get(dialog_id, ())
+        with tracer.span("ws.fanout", subscribers=len(subscribers)):
+            for connection in subscribers:
+                connection.send_message(dialog_id, payload)
+        logger.debug_sampled(
+            "message.delivered", dialog_id=dialog_id, seq=seq,
+            subscribers=len(subscribers)
+        )
+
+    def close_dialogs(self, dialog_ids: typing.Iterable[str]):
+        """
+        Убирает закрытые диалоги из памяти этого и остальных процессов и
+        рассылает событие о закрытии каждого диалога
+        :param dialog_ids: Идентификаторы закрытых диалогов
+        :return:
+        """
+        dialog_ids = list(dialog_ids)
+        if not dialog_ids:
+            return
+        self.evict_dialogs(dialog_ids)
+        if self.broker is not None:
+            self.broker.publish({
+                "type": "dialogs_closed", "dialog_ids": dialog_ids
+            })
+        for dialog_id in dialog_ids:
+            self.publish_event(Event(EventType.DIALOG_CLOSED, int(dialog_id)))
+
+    def evict_dialogs(self, dialog_ids: typing.Iterable[str]):
+        """
+        Удаляет хвосты закрытых диалогов и снимает подписки на них
+        мультиплексированных соединений. Одноцелевые соединения остаются
+        подписанными до закрытия, т.к. ответ техподдержки в закрытый диалог
+        снова его открывает
+        :param dialog_ids:
+        :return:
+        """
+        for dialog_id in dialog_ids:
+            self.tails.discard(dialog_id)
+            for connection in list(self.dialogs.get(dialog_id, ())):
+                if connection.multiplexed:
+                    self.unsubscribe(connection, dialog_id)
+                    connection.put(
+                        {"type": "closed", "dialog_id": int(dialog_id)}
+                    )
+
+    def publish_event(self, event: Event):
+        """
+        Рассылает событие всем подписанным на события соединениям
+        :param event:
+        :return:
+        """
+        payload = event.as_json()
+        self.deliver_event(payload)
+        if self.broker is not None:
+            self.broker.publish({"type": "event", "payload": payload})
+
+    def deliver_event(self, payload: dict):
+        for connection in self.events_subscribers:
+            connection.send_event(payload)
+
+    def handle_broker_reconnect(self):
+        """
+        Вызывается брокером после переподключения: кадры, опубликованные
+        другими процессами во время разрыва, потеряны. Хвосты диалогов могут не
+        содержать этих сообщений, поэтому они сбрасываются, а подключенным
+        соединениям досылаются пропущенные сообщения из бд
+        :return:
+        """
+        logger.info("broker.reconnected", connections=len(self.connections))
+        self.tails.clear()
+        for connection in list(self.connections):
+            if connection.dialogs:
+                asyncio.ensure_future(self.resync(connection))
+
+    async def resync(self, connection: Connection):
+        """
+        Повторно подписывает соединение на все его диалоги с досылкой из бд
+        сообщений после последнего отправленного. Если соединению еще не
+        отправлялось ни одного сообщения диалога, то пропущенные сообщения
+        определить нельзя, и клиент получает кадр ``reset``
+        :param connection:
+        :return:
+        """
+        for dialog_id in list(connection.dialogs):
+            if connection.ws.closed or dialog_id not in connection.dialogs:
+                continue
+            last_seq = connection.last_seqs.get(dialog_id)
+            if last_seq is None:
+                connection.put({"type": "reset", "dialog_id": int(dialog_id)})
+                continue
+            await self.subscribe(
+                connection, dialog_id, last_seq,
+                monitor=dialog_id in connection.monitored
+            )
+
+    def handle_broker_frame(self, frame: dict):
+        """
+        Доставляет сообщение или событие, опубликованное в другом процессе.
+        Записи логов при доставке получают идентификатор корреляции запроса,
+        в котором сообщение было опубликовано
+        :param frame: Кадр брокера
+        :return:
+        """
+        token = logs.correlation_id.set(frame.get("correlation_id"))
+        try:
+            with tracer.trace("broker.deliver", type=frame["type"]):
+                if frame["type"] == "message":
+                    self.deliver_message(
+                        frame["dialog_id"], frame["seq"], frame["payload"]
+                    )
+                elif frame["type"] == "event":
+                    self.deliver_event(frame["payload"])
+                elif frame["type"] == "dialogs_closed":
+                    self.evict_dialogs(frame["dialog_ids"])
+                elif (frame["type"] == "signals"
+                      and self.signals is not None):
+                    self.signals.deliver(frame["frames"])
+        finally:
+            logs.correlation_id.reset(token)
+
+    async def handle_command(self, connection: Connection, command: dict):
+        """
+        Обрабатывает команду клиента соединения
+        :param connection:
+        :param command: Разобранный json команды
+        :return:
+        """
+        try:
+            action = command["command"]
+            dialog_id = str(int(command["dialog_id"]))
+            last_seq = command.get("last_seq")
+            last_seq = int(last_seq) if last_seq is not None else None
+            mode = command.get("mode", "participant")
+            if mode not in ("participant", "monitor"):
+                raise ValueError(mode)
+        except (KeyError, TypeError, ValueError):
+            connection.put({"type": "error", "error": "invalid command"})
+            return
+
+        if action in ("typing", "read") and self.signals is not None:
+            # сигналы принимаются только по диалогам, на которые подписано
+            # соединение не в режиме наблюдения, и не подтверждаются
+            if dialog_id not in connection.dialogs:
+                connection.put({"type": "error", "error": "not subscribed"})
+            elif dialog_id in connection.monitored:
+                connection.put({"type": "error", "error": "read-only"})
+            else:
+                self.signals.handle_command(connection, action, dialog_id)
+            return
+        if action == "send" and connection.send_handler is not None:
+            if dialog_id not in connection.dialogs:
+                connection.put({"type": "error", "error": "not subscribed"})
+            elif dialog_id in connection.monitored:
+                connection.put({"type": "error", "error": "read-only"})
+            else:
+                await connection.send_handler(connection, dialog_id, command)
+            return
+        if action not in ("subscribe", "unsubscribe"):
+            connection.put({"type": "error", "error": "unknown command"})
+            return
+        # подтверждение отправляется до досылки пропущенных сообщений
+        ack = {"type": action + "d", "dialog_id": int(dialog_id)}
+        if action == "subscribe" and mode == "monitor":
+            ack["mode"] = mode
+        connection.put(ack)
+        if action == "subscribe":
+            await self.subscribe(
+                connection, dialog_id, last_seq, monitor=mode == "monitor"
+            )
+        else:
+            self.unsubscribe(connection, dialog_id)
+
+    async def read_commands(self, connection: Connection):
+        """
+        Читает кадры клиента до закрытия вебсокета. Любой входящий кадр
+        продлевает жизнь соединения. Одноцелевое соединение диалога
+        принимает только ответы в этот диалог, остальные одноцелевые
+        соединения кадры не обрабатывают
+        :param connection:
+        :return:
+        """
+        async for ws_message in connection.ws:
+            connection.touch()
+            if ws_message.type == WSMsgType.PING:
+                await connection.ws.pong(ws_message.data)
+                continue
+            if ws_message.type != WSMsgType.TEXT or not (
+                    connection.multiplexed or connection.send_handler):
+                continue
+            try:
+                command = json.loads(ws_message.data)
+            except ValueError:
+                command = None
+            if not isinstance(command, dict):
+                connection.put({"type": "error", "error": "invalid command"})
+                continue
+            if not connection.multiplexed:
+                if not connection.dialogs:
+                    connection.put(
+                        {"type": "error", "error": "not subscribed"}
+                    )
+                    continue
+                command = dict(
+                    command, command="send",
+                    dialog_id=next(iter(connection.dialogs))
+                )
+            await self.handle_command(connection, command)
+
+    async def serve(self, connection: Connection,
+                    dialog_ids: typing.Iterable[str] = (),
+                    events: bool = True, last_seq: int = None):
+        """
+        Регистрирует соединение и обслуживает его до закрытия вебсокета: одна
+        задача отправляет кадры, текущая читает команды клиента
+        :param connection: Соединение
+        :param dialog_ids: Диалоги, на которые нужно подписать соединение сразу
+        :param events: Подписать ли соединение на события
+        :param last_seq: Порядковый номер последнего полученного сообщения
+          для досылки при подписке на dialog_ids
+        :return:
+        """
+        connection.task = asyncio.current_task()
+        self.register(connection, events)
+        sender = asyncio.ensure_future(connection.send_loop())
+        try:
+            for dialog_id in dialog_ids:
+                await self.subscribe(connection, dialog_id, last_seq)
+            await self.read_commands(connection)
+        except asyncio.CancelledError:
+            if connection.reaped is None:
+                raise
+        finally:
+            sender.cancel()
+            self.unregister(connection)
+
+        if connection.reaped is not None:
+            try:
+                await asyncio.wait_for(
+                    connection.ws.close(code=WSCloseCode.GOING_AWAY),
+                    self.heartbeat_interval
+                )
+            except Exception:
+                pass
+
+    def reap(self, connection: Connection, reason: str):
+        """
+        Принудительно закрывает соединение: убирает его из реестра, очищает его
+        очередь и прерывает обслуживающую его задачу
+        :param connection: Соединение
+        :param reason: Причина закрытия, используется как метка метрики
+        :return:
+        """
+        connection.reaped = reason
+        self.unregister(connection)
+        while not connection.outbox.empty():
+            connection.outbox.get_nowait()
+        if connection.task is not None:
+            connection.task.cancel()
+        self.reaped_counter.inc(reason=reason)
+        logger.info(
+            "ws.reaped", reason=reason, user_id=connection.user_id
+        )
+
+    def sweep(self):
+        """
+        Проверяет все соединения: закрывает не успевающие читать и те, от
+        которых давно не было входящих кадров, в остальные отправляет ping
+        :return:
+        """
+        now = time.monotonic()
+        for connection in list(self.connections):
+            if connection.overflowed:
+                self.reap(connection, "overflow")
+            elif now - connection.last_seen > self.idle_timeout:
+                self.reap(connection, "idle")
+            else:
+                asyncio.ensure_future(connection.ping())
+
+    async def reap_loop(self):
+        """
+        Фоновая задача периодической проверки соединений
+        :return:
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            self.sweep()
+
+
+def websocket_response() -> web.WebSocketResponse:
+    """
+    Создает вебсокет для обслуживания реестром. Автоответ на ping отключен,
+    т.к. pong и ping клиента должны обновлять время последней активности
+    соединения(см. :meth:`ConnectionRegistry.read_commands`). Предлагаются
+    подпротоколы всех доступных кодировщиков кадров
+    :return:
+    """
+    return web.WebSocketResponse(
+        autoping=False, compress=config.WS_COMPRESS,
+        protocols=framing.protocols()
+    )
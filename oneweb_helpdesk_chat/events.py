@@ -5,21 +5,25 @@
     уведомление получат все пользователи.
 * Клиент написал сообщение
 * Новое сообщение от техподдержки
+* Диалог закрыт
+
+События рассылаются подписанным соединениям через
+:class:`~oneweb_helpdesk_chat.connections.ConnectionRegistry`
 """
-from asyncio import Queue
 from enum import Enum
 
-events_queue = Queue()
-subscribed_users = []
-
 
 class EventType(Enum):
     """
     Тип события. Доступные значения:
       * NEW_UNASSIGNED_DIALOG_MESSAGE: новое сообщение в диалоге без
       назначенного пользователя
+      * DIALOG_CLOSED: диалог закрыт вручную или после периода бездействия
+      * DIALOG_TRANSFERRED: диалог передан другому пользователю
     """
     NEW_UNASSIGNED_DIALOG_MESSAGE = "NEW_UNASSIGNED_DIALOG_MESSAGE"
+    DIALOG_CLOSED = "DIALOG_CLOSED"
+    DIALOG_TRANSFERRED = "DIALOG_TRANSFERRED"
 
 
 class Event:
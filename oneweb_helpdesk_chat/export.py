@@ -0,0 +1,200 @@
+"""
+Выгрузка сообщений для аналитики в форматах NDJSON и CSV. Сообщения читаются из
+бд курсором на стороне сервера(``stream_results``) порциями по
+:data:`~oneweb_helpdesk_chat.config.EXPORT_CHUNK_SIZE` строк и сразу
+записываются в ответ, поэтому потребление памяти не зависит от объема выгрузки.
+Выгружаются только сообщения из бд, заархивированные сообщения(см.
+:mod:`~oneweb_helpdesk_chat.storage.archive`) в выгрузку не попадают.
+
+Выгрузка доступна через эндпоинт ``/export/messages`` и из командной строки::
+
+    python -m oneweb_helpdesk_chat.export --format csv \\
+        --date-from 2020-01-01 --date-to 2020-02-01 > messages.csv
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import io
+import json
+import sys
+import typing
+
+import sqlalchemy
+from sqlalchemy.engine import Connection
+
+from oneweb_helpdesk_chat import config
+from oneweb_helpdesk_chat.storage import database
+from oneweb_helpdesk_chat.storage.domain import Channel
+
+# поля выгрузки в порядке столбцов csv
+FIELDS = (
+    "message_id", "dialog_id", "seq", "created_at", "channel", "user_id",
+    "customer_id", "customer_name", "customer_phone", "text"
+)
+
+
+class ExportQuery:
+    """
+    Параметры выгрузки
+
+    :ivar date_from: Сообщения, созданные не раньше указанного времени
+    :ivar date_to: Сообщения, созданные раньше указанного времени
+    :ivar channel: Канал сообщений
+    """
+
+    def __init__(self, date_from: datetime.datetime = None,
+                 date_to: datetime.datetime = None,
+                 channel: Channel = None) -> None:
+        super().__init__()
+        self.date_from = date_from
+        self.date_to = date_to
+        self.channel = channel
+
+    def select(self) -> sqlalchemy.sql.Select:
+        """
+        Запрос сообщений выгрузки. Сообщения упорядочены по диалогам, внутри
+        диалога -- в порядке отправки
+        :return:
+        """
+        messages = database.Message.__table__
+        dialogs = database.Dialog.__table__
+        customers = database.Customer.__table__
+        query = sqlalchemy.select([
+            messages.c.id, messages.c.dialog_id, messages.c.seq,
+            messages.c.created_at, messages.c.channel, messages.c.user_id,
+            customers.c.id, customers.c.name, customers.c.phone_number,
+            messages.c.text
+        ]).select_from(
+            messages.join(dialogs, messages.c.dialog_id == dialogs.c.id)
+            .join(customers, dialogs.c.customer_id == customers.c.id)
+        ).order_by(messages.c.dialog_id, messages.c.id)
+        if self.date_from is not None:
+            query = query.where(messages.c.created_at >= self.date_from)
+        if self.date_to is not None:
+            query = query.where(messages.c.created_at < self.date_to)
+        if self.channel is not None:
+            query = query.where(messages.c.channel == self.channel)
+        return query
+
+
+def _values(row) -> list:
+    values = list(row)
+    values[3] = values[3].isoformat()
+    values[4] = values[4].value
+    return values
+
+
+class NdjsonWriter:
+    """
+    Запись сообщений в формате NDJSON: по одному json-объекту на строку
+    """
+    content_type = "application/x-ndjson"
+
+    def header(self) -> bytes:
+        return b""
+
+    def rows(self, rows: typing.Iterable) -> bytes:
+        return "".join(
+            json.dumps(dict(zip(FIELDS, _values(row))), ensure_ascii=False)
+            + "\n"
+            for row in rows
+        ).encode("utf8")
+
+
+class CsvWriter:
+    """
+    Запись сообщений в формате CSV с заголовком
+    """
+    content_type = "text/csv"
+
+    def _write(self, rows: typing.Iterable) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode("utf8")
+
+    def header(self) -> bytes:
+        return self._write([FIELDS])
+
+    def rows(self, rows: typing.Iterable) -> bytes:
+        return self._write(_values(row) for row in rows)
+
+
+WRITERS = {"ndjson": NdjsonWriter, "csv": CsvWriter}
+
+
+def iter_chunks(connection: Connection, query: ExportQuery,
+                chunk_size: int = config.EXPORT_CHUNK_SIZE
+                ) -> typing.Iterator[list]:
+    """
+    Читает сообщения выгрузки порциями курсором на стороне сервера
+    :param connection: Соединение с бд, используемое только для выгрузки
+    :param query:
+    :param chunk_size: Размер порции
+    :return:
+    """
+    result = connection.execution_options(stream_results=True).execute(
+        query.select()
+    )
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+async def stream(query: ExportQuery, writer,
+                 chunk_size: int = config.EXPORT_CHUNK_SIZE
+                 ) -> typing.AsyncIterator[bytes]:
+    """
+    Асинхронно выгружает сообщения. Чтение из бд выполняется в пуле потоков
+    для работы с бд, по одной порции за раз
+    :param query:
+    :param writer: Объект записи в нужном формате
+    :param chunk_size: Размер порции
+    :return: Части выгрузки
+    """
+    loop = asyncio.get_event_loop()
+    connection = await loop.run_in_executor(
+        database.executor, database.engine().connect
+    )
+    chunks = iter_chunks(connection, query, chunk_size)
+    try:
+        yield writer.header()
+        while True:
+            rows = await loop.run_in_executor(
+                database.executor, next, chunks, None
+            )
+            if rows is None:
+                break
+            yield writer.rows(rows)
+    finally:
+        # курсор закрывается до соединения, в том числе при прерванной
+        # выгрузке
+        await loop.run_in_executor(database.executor, chunks.close)
+        await loop.run_in_executor(database.executor, connection.close)
+
+
+def main(argv: typing.List[str] = None):
+    parser = argparse.ArgumentParser(prog="oneweb_helpdesk_chat.export")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="ndjson")
+    parser.add_argument("--date-from", type=datetime.datetime.fromisoformat)
+    parser.add_argument("--date-to", type=datetime.datetime.fromisoformat)
+    parser.add_argument("--channel", type=Channel)
+    args = parser.parse_args(argv)
+
+    query = ExportQuery(args.date_from, args.date_to, args.channel)
+    writer = WRITERS[args.format]()
+    output = sys.stdout.buffer
+    output.write(writer.header())
+    with database.engine().connect() as connection:
+        for rows in iter_chunks(connection, query):
+            output.write(writer.rows(rows))
+    output.flush()
+
+
+if __name__ == "__main__":
+    main()
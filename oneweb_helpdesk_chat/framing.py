@@ -0,0 +1,105 @@
+"""
+Кодирование кадров, отправляемых сервером в вебсокет-соединения. Формат
+выбирается клиентом при подключении через подпротокол вебсокета
+(заголовок ``Sec-WebSocket-Protocol``):
+
+* без подпротокола -- каждый кадр отправляется отдельным текстовым
+  сообщением в json, как и раньше;
+* ``helpdesk.json`` -- текстовое сообщение содержит json-массив кадров;
+* ``helpdesk.msgpack`` -- бинарное сообщение содержит массив кадров в
+  MessagePack. Доступен, только если установлен пакет msgpack.
+
+В подпротоколах с массивами кадры, попавшие в очередь соединения в течение
+:data:`~oneweb_helpdesk_chat.config.WS_BATCH_WINDOW`, отправляются одним
+сообщением. Независимо от подпротокола сообщения сжимаются
+permessage-deflate, если клиент его поддерживает(см.
+:data:`~oneweb_helpdesk_chat.config.WS_COMPRESS`). Команды клиента всегда
+отправляются текстовыми сообщениями в json
+"""
+import json
+import typing
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec:
+    """
+    Кодировщик кадров
+
+    :ivar str protocol: Подпротокол вебсокета
+    :ivar bool batching: Можно ли отправлять несколько кадров одним
+      сообщением
+    """
+    protocol = None  # type: typing.Optional[str]
+    batching = False
+
+    def encode(self, frames: typing.List[dict]) -> typing.Union[str, bytes]:
+        """
+        Кодирует кадры в одно сообщение вебсокета
+        :param frames: Кадры, без пакетной отправки -- ровно один
+        :return: Текст для текстового сообщения или байты для бинарного
+        """
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    """
+    Кадр в json без подпротокола
+    """
+
+    def encode(self, frames: typing.List[dict]) -> str:
+        frame, = frames
+        return json.dumps(frame)
+
+
+class JsonBatchCodec(Codec):
+    """
+    Массив кадров в компактном json: без пробелов и без экранирования
+    не-ASCII символов
+    """
+    protocol = "helpdesk.json"
+    batching = True
+
+    def encode(self, frames: typing.List[dict]) -> str:
+        return json.dumps(frames, separators=(",", ":"), ensure_ascii=False)
+
+
+class MsgpackCodec(Codec):
+    """
+    Массив кадров в MessagePack
+    """
+    protocol = "helpdesk.msgpack"
+    batching = True
+
+    def encode(self, frames: typing.List[dict]) -> bytes:
+        return msgpack.packb(frames)
+
+
+# кодировщик соединений без подпротокола
+default_codec = JsonCodec()
+
+# подпротоколы в порядке предпочтения сервера
+_codecs = [JsonBatchCodec()]
+if msgpack is not None:
+    _codecs.insert(0, MsgpackCodec())
+codecs = {codec.protocol: codec for codec in _codecs}
+
+
+def protocols() -> typing.Tuple[str, ...]:
+    """
+    Подпротоколы, которые сервер предлагает при подключении
+    :return:
+    """
+    return tuple(codec.protocol for codec in _codecs)
+
+
+def for_protocol(protocol: typing.Optional[str]) -> Codec:
+    """
+    Кодировщик для выбранного при подключении подпротокола
+    :param protocol: Подпротокол или None
+    :return:
+    """
+    return codecs.get(protocol, default_codec)
@@ -1,12 +1,45 @@
 """
 Шлюзы для взаимодейстия с серверами чатов. Данный модуль предназначен для
-обработки http-запросов от сервисов
+обработки http-запросов от сервисов.
+
+Шлюзы могут быть описаны в json-файле настроек(см.
+:data:`~oneweb_helpdesk_chat.config.GATEWAYS_CONFIG`)::
+
+    {
+        "whatsapp": {
+            "class": "oneweb_helpdesk_chat.gateways.WhatsappGateway",
+            "endpoint": "https://graph.facebook.com/v17.0/<id>/messages",
+            "credentials": {"token": "..."},
+            "connection_limit": 20
+        }
+    }
+
+Такие шлюзы создаются и запускаются при старте приложения и
+останавливаются при его завершении. Файл перечитывается по сигналу SIGHUP:
+измененные шлюзы пересоздаются, удаленные останавливаются, при этом
+отправка сообщений, начатая старым экземпляром шлюза, не прерывается
+
+Вложения входящих сообщений(изображения, голосовые сообщения, документы)
+скачиваются шлюзом у сервиса по фрагментам(см. :meth:`Gateway.fetch_media`)
+в :class:`хранилище вложений <oneweb_helpdesk_chat.storage.media.MediaStore>`
+до сохранения сообщений
 """
-import string
+import asyncio
+import importlib
+import inspect
+import json
+import re
+import typing
+
+import aiohttp
 from aiohttp import web
 
 from abc import ABCMeta, abstractmethod
-from . import storage
+from . import config as app_config, logs, storage
+from .schema import Field, Schema, SchemaError
+from .tracing import tracer
+
+logger = logs.get_logger(__name__)
 
 
 class Message:
@@ -15,11 +48,82 @@ class Message:
     информацию о полученном сообщении
     """
 
-    def __init__(self, phone_number, text, user_name="") -> None:
+    def __init__(self, phone_number, text, user_name="",
+                 media: "MediaReference" = None) -> None:
         super().__init__()
         self.phone_number = phone_number
         self.text = text
         self.user_name = user_name
+        self.media = media
+
+
+class MediaReference:
+    """
+    Вложение полученного сообщения, которое еще нужно скачать у сервиса
+    """
+
+    def __init__(self, media_id: str, content_type: str = None,
+                 filename: str = None) -> None:
+        """
+        :param media_id: Идентификатор или адрес вложения в сервисе
+        :param content_type: MIME-тип, если сервис его сообщает
+        :param filename: Исходное имя файла
+        """
+        super().__init__()
+        self.media_id = media_id
+        self.content_type = content_type
+        self.filename = filename
+
+
+class GatewayConfig:
+    """
+    Настройки шлюза
+    """
+
+    def __init__(self, gateway_class: str = "", endpoint: str = "",
+                 credentials: dict = None, connection_limit: int = 10,
+                 options: dict = None) -> None:
+        """
+        :param gateway_class: Путь к классу шлюза вида ``package.module.Class``
+        :param endpoint: Адрес api сервиса
+        :param credentials: Данные для авторизации в сервисе
+        :param connection_limit: Максимальное количество одновременных
+          соединений с сервисом
+        :param options: Прочие настройки, специфичные для шлюза
+        """
+        super().__init__()
+        self.gateway_class = gateway_class
+        self.endpoint = endpoint
+        self.credentials = credentials or {}
+        self.connection_limit = connection_limit
+        self.options = options or {}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GatewayConfig":
+        return cls(
+            gateway_class=data["class"],
+            endpoint=data.get("endpoint", ""),
+            credentials=data.get("credentials"),
+            connection_limit=int(data.get("connection_limit", 10)),
+            options=data.get("options")
+        )
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, GatewayConfig) and vars(self) == vars(other)
+
+
+def read_config(path: str) -> typing.Dict[str, GatewayConfig]:
+    """
+    Читает настройки шлюзов из json-файла
+    :param path:
+    :return: Настройки шлюзов по их псевдонимам
+    """
+    with open(path, encoding="utf8") as config_file:
+        data = json.load(config_file)
+    return {
+        alias: GatewayConfig.from_dict(gateway_data)
+        for alias, gateway_data in data.items()
+    }
 
 
 class Gateway(metaclass=ABCMeta):
@@ -30,18 +134,76 @@ class Gateway(metaclass=ABCMeta):
     :meth:`app.gateway_hook`, а также в модуле :mod:`chat` для отправки
     сообщений в сервис
 
+    Если тело запроса сервиса описывается схемой, то шлюз наследуется от
+    :class:`SchemaGateway` и переопределять parse_message не нужно
+
     :ivar: DialogRepository dialog_repository
     """
 
     def __init__(self, customer_repository: storage.CustomerRepository,
-                 dialog_repository: storage.DialogRepository) -> None:
+                 dialog_repository: storage.DialogRepository,
+                 config: GatewayConfig = None,
+                 media_store: storage.MediaStore = None) -> None:
         """
         :param customer_repository: Репозиторий для клиентов
         :param dialog_repository: Репозиторий для диалогов
+        :param config: Настройки шлюза
+        :param media_store: Хранилище вложений
         """
         super().__init__()
         self.customer_repository = customer_repository
         self.dialog_repository = dialog_repository
+        self.config = config or GatewayConfig()
+        self.media_store = media_store or storage.default_media_store()
+        # пул соединений с сервисом, создается при запуске шлюза
+        self.http = None  # type: typing.Optional[aiohttp.ClientSession]
+        self.in_flight = 0
+        self._drained = None  # type: typing.Optional[asyncio.Event]
+
+    async def start(self):
+        """
+        Запускает шлюз: создает пул соединений с сервисом
+        :return:
+        """
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=self.config.connection_limit
+        ))
+
+    async def stop(self, timeout: float = 30):
+        """
+        Останавливает шлюз. Перед закрытием пула соединений дожидается
+        завершения уже начатых отправок сообщений
+        :param timeout: Максимальное время ожидания отправок
+        :return:
+        """
+        if self.in_flight:
+            self._drained = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    async def send(self, message):
+        """
+        Отправляет сообщение в сервис через :meth:`send_message`, учитывая
+        его в количестве незавершенных отправок
+        :param message:
+        :return:
+        """
+        self.in_flight += 1
+        try:
+            with tracer.span("gateway.send", channel=self.get_channel()):
+                result = self.send_message(message)
+                if inspect.isawaitable(result):
+                    result = await result
+            return result
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight and self._drained is not None:
+                self._drained.set()
 
     async def handle_message(self, request: web.Request) -> storage.Message:
         """
@@ -51,30 +213,174 @@ class Gateway(metaclass=ABCMeta):
         :return:
         """
         raw_message = await self.parse_message(request)
-        dialog = await self.dialog_repository.get_by_phone(
-            raw_message.phone_number
-        )
+        messages = await self.ingest_messages([raw_message])
+        return messages[0]
 
-        if dialog is None:
-            customer = await self.customer_repository.get_by_phone(
-                raw_message.phone_number
+    async def handle_messages(
+            self, request: web.Request
+    ) -> typing.List[storage.Message]:
+        """
+        Обработка запроса от сервиса, который может содержать сразу несколько
+        сообщений(см. :meth:`parse_messages`)
+        :param request:
+        :return: Сохраненные сообщения в порядке их следования в запросе
+        """
+        return await self.ingest_messages(await self.parse_messages(request))
+
+    async def ingest_messages(
+            self, raw_messages: typing.List[Message]
+    ) -> typing.List[storage.Message]:
+        """
+        Привязывает сообщения к диалогам и сохраняет их. Количество запросов к
+        бд не зависит от количества сообщений: диалоги и клиенты ищутся одним
+        запросом по всем идентификаторам клиентов(см. :meth:`identify`),
+        недостающие создаются, и все сохраняется одним коммитом. Если клиент
+        был создан другим процессом и потому не попал в индекс известных
+        идентификаторов, поиск повторяется без индекса
+        :param raw_messages: Разобранные сообщения
+        :return: Сохраненные сообщения
+        """
+        if not raw_messages:
+            return []
+        attachments = await self.download_attachments(raw_messages)
+        try:
+            return await self._ingest_messages(
+                raw_messages, attachments, use_index=True
+            )
+        except storage.IdentityConflict:
+            logger.info("gateway.identity_conflict",
+                        channel=self.get_channel())
+            return await self._ingest_messages(
+                raw_messages, attachments, use_index=False
             )
-            if customer is None:
-                customer = storage.Customer(
-                    name=raw_message.user_name,
-                    phone_number=raw_message.phone_number
+
+    async def download_attachments(
+            self, raw_messages: typing.List[Message]
+    ) -> typing.List[typing.Optional[storage.Attachment]]:
+        """
+        Параллельно скачивает вложения сообщений в хранилище вложений. Если
+        вложение скачать не удалось, сообщение сохраняется без него
+        :param raw_messages:
+        :return: Вложения в порядке сообщений, None для сообщений без
+          вложений
+        """
+        async def download(media: typing.Optional[MediaReference]):
+            if media is None:
+                return None
+            chunks = self.fetch_media(media)
+            if chunks is None:
+                logger.warning(
+                    "gateway.media_unsupported", channel=self.get_channel(),
+                    media_id=media.media_id
+                )
+                return None
+            try:
+                with tracer.span("gateway.media", channel=self.get_channel()):
+                    return await self.media_store.save(
+                        chunks, media.content_type,
+                        media.filename
+                    )
+            except Exception:
+                logger.exception(
+                    "gateway.media_failed", channel=self.get_channel(),
+                    media_id=media.media_id
                 )
-                await self.customer_repository.save(customer)
-            dialog = storage.Dialog(customer=customer)
+                return None
+
+        return await asyncio.gather(*(
+            download(raw_message.media) for raw_message in raw_messages
+        ))
 
-        message = storage.Message(
-            channel=self.get_channel(), text=raw_message.text
+    def fetch_media(
+            self, media: MediaReference
+    ) -> typing.Optional[typing.AsyncIterator[bytes]]:
+        """
+        Скачивает вложение у сервиса. Реализуется асинхронным генератором,
+        который отдает содержимое фрагментами по мере получения, не
+        дожидаясь загрузки всего вложения. Шлюз, который не умеет скачивать
+        вложения, не переопределяет метод: сообщение сохраняется без вложения
+        :param media:
+        :return: None, если шлюз не поддерживает вложения
+        """
+        return None
+
+    async def _ingest_messages(
+            self, raw_messages: typing.List[Message],
+            attachments: typing.List[typing.Optional[storage.Attachment]],
+            use_index: bool
+    ) -> typing.List[storage.Message]:
+        identities = [
+            self.identify(raw_message) for raw_message in raw_messages
+        ]
+        unique = list(dict.fromkeys(identities))
+        dialogs = await self.dialog_repository.get_by_identities(
+            unique, use_index
         )
-        dialog.messages.append(message)
 
-        await self.dialog_repository.save(dialog)
+        missing = [identity for identity in unique if identity not in dialogs]
+        if missing:
+            customers = await self.customer_repository.resolve(
+                missing, use_index
+            )
+            user_names = {
+                identity: raw_message.user_name
+                for identity, raw_message in zip(
+                    reversed(identities), reversed(raw_messages)
+                )
+            }
+            for identity in missing:
+                customer = customers.get(identity) or self.create_customer(
+                    identity, user_names[identity]
+                )
+                dialogs[identity] = storage.Dialog(customer=customer)
+
+        messages = []
+        for identity, raw_message, attachment in zip(
+                identities, raw_messages, attachments
+        ):
+            message = storage.Message(
+                channel=self.get_channel(), text=raw_message.text,
+                attachment=attachment
+            )
+            dialogs[identity].add_message(message)
+            messages.append(message)
+
+        await self.dialog_repository.save_all(dialogs.values())
+        for message in messages:
+            logger.debug_sampled(
+                "message.ingested", dialog_id=message.dialog_id,
+                seq=message.seq
+            )
+        return messages
+
+    def identify(self, raw_message: Message) -> storage.domain.Identity:
+        """
+        Идентификатор клиента, от которого пришло сообщение. По умолчанию --
+        нормализованный номер телефона, шлюзы каналов без номеров телефонов
+        возвращают идентификатор пользователя в канале
+        :param raw_message:
+        :return:
+        """
+        return storage.domain.Identity.phone(
+            storage.identity.normalize_phone(raw_message.phone_number)
+        )
 
-        return message
+    @staticmethod
+    def create_customer(identity: storage.domain.Identity,
+                        name: str) -> storage.Customer:
+        """
+        Создает нового клиента с указанным идентификатором
+        :param identity:
+        :param name: Имя клиента
+        :return:
+        """
+        if identity.is_phone:
+            return storage.Customer(
+                name=name, phone_number=identity.external_id
+            )
+        return storage.Customer(name=name, aliases=[storage.CustomerAlias(
+            channel=identity.channel, external_id=identity.external_id
+        )])
 
     @abstractmethod
     def get_channel(self):
@@ -88,6 +394,16 @@ class Gateway(metaclass=ABCMeta):
         :return:
         """
 
+    async def parse_messages(self, request) -> typing.List[Message]:
+        """
+        Парсинг тела запроса, которое может содержать сразу несколько
+        сообщений. По умолчанию тело содержит одно сообщение и разбирается
+        методом parse_message
+        :param request:
+        :return:
+        """
+        return [await self.parse_message(request)]
+
     @abstractmethod
     def send_message(self, message):
         """
@@ -97,15 +413,56 @@ class Gateway(metaclass=ABCMeta):
         """
 
 
+class SchemaGateway(Gateway):
+    """
+    Базовый класс для шлюзов, тело запроса которых описывается схемой(см.
+    :mod:`oneweb_helpdesk_chat.schema`). Подкласс задает схему в атрибуте
+    payload_schema, разбор тела выполняется по ней
+    """
+    payload_schema = None  # type: typing.Type[Schema]
+
+    async def parse_message(self, request) -> Message:
+        messages = await self.parse_messages(request)
+        if not messages:
+            raise web.HTTPBadRequest(text="no messages in payload")
+        return messages[0]
+
+    async def parse_messages(self, request) -> typing.List[Message]:
+        body = await request.read()
+        with tracer.span("gateway.parse", size=len(body)) as span:
+            try:
+                messages = self.payload_schema.loads(body)
+            except SchemaError as e:
+                raise web.HTTPBadRequest(text=str(e))
+            if span is not None:
+                span.set_attribute("messages", len(messages))
+        return messages
+
+
+class GatewayNotFound(KeyError):
+    """
+    Шлюз с указанным псевдонимом не зарегистрирован
+    """
+
+
+# псевдоним шлюза используется в url хука, поэтому допустимы только буквы,
+# цифры, "_", "-" и "."
+ALIAS_PATTERN = re.compile(r"[\w.-]+")
+
+
 class Repository:
     """
-    Реозиторий для шлюзов
+    Реозиторий для шлюзов. Шлюзы, загруженные из настроек методом
+    :meth:`load`, управляются репозиторием: он их запускает, пересоздает при
+    изменении настроек и останавливает
     """
 
     def __init__(self) -> None:
         super().__init__()
 
-        self._repository = {}
+        self._repository = {}  # type: typing.Dict[str, Gateway]
+        # настройки шлюзов, которыми управляет репозиторий
+        self.configs = {}  # type: typing.Dict[str, GatewayConfig]
 
     def register_gateway(self, alias: str, gateway: Gateway):
         """
@@ -115,11 +472,22 @@ class Repository:
         :param gateway: Непосредственно шлюз
         :return:
         """
-        if string.whitespace in alias:
+        self.check_alias(alias)
+        self._repository[alias] = gateway
+
+    @staticmethod
+    def check_alias(alias: str):
+        """
+        Проверяет псевдоним шлюза
+        :param alias:
+        :return:
+        :raises ValueError: Если псевдоним недопустим
+        """
+        if not ALIAS_PATTERN.fullmatch(alias):
             raise ValueError(
-                "Gateway alias can't contain any whitespace characters"
+                "Gateway alias can contain only letters, digits, '_', '-' "
+                "and '.'"
             )
-        self._repository[alias] = gateway
 
     def unregister_gateway(self, alias: str):
         """
@@ -134,14 +502,194 @@ class Repository:
         Возвращает шлюз из репозитория по его псевдониму
         :param alias:
         :return:
+        :raises GatewayNotFound: Если шлюз не зарегистрирован
+        """
+        try:
+            return self._repository[alias]
+        except KeyError:
+            raise GatewayNotFound(alias) from None
+
+    def get_by_channel(self, channel: storage.domain.Channel) -> Gateway:
+        """
+        Возвращает шлюз канала, используется для отправки ответов клиентам.
+        Если канал обслуживают несколько шлюзов, то возвращается первый
+        зарегистрированный
+        :param channel:
+        :return:
+        :raises GatewayNotFound: Если шлюза канала нет
+        """
+        for gateway in self._repository.values():
+            if gateway.get_channel() == channel:
+                return gateway
+        raise GatewayNotFound(channel)
+
+    @staticmethod
+    def create_gateway(config: GatewayConfig) -> Gateway:
+        """
+        Создает шлюз по настройкам
+        :param config:
+        :return:
+        """
+        module_name, _, class_name = config.gateway_class.rpartition(".")
+        gateway_class = getattr(importlib.import_module(module_name),
+                                class_name)
+        return gateway_class(
+            storage.default_customer_repository(),
+            storage.default_dialogs_repository(),
+            config
+        )
+
+    async def load(self, configs: typing.Dict[str, GatewayConfig]):
+        """
+        Приводит управляемые шлюзы в соответствие с настройками: создает и
+        запускает новые шлюзы, пересоздает шлюзы с измененными настройками и
+        останавливает удаленные. Сначала запускаются все новые экземпляры, и
+        только затем они разом заменяют старые: если создать или запустить
+        хотя бы один шлюз не удалось, то запущенные новые экземпляры
+        останавливаются, а настройки не меняются. Новый экземпляр шлюза
+        начинает принимать запросы сразу после замены, старый
+        останавливается после завершения начатых им отправок
+        :param configs: Настройки шлюзов по псевдонимам
+        :return:
+        """
+        started = {}  # type: typing.Dict[str, Gateway]
+        try:
+            for alias, config in configs.items():
+                if self.configs.get(alias) == config:
+                    continue
+                self.check_alias(alias)
+                started[alias] = self.create_gateway(config)
+                await started[alias].start()
+        except Exception:
+            await self._stop_gateways(started.values())
+            raise
+
+        retired = []
+        try:
+            for alias, gateway in started.items():
+                if alias in self.configs:
+                    retired.append(self._repository[alias])
+                self._repository[alias] = gateway
+                self.configs[alias] = configs[alias]
+            for alias in set(self.configs) - set(configs):
+                del self.configs[alias]
+                retired.append(self._repository.pop(alias))
+        finally:
+            await self._stop_gateways(retired)
+
+    @staticmethod
+    async def _stop_gateways(gateways: typing.Iterable[Gateway]):
+        # ошибка остановки одного шлюза не мешает остановить остальные
+        results = await asyncio.gather(
+            *(gateway.stop() for gateway in gateways), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("gateways.stop_failed", exc_info=result)
+
+    async def stop(self):
+        """
+        Останавливает все управляемые шлюзы
+        :return:
         """
-        return self._repository[alias]
+        await self.load({})
+
 
+# типы сообщений WhatsApp с вложением, вложение лежит в поле с названием типа
+WHATSAPP_MEDIA_TYPES = ("image", "audio", "video", "document", "sticker")
 
-class WhatsappGateway(Gateway):
+
+def whatsapp_message(phone_number: str, text: str, **media) -> Message:
     """
-    Шлюз для общения с Вотсаппом
+    Создает сообщение из элемента тела вебхука WhatsApp
+    :param phone_number:
+    :param text: Текст текстового сообщения
+    :param media: Описания вложений по типам, заполнено не больше одного
+    :return:
     """
+    for media_type, item in media.items():
+        if item is None:
+            continue
+        if not isinstance(item.get("id"), str):
+            raise SchemaError("{}.id: required".format(media_type))
+        return Message(
+            phone_number, item.get("caption", ""), media=MediaReference(
+                item["id"], item.get("mime_type"), item.get("filename")
+            )
+        )
+    return Message(phone_number, text)
+
+
+class WhatsappPayload(Schema):
+    """
+    Тело вебхука WhatsApp Business. Один запрос может содержать несколько
+    сообщений и статусов доставки, статусы и сообщения неподдерживаемых
+    типов(например, геопозиции) пропускаются
+    """
+    items = "entry.*.changes.*.value.messages.*"
+    when = {"type": frozenset(("text",) + WHATSAPP_MEDIA_TYPES)}
+    target = whatsapp_message
+
+    phone_number = Field("from", (str, int), convert=str)
+    text = Field("text.body", default="")
+    image = Field("image", dict, default=None)
+    audio = Field("audio", dict, default=None)
+    video = Field("video", dict, default=None)
+    document = Field("document", dict, default=None)
+    sticker = Field("sticker", dict, default=None)
+
+
+class WhatsappGateway(SchemaGateway):
+    """
+    Шлюз для общения с Вотсаппом через WhatsApp Business Cloud API. В
+    настройках указываются адрес отправки сообщений(endpoint) и токен
+    доступа(credentials.token). Адрес api для получения вложений можно
+    переопределить настройкой options.media_endpoint
+    """
+    payload_schema = WhatsappPayload
+
+    def get_channel(self):
+        return storage.domain.Channel.WHATSAPP
+
+    def authorization(self) -> dict:
+        return {
+            "Authorization": "Bearer {}".format(
+                self.config.credentials.get("token", "")
+            )
+        }
+
+    async def fetch_media(self, media: MediaReference):
+        # сначала по идентификатору вложения запрашивается временная ссылка
+        # на него, затем содержимое скачивается по ссылке
+        endpoint = self.config.options.get(
+            "media_endpoint", "https://graph.facebook.com/v17.0/"
+        )
+        async with self.http.get(
+                endpoint + media.media_id, headers=self.authorization()
+        ) as response:
+            response.raise_for_status()
+            url = (await response.json())["url"]
+        async with self.http.get(
+                url, headers=self.authorization()
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(
+                    app_config.MEDIA_CHUNK_SIZE
+            ):
+                yield chunk
+
+    async def send_message(self, message):
+        async with self.http.post(
+                self.config.endpoint,
+                headers=self.authorization(),
+                json={
+                    "messaging_product": "whatsapp",
+                    "to": message.dialog.customer.phone_number,
+                    "type": "text",
+                    "text": {"body": message.text},
+                }
+        ) as response:
+            response.raise_for_status()
 
 
 repository = Repository()
@@ -0,0 +1,80 @@
+"""
+Список диалогов(инбокс) для работников тп. Список строится по денормализованной
+сводке диалога(последнее сообщение, счетчик входящих сообщений), поэтому для
+его получения не нужно агрегировать таблицу сообщений.
+"""
+import datetime
+import typing
+
+from oneweb_helpdesk_chat.chat import DEFAULT_DT_FORMAT
+from oneweb_helpdesk_chat.storage import Dialog, DialogAssignment
+
+# Максимальный размер страницы, который может запросить клиент
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(dialog: Dialog) -> str:
+    """
+    Формирует курсор для получения следующей страницы после указанного диалога
+    :param dialog: Последний диалог на текущей странице
+    :return:
+    """
+    return "{}_{}".format(dialog.last_message_at.isoformat(), dialog.id)
+
+
+def decode_cursor(cursor: str) -> typing.Tuple[datetime.datetime, int]:
+    """
+    Разбирает курсор, сформированный :meth:`encode_cursor`
+    :param cursor: Курсор
+    :return: Пара из времени последнего сообщения и идентификатора диалога
+    :raises ValueError: Если курсор некорректный
+    """
+    last_message_at, _, dialog_id = cursor.rpartition("_")
+    return (
+        datetime.datetime.fromisoformat(last_message_at), int(dialog_id)
+    )
+
+
+def dialog_summary(dialog: Dialog, unread_count: int) -> dict:
+    """
+    Представление диалога в списке диалогов
+    :param dialog: Диалог
+    :param unread_count: Количество непрочитанных пользователем сообщений
+    :return:
+    """
+    last_message = dialog.last_message
+    assigned_user = dialog.assigned_user
+    return {
+        "id": dialog.id,
+        "customer": {
+            "id": dialog.customer.id,
+            "name": dialog.customer.name
+        },
+        "assigned_user": {
+            "id": assigned_user.id,
+            "name": assigned_user.name
+        } if assigned_user else None,
+        "last_message": {
+            "id": last_message.id,
+            "text": last_message.text,
+            "from_customer": last_message.user_id is None,
+        } if last_message else None,
+        "last_message_at": dialog.last_message_at.strftime(DEFAULT_DT_FORMAT),
+        "state": dialog.state.value,
+        "unread_count": unread_count,
+    }
+
+
+def assignment_summary(assignment: DialogAssignment) -> dict:
+    """
+    Представление записи журнала назначений диалога
+    :param assignment:
+    :return:
+    """
+    return {
+        "id": assignment.id,
+        "from_user_id": assignment.from_user_id,
+        "to_user_id": assignment.to_user_id,
+        "changed_by_user_id": assignment.changed_by_user_id,
+        "created_at": assignment.created_at.strftime(DEFAULT_DT_FORMAT),
+    }
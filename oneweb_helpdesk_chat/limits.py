@@ -0,0 +1,191 @@
+"""
+Ограничение частоты запросов и контроль нагрузки. Запросы, которые превышают
+лимит или приходят, когда пул для работы с бд перегружен, отклоняются до того,
+как дойдут до бд: с кодом 429 и 503 соответственно. Количество отклоненных
+запросов доступно в метрике ``requests_shed_total``
+"""
+import collections
+import ipaddress
+import math
+import time
+import typing
+
+from aiohttp import web
+
+from oneweb_helpdesk_chat import config, metrics
+
+shed_counter = metrics.registry.counter(
+    "requests_shed_total", "Requests rejected by rate limits or admission"
+)
+
+
+def parse_networks(
+        proxies: typing.Iterable[str]
+) -> typing.List[typing.Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
+    """
+    Разбирает адреса и подсети доверенных прокси
+    :param proxies: Адреса(``10.0.0.1``) или подсети(``10.0.0.0/8``)
+    :return:
+    """
+    return [ipaddress.ip_network(proxy, strict=False) for proxy in proxies]
+
+
+class ClientAddressResolver:
+    """
+    Определяет адрес клиента для ограничений по ip. Если запрос пришел от
+    доверенного прокси, то адресом клиента считается самый правый адрес
+    X-Forwarded-For, не принадлежащий доверенным прокси: левые адреса
+    заголовка клиент может подставить сам
+    """
+
+    def __init__(self, trusted_proxies: typing.Iterable[str] = ()) -> None:
+        super().__init__()
+        self.networks = parse_networks(trusted_proxies)
+
+    def is_trusted(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.networks)
+
+    def resolve(self, request: web.Request) -> str:
+        """
+        :param request:
+        :return: Адрес клиента
+        """
+        address = request.remote
+        if not self.networks or not self.is_trusted(address):
+            return address
+        forwarded = request.headers.get("X-Forwarded-For", "")
+        for hop in reversed([hop.strip() for hop in forwarded.split(",")]):
+            if not hop:
+                continue
+            address = hop
+            if not self.is_trusted(hop):
+                break
+        return address
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты по алгоритму token bucket, отдельное ведро для каждого
+    ключа. Для ведра хранится только пара(количество токенов, время
+    обновления), ведра давно не обращавшихся ключей вытесняются при превышении
+    max_keys. Вытеснение безопасно: вытесняемое ведро почти наверняка уже
+    полное, а отсутствующее ведро считается полным
+    """
+
+    def __init__(self, name: str, rate: float, burst: int,
+                 max_keys: int = config.RATE_LIMIT_KEYS,
+                 clock: typing.Callable[[], float] = time.monotonic) -> None:
+        """
+        :param name: Имя ограничителя для метрик
+        :param rate: Скорость пополнения ведра, токенов в секунду
+        :param burst: Емкость ведра
+        :param max_keys: Максимальное количество хранимых ведер
+        :param clock: Источник времени
+        """
+        super().__init__()
+        self.name = name
+        self.configured = (rate, burst)
+        self.rate = rate
+        self.burst = burst  # type: float
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = collections.OrderedDict()
+
+    def split(self, parts: int):
+        """
+        Делит заданный лимит между несколькими процессами: каждый получает
+        свою долю скорости и всплеска. Всплеск не опускается ниже одного
+        запроса, иначе при всплеске меньше количества процессов запросы
+        отклонялись бы всегда
+        :param parts: Количество процессов
+        :return:
+        """
+        rate, burst = self.configured
+        self.rate = rate / parts
+        self.burst = max(min(burst, 1), burst / parts)
+        self.buckets.clear()
+
+    def acquire(self, key: str, cost: float = 1) -> float:
+        """
+        Забирает токены из ведра ключа
+        :param key:
+        :param cost: Количество токенов
+        :return: 0, если токены получены, иначе через сколько секунд их будет
+          достаточно
+        """
+        now = self.clock()
+        tokens, updated_at = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        retry_after = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        elif self.rate > 0:
+            retry_after = (cost - tokens) / self.rate
+        else:
+            retry_after = math.inf
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return retry_after
+
+    def check(self, key: str, cost: float = 1):
+        """
+        То же, что и :meth:`acquire`, но при превышении лимита выбрасывает
+        исключение
+        :param key:
+        :param cost:
+        :return:
+        :raises web.HTTPTooManyRequests: Если лимит превышен
+        """
+        retry_after = self.acquire(key, cost)
+        if retry_after:
+            shed_counter.inc(reason=self.name)
+            raise web.HTTPTooManyRequests(headers={
+                "Retry-After": str(max(1, math.ceil(min(retry_after, 3600))))
+            })
+
+
+class AdmissionController:
+    """
+    Контроль нагрузки: отклоняет запросы, если задачи для работы с бд копятся
+    в очереди пула потоков, т.е. новые запросы все равно не будут обработаны
+    вовремя
+    """
+
+    def __init__(self, backlog: typing.Callable[[], int],
+                 pool_usage: typing.Callable[[], float],
+                 max_backlog: int = config.ADMISSION_MAX_BACKLOG,
+                 max_pool_usage: float = config.ADMISSION_MAX_POOL_USAGE
+                 ) -> None:
+        """
+        :param backlog: Функция, возвращающая количество ожидающих задач
+        :param pool_usage: Функция, возвращающая долю занятых соединений бд
+        :param max_backlog: Максимальное количество ожидающих задач
+        :param max_pool_usage: Доля занятых соединений, при которой запросы
+          отклоняются уже при половине max_backlog ожидающих задач
+        """
+        super().__init__()
+        self.backlog = backlog
+        self.pool_usage = pool_usage
+        self.max_backlog = max_backlog
+        self.max_pool_usage = max_pool_usage
+
+    def overloaded(self) -> bool:
+        backlog = self.backlog()
+        if backlog > self.max_backlog:
+            return True
+        return (backlog > self.max_backlog // 2
+                and self.pool_usage() >= self.max_pool_usage)
+
+    def check(self):
+        """
+        :return:
+        :raises web.HTTPServiceUnavailable: Если сервис перегружен
+        """
+        if self.overloaded():
+            shed_counter.inc(reason="overload")
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
@@ -0,0 +1,187 @@
+"""
+Структурированное логгирование. Записи логов -- json-объекты с именем события
+и произвольными полями::
+
+    logger = logs.get_logger(__name__)
+    logger.info("gateway.messages_received", gateway="whatsapp", count=10)
+
+Запись в файл или поток не выполняется в потоке цикла событий: обработчик
+только кладет запись в очередь, а форматирование и запись выполняет фоновый
+поток(:class:`logging.handlers.QueueListener`).
+
+К каждой записи добавляется идентификатор корреляции текущего запроса(см.
+:data:`correlation_id`), поэтому все записи, относящиеся к обработке одного
+сообщения -- от хука шлюза до доставки в вебсокеты, в том числе в других
+процессах, -- можно найти по одному идентификатору.
+
+Частые отладочные события пишутся выборочно методом
+:meth:`StructuredLogger.debug_sampled`, доля записываемых событий задается
+настройкой :data:`~oneweb_helpdesk_chat.config.LOG_DEBUG_SAMPLE_RATE`
+"""
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import typing
+import uuid
+
+from oneweb_helpdesk_chat import config
+
+ROOT_LOGGER = "oneweb_helpdesk_chat"
+
+# идентификатор корреляции обрабатываемого запроса
+correlation_id = contextvars.ContextVar(
+    "correlation_id", default=None
+)  # type: contextvars.ContextVar[typing.Optional[str]]
+
+_listener = None  # type: typing.Optional[logging.handlers.QueueListener]
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    Логгер, принимающий поля записи именованными аргументами
+    """
+
+    def __init__(self, logger: logging.Logger,
+                 sample_rate: float = None) -> None:
+        super().__init__(logger, {})
+        self.sample_rate = sample_rate
+
+    def process(self, msg, kwargs):
+        fields = {
+            key: kwargs.pop(key) for key in list(kwargs)
+            if key not in ("exc_info", "stack_info", "stacklevel", "extra")
+        }
+        kwargs["extra"] = {"fields": fields}
+        return msg, kwargs
+
+    def debug_sampled(self, event: str, **fields):
+        """
+        Пишет отладочное событие с вероятностью sample_rate. Доля
+        записанных событий добавляется в запись полем sample_rate
+        :param event:
+        :param fields:
+        :return:
+        """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        rate = (config.LOG_DEBUG_SAMPLE_RATE if self.sample_rate is None
+                else self.sample_rate)
+        if rate < 1 and random.random() >= rate:
+            return
+        self.debug(event, sample_rate=rate, **fields)
+
+
+def get_logger(name: str, sample_rate: float = None) -> StructuredLogger:
+    return StructuredLogger(logging.getLogger(name), sample_rate)
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Добавляет в запись идентификатор корреляции. Фильтр должен выполняться в
+    потоке, который пишет запись, поэтому он устанавливается на обработчик
+    очереди
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Форматирует запись в однострочный json
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        correlation = getattr(record, "correlation_id", None)
+        if correlation is not None:
+            data["correlation_id"] = correlation
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc_info"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Обработчик, который кладет запись в очередь без форматирования: запись
+    форматируется уже в фоновом потоке. Чтобы запись можно было передать в
+    другой поток, сообщение подставляется заранее, а исключение сохраняется
+    в виде текста
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+
+def setup(level: str = config.LOG_LEVEL, path: str = config.LOG_FILE,
+          stream: typing.TextIO = None):
+    """
+    Настраивает логгирование приложения: записи логгеров пакета попадают в
+    очередь и пишутся фоновым потоком в файл path или в stream(по умолчанию
+    stderr). Повторный вызов перенастраивает логгирование
+    :param level: Уровень логгирования
+    :param path: Путь к файлу логов
+    :param stream: Поток для записи, если файл не указан
+    :return:
+    """
+    global _listener
+    shutdown()
+    if path:
+        target = logging.FileHandler(path, encoding="utf8")
+    else:
+        target = logging.StreamHandler(stream or sys.stderr)
+    target.setFormatter(JsonFormatter())
+
+    handler = QueueHandler(queue.SimpleQueue())
+    handler.addFilter(CorrelationFilter())
+    logger = logging.getLogger(ROOT_LOGGER)
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(handler.queue, target)
+    _listener.start()
+
+
+def shutdown():
+    """
+    Дописывает накопившиеся в очереди записи и останавливает фоновый поток
+    :return:
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,110 @@
+"""
+Простые метрики процесса: счетчики и показатели, которые отдаются эндпоинтом
+``/metrics/`` в текстовом формате prometheus. Метрики хранятся в памяти
+процесса, обновление метрики -- это изменение числа в словаре, поэтому их можно
+обновлять на горячем пути без заметных затрат.
+"""
+import typing
+
+LabelsKey = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+def _labels_key(labels: dict) -> LabelsKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(key: LabelsKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, value) for name, value in key
+    ) + "}"
+
+
+class Counter:
+    """
+    Монотонно возрастающий счетчик. Значения хранятся отдельно для каждого
+    набора меток
+    """
+    metric_type = "counter"
+
+    def __init__(self, name: str, description: str) -> None:
+        super().__init__()
+        self.name = name
+        self.description = description
+        self.values = {}  # type: typing.Dict[LabelsKey, float]
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_labels_key(labels), 0)
+
+    def samples(self) -> typing.Iterable[typing.Tuple[LabelsKey, float]]:
+        return self.values.items()
+
+
+class Gauge(Counter):
+    """
+    Показатель, который может как расти, так и уменьшаться. Вместо хранимого
+    значения можно указать функцию, которая будет вызвана при сборе метрик
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name: str, description: str,
+                 callback: typing.Callable[[], float] = None) -> None:
+        super().__init__(name, description)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        self.values[_labels_key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self) -> typing.Iterable[typing.Tuple[LabelsKey, float]]:
+        if self.callback is not None:
+            return [((), self.callback())]
+        return super().samples()
+
+
+class Registry:
+    """
+    Реестр метрик. Метрика с одним и тем же именем создается один раз,
+    повторный вызов возвращает уже созданную
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.metrics = {}  # type: typing.Dict[str, Counter]
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, description))
+
+    def gauge(self, name: str, description: str,
+              callback: typing.Callable[[], float] = None) -> Gauge:
+        gauge = self.metrics.setdefault(
+            name, Gauge(name, description, callback)
+        )
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def render(self) -> str:
+        """
+        Возвращает все метрики в текстовом формате prometheus
+        :return:
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append("# HELP {} {}".format(metric.name, metric.description))
+            lines.append("# TYPE {} {}".format(metric.name, metric.metric_type))
+            for key, value in metric.samples():
+                lines.append("{}{} {}".format(
+                    metric.name, _format_labels(key), value
+                ))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,96 @@
+"""
+Семплирующий профилировщик потока цикла событий. Включается и выключается во
+время работы через административные эндпоинты(см.
+:func:`~oneweb_helpdesk_chat.app.profiler_start`). Фоновый поток с заданным
+интервалом снимает стек вызовов профилируемого потока, результат отдается в
+формате свернутых стеков(collapsed stacks), из которого строятся flame graph::
+
+    module:function;module:function 42
+"""
+import collections
+import sys
+import threading
+import typing
+
+
+class SamplingProfiler:
+    """
+    Профилировщик, периодически снимающий стек одного потока
+
+    :ivar float interval: Интервал между снимками в секундах
+    :ivar collections.Counter stacks: Количество снимков каждого стека
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        super().__init__()
+        self.interval = interval
+        self.stacks = collections.Counter()  # type: typing.Counter[str]
+        self.samples = 0
+        self._thread = None  # type: typing.Optional[threading.Thread]
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, thread_id: int = None):
+        """
+        Запускает профилирование потока, по умолчанию вызывающего
+        :param thread_id: Идентификатор профилируемого потока
+        :return:
+        """
+        if self.running:
+            raise RuntimeError("profiler is already running")
+        target = threading.get_ident() if thread_id is None else thread_id
+        self.stacks.clear()
+        self.samples = 0
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(target,), name="sampling-profiler",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, thread_id: int):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = self._collapse(frame)
+            with self._lock:
+                self.stacks[stack] += 1
+                self.samples += 1
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("{}:{}".format(
+                frame.f_globals.get("__name__", code.co_filename),
+                code.co_name
+            ))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def collapsed(self) -> str:
+        """
+        Результат в формате свернутых стеков, самые частые стеки первыми
+        :return:
+        """
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return "".join(
+            "{} {}\n".format(stack, count) for stack, count in stacks
+        )
+
+
+# профилировщик потока цикла событий приложения
+profiler = SamplingProfiler()
@@ -1,40 +1,87 @@
 """
-Данный модуль предоставляет различные реализации очередей для взаимодействия с
-чатом. Предполагается, что этот модуль будет использован как для простой
-реализации репозитория очередей и самих очередей, так и для более продвинутой
-реализации, например на базе redis'а.
+Данный модуль предоставляет хранилища последних сообщений диалогов для
+досылки клиентам после переподключения. Доставка сообщений подписанным
+соединениям выполняется реестром соединений(см.
+:mod:`oneweb_helpdesk_chat.connections`)
 """
-import asyncio
+import collections
+import typing
 
-from oneweb_helpdesk_chat.storage import Message
+from oneweb_helpdesk_chat import config
 
 
-class DictRepository:
+class TailRepository:
     """
-    Самая примитивная реализация репозитория. Данный репозиторий использует
-    словарь для хранения очередей и asyncio.Queue для хранения элементов очереди
-
+    Хранит в памяти последние сообщения диалогов(уже преобразованные для
+    отправки), чтобы дослать их клиенту после переподключения без обращения к
+    бд. Объем ограничен: для каждого диалога хранится не больше size сообщений,
+    а при превышении количества диалогов вытесняются давно не обновлявшиеся.
+    Сообщения, которые вытеснены из памяти, досылаются из бд
     """
-    def __init__(self) -> None:
+
+    def __init__(self, size: int = config.DIALOG_TAIL_SIZE,
+                 max_dialogs: int = config.DIALOG_TAILS_LIMIT) -> None:
         super().__init__()
-        self.dict = {}
+        self.size = size
+        self.max_dialogs = max_dialogs
+        # идентификатор диалога -> deque из пар (seq, сообщение)
+        self.dict = collections.OrderedDict()
+
+    def append(self, dialog_id: str, seq: int, payload: dict) -> bool:
+        """
+        Добавляет сообщение в хвост диалога. Хвост всегда содержит сообщения
+        подряд, без пропусков: если seq не следует за последним сообщением
+        хвоста(например, часть сообщений не дошла через брокер), то хвост
+        начинается заново с этого сообщения, а более ранние сообщения
+        досылаются из бд. Повторные и запоздавшие сообщения пропускаются
+        :param dialog_id: Идентификатор диалога
+        :param seq: Порядковый номер сообщения в диалоге
+        :param payload: Сообщение, преобразованное для отправки
+        :return: False, если в хвосте был обнаружен пропуск и он начат заново
+        """
+        tail = self.dict.get(dialog_id)
+        if tail is None:
+            tail = self.dict[dialog_id] = collections.deque(maxlen=self.size)
+            if len(self.dict) > self.max_dialogs:
+                self.dict.popitem(last=False)
+        else:
+            self.dict.move_to_end(dialog_id)
+        contiguous = True
+        if tail:
+            last_seq = tail[-1][0]
+            if seq <= last_seq:
+                return True
+            if seq != last_seq + 1:
+                tail.clear()
+                contiguous = False
+        tail.append((seq, payload))
+        return contiguous
 
-    async def put(self, queue_name: str, message: Message):
+    def clear(self):
         """
-        Сохранение сообщения в очерди
-        :param queue_name: Название очереди, если ее нет, то будет созадана
-        :param message: Сообщение, которое нужно будет сохранить
+        Удаляет хвосты всех диалогов, например, когда часть сообщений могла
+        быть потеряна при переподключении к брокеру
         :return:
         """
-        return await self.dict.setdefault(queue_name, asyncio.Queue()).put(
-            message
-        )
+        self.dict.clear()
 
-    async def get(self, queue_name: str) -> Message:
+    def discard(self, dialog_id: str):
         """
-        Получить сообщение из указанной очереди. Помните, что при получении
-        сообщения из очереди, оно будет удалено из нее
-        :param queue_name: Название очереди, откуда нужно получить сообщение
+        Удаляет хвост диалога, например, когда диалог закрыт
+        :param dialog_id:
         :return:
         """
-        return await self.dict.setdefault(queue_name, asyncio.Queue()).get()
+        self.dict.pop(dialog_id, None)
+
+    def since(self, dialog_id: str,
+              seq: int) -> typing.Optional[typing.List[dict]]:
+        """
+        Возвращает сообщения диалога с порядковым номером больше seq
+        :param dialog_id: Идентификатор диалога
+        :param seq: Последний полученный клиентом порядковый номер
+        :return: Сообщения или None, если в памяти есть не все нужные сообщения
+        """
+        tail = self.dict.get(dialog_id)
+        if not tail or tail[0][0] > seq + 1:
+            return None
+        return [payload for message_seq, payload in tail if message_seq > seq]
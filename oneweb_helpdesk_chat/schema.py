@@ -0,0 +1,230 @@
+"""
+Декларативные схемы тел запросов от сервисов. Схема описывает, где в json
+находятся поля сообщения, и при объявлении класса компилируется в функцию
+разбора: для каждой схемы генерируется код без циклов по полям и частям путей и
+без обращений к описанию схемы во время разбора. Пример::
+
+    class Payload(Schema):
+        items = "entry.*.changes.*.value.messages.*"
+        when = {"type": "text"}
+        target = Message
+
+        phone_number = Field("from", (str, int), convert=str)
+        text = Field("text.body")
+        user_name = Field("profile.name", default="")
+
+    messages = Payload.loads(body)
+
+* items -- путь к элементам в теле запроса, ``*`` означает перебор
+  элементов списка. Если не указан, то все тело -- один элемент
+* when -- значения полей, которым должен соответствовать элемент, или
+  множества допустимых строковых значений. Остальные элементы(например,
+  статусы доставки) пропускаются
+* target -- функция, которой передаются разобранные поля в виде именованных
+  аргументов
+"""
+import json
+import typing
+
+_MISSING = object()
+_SKIP = object()
+
+
+class SchemaError(ValueError):
+    """
+    Тело запроса не соответствует схеме
+    """
+
+
+class Field:
+    """
+    Поле схемы
+    """
+
+    def __init__(self, path: str, type_: typing.Union[type, tuple] = str,
+                 default: typing.Any = _MISSING,
+                 convert: typing.Callable = None) -> None:
+        """
+        :param path: Путь к значению внутри элемента, через точку
+        :param type_: Допустимый тип или кортеж типов значения
+        :param default: Значение по умолчанию. Если не указано, то поле
+          обязательное
+        :param convert: Функция преобразования значения после проверки типа
+        """
+        super().__init__()
+        self.path = path
+        self.type_ = type_
+        self.default = default
+        self.convert = convert
+
+
+def _path_lookup(source: str, path: str, target: str,
+                 indent: str) -> typing.List[str]:
+    """
+    Генерирует код, который записывает в переменную target значение по пути
+    path или _MISSING, если какой-то части пути нет
+    """
+    lines = []
+    for part in path.split("."):
+        lines.extend([
+            "{}if {}.__class__ is dict:".format(indent, source),
+            "{}    {} = {}.get({!r}, _MISSING)".format(
+                indent, target, source, part
+            ),
+            "{}else:".format(indent),
+            "{}    {} = _MISSING".format(indent, target),
+        ])
+        source = target
+    return lines
+
+
+def compile_item_parser(fields: typing.Dict[str, Field], when: dict,
+                        target: typing.Callable) -> typing.Callable:
+    """
+    Компилирует функцию разбора одного элемента
+    :param fields: Поля схемы по именам аргументов target
+    :param when: Условия на значения полей элемента
+    :param target: Функция создания результата
+    :return: Функция, возвращающая результат target или _SKIP, если элемент не
+      соответствует условиям when
+    """
+    namespace = {
+        "_MISSING": _MISSING, "_SKIP": _SKIP, "_target": target,
+        "SchemaError": SchemaError
+    }
+    lines = ["def parse_item(item):"]
+    for number, (path, value) in enumerate(when.items()):
+        variable = "w{}".format(number)
+        namespace["_when{}".format(number)] = value
+        lines.extend(_path_lookup("item", path, variable, "    "))
+        if isinstance(value, (set, frozenset)):
+            lines.append(
+                "    if {0}.__class__ is not str or {0} not in _when{1}:"
+                .format(variable, number)
+            )
+        else:
+            lines.append("    if {} != _when{}:".format(variable, number))
+        lines.append("        return _SKIP")
+
+    arguments = []
+    for number, (name, field) in enumerate(fields.items()):
+        variable = "f{}".format(number)
+        namespace["_type{}".format(number)] = field.type_
+        lines.extend(_path_lookup("item", field.path, variable, "    "))
+        lines.append("    if {} is _MISSING:".format(variable))
+        if field.default is _MISSING:
+            lines.append("        raise SchemaError({!r})".format(
+                "{}: required".format(field.path)
+            ))
+        else:
+            namespace["_default{}".format(number)] = field.default
+            lines.append("        {} = _default{}".format(variable, number))
+        lines.append("    elif not isinstance({}, _type{}):".format(
+            variable, number
+        ))
+        lines.append("        raise SchemaError({!r})".format(
+            "{}: invalid type".format(field.path)
+        ))
+        if field.convert is not None:
+            namespace["_convert{}".format(number)] = field.convert
+            lines.append("    else:")
+            lines.append("        {0} = _convert{1}({0})".format(
+                variable, number
+            ))
+        arguments.append("{}={}".format(name, variable))
+    lines.append("    return _target({})".format(", ".join(arguments)))
+
+    exec("\n".join(lines), namespace)
+    return namespace["parse_item"]
+
+
+def compile_items_parser(path: typing.Optional[str],
+                         parse_item: typing.Callable) -> typing.Callable:
+    """
+    Компилирует функцию, которая перебирает элементы по пути, в котором ``*``
+    означает перебор списка, и разбирает их функцией parse_item. Отсутствующие
+    части пути считаются пустыми
+    :param path: Путь к элементам или None, если тело -- один элемент
+    :param parse_item: Функция разбора элемента
+    :return: Функция, возвращающая список разобранных элементов
+    """
+    namespace = {
+        "_MISSING": _MISSING, "_SKIP": _SKIP, "_parse_item": parse_item,
+        "SchemaError": SchemaError
+    }
+    lines = ["def parse(data):", "    result = []"]
+    variable, indent = "data", "    "
+    for number, part in enumerate(path.split(".") if path else ()):
+        next_variable = "n{}".format(number)
+        if part == "*":
+            lines.extend([
+                "{}if {}.__class__ is not list:".format(indent, variable),
+                "{}    raise SchemaError({!r})".format(
+                    indent, "{}: list expected".format(path)
+                ),
+                "{}for {} in {}:".format(indent, next_variable, variable),
+            ])
+        else:
+            lines.extend([
+                "{}if {}.__class__ is not dict:".format(indent, variable),
+                "{}    raise SchemaError({!r})".format(
+                    indent, "{}: object expected".format(path)
+                ),
+                "{}{} = {}.get({!r}, _MISSING)".format(
+                    indent, next_variable, variable, part
+                ),
+                "{}if {} is not _MISSING:".format(indent, next_variable),
+            ])
+        variable, indent = next_variable, indent + "    "
+    lines.extend([
+        "{}item = _parse_item({})".format(indent, variable),
+        "{}if item is not _SKIP:".format(indent),
+        "{}    result.append(item)".format(indent),
+        "    return result",
+    ])
+
+    exec("\n".join(lines), namespace)
+    return namespace["parse"]
+
+
+class Schema:
+    """
+    Базовый класс схем. Поля схемы объявляются атрибутами класса типа
+    :class:`Field`, функция разбора компилируется при объявлении подкласса
+    """
+    items = None  # type: typing.Optional[str]
+    when = {}  # type: dict
+    target = dict  # type: typing.Callable
+
+    fields = {}  # type: typing.Dict[str, Field]
+    parse_item = None  # type: typing.Callable
+    parse = None  # type: typing.Callable
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, Field):
+                    fields[name] = value
+        cls.fields = fields
+        parse_item = compile_item_parser(fields, cls.when, cls.target)
+        cls.parse_item = staticmethod(parse_item)
+        # разбор уже декодированного тела запроса, возвращает список
+        # разобранных элементов и выбрасывает SchemaError
+        cls.parse = staticmethod(compile_items_parser(cls.items, parse_item))
+
+    @classmethod
+    def loads(cls, body: typing.Union[bytes, str]) -> list:
+        """
+        Разбирает тело запроса
+        :param body:
+        :return: Список разобранных элементов
+        :raises SchemaError: Если тело не является json или не соответствует
+          схеме
+        """
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            raise SchemaError("invalid json: {}".format(e)) from e
+        return cls.parse(data)
@@ -0,0 +1,211 @@
+"""
+Запуск сервера в несколько процессов. Каждый воркер -- отдельный процесс со
+своим приложением, движком бд, пулом потоков и хвостами сообщений, поэтому
+воркеры не конкурируют за один GIL. Воркеры принимают соединения на одном и том
+же порту: каждый открывает свой слушающий сокет с SO_REUSEPORT, и входящие
+соединения распределяет ядро. Там, где SO_REUSEPORT недоступен, слушающий сокет
+открывается в родительском процессе и наследуется воркерами.
+
+Сообщения и события, опубликованные в одном воркере, пересылаются остальным
+через брокер(:mod:`oneweb_helpdesk_chat.broker`), который работает в
+отдельном процессе. Поэтому вебсокет оператора и хук шлюза для одного и того
+же диалога могут попасть в разные воркеры.
+
+Периодическое обслуживание хранилища(партиции, закрытие неактивных диалогов,
+архивация) выполняется только в первом воркере.
+
+Ограничения частоты запросов заданы на весь сервис и делятся поровну между
+воркерами. Контроль нагрузки на пул для работы с бд у каждого воркера свой,
+как и сам пул.
+
+Запуск::
+
+    python -m oneweb_helpdesk_chat --port 8080 --workers 4
+"""
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import tempfile
+import time
+import typing
+
+from aiohttp import web
+
+from oneweb_helpdesk_chat import config
+from oneweb_helpdesk_chat.broker import UnixSocketBroker, run_broker
+
+
+def listen_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    """
+    Создает слушающий сокет
+    :param host:
+    :param port:
+    :param reuse_port: Разрешить другим процессам слушать тот же порт
+    :return:
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(host: str, port: int, broker_path: str,
+               sock: socket.socket = None, maintenance: bool = False,
+               workers: int = 1):
+    """
+    Точка входа процесса-воркера
+    :param host:
+    :param port:
+    :param broker_path: Путь к сокету брокера
+    :param sock: Унаследованный слушающий сокет, если SO_REUSEPORT недоступен
+    :param maintenance: Выполнять ли в воркере обслуживание хранилища
+    :param workers: Общее количество воркеров
+    :return:
+    """
+    from oneweb_helpdesk_chat import logs, storage, tracing
+    from oneweb_helpdesk_chat.app import make_app
+
+    # потоки записи логов и трасс не наследуются при fork, поэтому они
+    # настраиваются в каждом воркере
+    logs.setup()
+    tracing.setup()
+    storage.database.setup_process()
+    if sock is None:
+        sock = listen_socket(host, port, reuse_port=True)
+    web.run_app(
+        make_app(UnixSocketBroker(broker_path), maintenance, workers),
+        sock=sock, print=None
+    )
+
+
+def run_child(target: typing.Callable, *args):
+    """
+    Точка входа дочернего процесса. Обработчики сигналов родителя
+    сбрасываются, чтобы процесс завершался по SIGTERM
+    :param target:
+    :param args:
+    :return:
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    target(*args)
+
+
+class Supervisor:
+    """
+    Родительский процесс: запускает брокер и воркеры и перезапускает их, если
+    они неожиданно завершились
+    """
+
+    def __init__(self, host: str, port: int, workers: int,
+                 broker_path: str) -> None:
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.workers_count = workers
+        self.broker_path = broker_path
+        self.context = multiprocessing.get_context("fork")
+        self.sock = None
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.sock = listen_socket(host, port, reuse_port=False)
+        self.broker = None  # type: typing.Optional[multiprocessing.Process]
+        self.workers = []  # type: typing.List[multiprocessing.Process]
+        self.stopping = False
+
+    def start_broker(self) -> multiprocessing.Process:
+        process = self.context.Process(
+            target=run_child, args=(run_broker, self.broker_path),
+            name="broker"
+        )
+        process.start()
+        return process
+
+    def start_worker(self, number: int) -> multiprocessing.Process:
+        # обслуживание хранилища выполняет только первый воркер, в том числе
+        # после перезапуска
+        process = self.context.Process(
+            target=run_child, name="worker-{}".format(number),
+            args=(run_worker, self.host, self.port, self.broker_path,
+                  self.sock, number == 0, self.workers_count)
+        )
+        process.start()
+        return process
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.broker = self.start_broker()
+        self.workers = [
+            self.start_worker(number) for number in range(self.workers_count)
+        ]
+        try:
+            while not self.stopping:
+                multiprocessing.connection.wait(
+                    [self.broker.sentinel]
+                    + [worker.sentinel for worker in self.workers],
+                    timeout=1
+                )
+                if self.stopping:
+                    break
+                if not self.broker.is_alive():
+                    self.broker = self.start_broker()
+                for number, worker in enumerate(self.workers):
+                    if not worker.is_alive():
+                        self.workers[number] = self.start_worker(number)
+        finally:
+            self.shutdown()
+
+    def shutdown(self, timeout: float = 10):
+        """
+        Останавливает воркеры, затем брокер
+        :param timeout: Сколько ждать завершения воркеров перед SIGKILL
+        :return:
+        """
+        for worker in self.workers:
+            worker.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                worker.kill()
+        self.broker.terminate()
+        self.broker.join()
+        if os.path.exists(self.broker_path):
+            os.remove(self.broker_path)
+
+
+def main(argv: typing.List[str] = None):
+    parser = argparse.ArgumentParser(prog="oneweb_helpdesk_chat")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=config.WORKERS)
+    parser.add_argument("--broker-socket", default=config.BROKER_SOCKET)
+    args = parser.parse_args(argv)
+    if args.workers > 1 and config.SEARCH_BACKEND == "local":
+        # каждый воркер видел бы в локальном индексе только сообщения,
+        # полученные им самим
+        parser.error("SEARCH_BACKEND=local supports a single worker only")
+
+    if args.workers <= 1:
+        from oneweb_helpdesk_chat import logs, storage, tracing
+        from oneweb_helpdesk_chat.app import make_app
+        logs.setup()
+        tracing.setup()
+        storage.database.setup_process()
+        web.run_app(make_app(), host=args.host, port=args.port)
+        return
+
+    broker_path = args.broker_socket or os.path.join(
+        tempfile.mkdtemp(prefix="helpdesk-chat-"), "broker.sock"
+    )
+    Supervisor(args.host, args.port, args.workers, broker_path).run()
@@ -0,0 +1,207 @@
+"""
+Эфемерные сигналы диалогов: "печатает" и "прочитано". В отличие от сообщений
+и событий(:mod:`oneweb_helpdesk_chat.events`) сигналы нигде не сохраняются и
+могут теряться:
+
+* сигналы одного отправителя в диалоге за интервал
+  :data:`~oneweb_helpdesk_chat.config.SIGNAL_FLUSH_INTERVAL` схлопываются в
+  один, накопленные сигналы рассылаются раз в интервал одним кадром брокера
+  для всех процессов;
+* частота сигналов каждого отправителя ограничена, лишние отбрасываются;
+* сигнал не ставится в очередь соединения, которое не успевает читать
+  кадры(очередь заполнена наполовину), и не накапливается сверх
+  :data:`~oneweb_helpdesk_chat.config.SIGNAL_PENDING_LIMIT`.
+
+Отброшенные сигналы учитываются в метрике ``signals_dropped_total``.
+
+Пользователь отправляет сигналы командами мультиплексированного
+соединения(только по диалогам, на которые оно подписано не в режиме
+наблюдения)::
+
+    {"command": "typing", "dialog_id": 1}
+    {"command": "read", "dialog_id": 1}
+
+и получает их кадрами ``{"type": "signal", "dialog_id": 1, "signal":
+"typing", "user_id": 2}``, для сигналов клиента user_id равен null. Шлюзы,
+которые получают такие сигналы от клиентов, публикуют их через
+:meth:`SignalHub.publish`.
+
+Сигнал "прочитано" от пользователя также сбрасывает его счетчик
+непрочитанных сообщений диалога, но не сразу: отметки о прочтении копятся
+в :class:`ReadReceipts` и записываются в бд пачкой раз в
+:data:`~oneweb_helpdesk_chat.config.READ_RECEIPTS_FLUSH_INTERVAL`
+"""
+import asyncio
+import collections
+import typing
+from enum import Enum
+
+from oneweb_helpdesk_chat import config, logs, metrics
+from oneweb_helpdesk_chat.connections import Connection, ConnectionRegistry
+from oneweb_helpdesk_chat.limits import RateLimiter
+
+logger = logs.get_logger(__name__)
+
+dropped_counter = metrics.registry.counter(
+    "signals_dropped_total", "Ephemeral signals dropped, by reason"
+)
+
+
+class SignalType(Enum):
+    TYPING = "typing"
+    READ = "read"
+
+
+class ReadReceipts:
+    """
+    Отметки о прочтении диалогов пользователями, ожидающие записи в бд.
+    Повторные отметки одного пользователя в диалоге до записи схлопываются
+    """
+
+    def __init__(
+            self,
+            mark_read_many: typing.Callable[
+                [typing.Set[typing.Tuple[int, int]]], typing.Awaitable
+            ],
+            interval: float = config.READ_RECEIPTS_FLUSH_INTERVAL
+    ) -> None:
+        """
+        :param mark_read_many: Асинхронная функция записи отметок, получает
+          множество пар (идентификатор диалога, идентификатор пользователя)
+        :param interval: Интервал записи в секундах
+        """
+        super().__init__()
+        self.mark_read_many = mark_read_many
+        self.interval = interval
+        self.pending = set()  # type: typing.Set[typing.Tuple[int, int]]
+
+    def add(self, dialog_id: int, user_id: int):
+        self.pending.add((dialog_id, user_id))
+
+    async def flush(self):
+        """
+        Записывает накопленные отметки. При ошибке отметки теряются, счетчик
+        непрочитанных обновится при следующем прочтении диалога
+        :return:
+        """
+        receipts, self.pending = self.pending, set()
+        if not receipts:
+            return
+        try:
+            await self.mark_read_many(receipts)
+        except Exception:
+            logger.exception("signals.read_receipts_failed",
+                             count=len(receipts))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+class SignalHub:
+    """
+    Рассылка эфемерных сигналов подписчикам диалогов
+    """
+
+    def __init__(self, registry: ConnectionRegistry,
+                 read_receipts: ReadReceipts = None,
+                 interval: float = config.SIGNAL_FLUSH_INTERVAL,
+                 limiter: RateLimiter = None,
+                 pending_limit: int = config.SIGNAL_PENDING_LIMIT) -> None:
+        """
+        :param registry: Реестр соединений, через брокер которого сигналы
+          пересылаются другим процессам
+        :param read_receipts: Отметки о прочтении для сигналов "прочитано"
+          от пользователей
+        :param interval: Интервал рассылки накопленных сигналов в секундах
+        :param limiter: Ограничитель частоты сигналов по отправителю
+        :param pending_limit: Максимальное количество накопленных сигналов
+        """
+        super().__init__()
+        self.registry = registry
+        self.read_receipts = read_receipts
+        self.interval = interval
+        self.limiter = limiter or RateLimiter(
+            "signals", config.SIGNAL_RATE_LIMIT, config.SIGNAL_RATE_BURST
+        )
+        self.pending_limit = pending_limit
+        # (диалог, сигнал, отправитель) -> кадр, последний сигнал побеждает
+        self.pending = collections.OrderedDict()
+
+    def publish(self, dialog_id: str, signal_type: SignalType,
+                user_id: int = None, customer_id: int = None) -> bool:
+        """
+        Ставит сигнал в очередь на рассылку
+        :param dialog_id: Идентификатор диалога
+        :param signal_type: Тип сигнала
+        :param user_id: Пользователь-отправитель
+        :param customer_id: Клиент-отправитель, если сигнал от клиента
+        :return: Принят ли сигнал
+        """
+        sender = ("user", user_id) if user_id is not None else (
+            "customer", customer_id
+        )
+        if self.limiter.acquire("{}:{}".format(*sender)):
+            dropped_counter.inc(reason="rate")
+            return False
+        key = (dialog_id, signal_type, sender)
+        self.pending.pop(key, None)
+        self.pending[key] = {
+            "type": "signal", "dialog_id": int(dialog_id),
+            "signal": signal_type.value, "user_id": user_id,
+        }
+        if len(self.pending) > self.pending_limit:
+            self.pending.popitem(last=False)
+            dropped_counter.inc(reason="pending")
+        return True
+
+    def handle_command(self, connection: Connection, action: str,
+                       dialog_id: str):
+        """
+        Обрабатывает команду сигнала от пользователя
+        :param connection: Соединение пользователя
+        :param action: "typing" или "read"
+        :param dialog_id:
+        :return:
+        """
+        signal_type = SignalType(action)
+        self.publish(dialog_id, signal_type, user_id=connection.user_id)
+        if signal_type == SignalType.READ and self.read_receipts is not None:
+            self.read_receipts.add(int(dialog_id), connection.user_id)
+
+    def flush(self):
+        """
+        Рассылает накопленные сигналы подписчикам этого и других процессов
+        :return:
+        """
+        if not self.pending:
+            return
+        frames = list(self.pending.values())
+        self.pending.clear()
+        self.deliver(frames)
+        if self.registry.broker is not None:
+            self.registry.broker.publish({"type": "signals", "frames": frames})
+
+    def deliver(self, frames: typing.List[dict]):
+        """
+        Доставляет сигналы мультиплексированным соединениям этого процесса,
+        подписанным на диалог, кроме соединений отправителя
+        :param frames:
+        :return:
+        """
+        for frame in frames:
+            dialog_id = str(frame["dialog_id"])
+            for connection in self.registry.dialogs.get(dialog_id, ()):
+                if (not connection.multiplexed
+                        or connection.user_id == frame["user_id"]):
+                    continue
+                if connection.congested:
+                    dropped_counter.inc(reason="congested")
+                    continue
+                connection.put(frame)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
@@ -1,28 +1,101 @@
 """
 Этот пакет представляет уровень доступа к данным
 """
-from .database import DialogRepository, CustomerRepository, UserRepository
-from .database import Customer, Dialog, Message, User
+from .database import (
+    DialogRepository, CustomerRepository, UserRepository,
+    CannedResponseRepository
+)
+from .database import (
+    CannedResponse, Customer, CustomerAlias, Dialog, DialogAssignment,
+    DialogReadState, Message, User, AssignmentConflict, IdentityConflict
+)
+from .archive import Archive
+from .media import MediaStore, MediaTooLarge
+from .domain import Attachment
+from . import identity, media, memory, partitions, querylog
+from .search import (
+    SearchIndex, PostgresSearchIndex, InvertedIndex, SearchQuery, Indexer
+)
+from oneweb_helpdesk_chat import config
 
 
 _ur_instance = None
+_cr_instance = None
 _dr_instance = None
+_crr_instance = None
+_si_instance = None
+_ms_instance = None
 
 
 def default_user_repository() -> UserRepository:
     """
     Возвращает репозиторий по умолчанию, который будет использован для работы
-    с пользователями
+    с пользователями. Реализация репозиториев выбирается настройкой
+    :data:`~oneweb_helpdesk_chat.config.STORAGE_BACKEND`
     :return:
     """
     global _ur_instance
     if not _ur_instance:
-        _ur_instance = UserRepository()
+        if config.STORAGE_BACKEND == 'memory':
+            _ur_instance = memory.MemoryUserRepository()
+        else:
+            _ur_instance = UserRepository()
     return _ur_instance
 
 
+def default_customer_repository() -> CustomerRepository:
+    global _cr_instance
+    if not _cr_instance:
+        if config.STORAGE_BACKEND == 'memory':
+            _cr_instance = memory.MemoryCustomerRepository()
+        else:
+            _cr_instance = CustomerRepository()
+    return _cr_instance
+
+
 def default_dialogs_repository() -> DialogRepository:
     global _dr_instance
     if not _dr_instance:
-        _dr_instance = DialogRepository()
+        if config.STORAGE_BACKEND == 'memory':
+            _dr_instance = memory.MemoryDialogRepository()
+        else:
+            _dr_instance = DialogRepository(
+                search_index=default_search_index()
+            )
     return _dr_instance
+
+
+def default_canned_responses_repository() -> CannedResponseRepository:
+    global _crr_instance
+    if not _crr_instance:
+        if config.STORAGE_BACKEND == 'memory':
+            _crr_instance = memory.MemoryCannedResponseRepository()
+        else:
+            _crr_instance = CannedResponseRepository()
+    return _crr_instance
+
+
+def default_search_index() -> SearchIndex:
+    """
+    Возвращает поисковый индекс по сообщениям, реализация выбирается настройкой
+    :data:`~oneweb_helpdesk_chat.config.SEARCH_BACKEND`
+    :return:
+    """
+    global _si_instance
+    if not _si_instance:
+        if config.SEARCH_BACKEND == 'local':
+            _si_instance = InvertedIndex()
+        else:
+            _si_instance = PostgresSearchIndex()
+    return _si_instance
+
+
+def default_media_store() -> MediaStore:
+    """
+    Возвращает хранилище вложений сообщений
+    :return:
+    """
+    global _ms_instance
+    if not _ms_instance:
+        _ms_instance = MediaStore()
+    return _ms_instance
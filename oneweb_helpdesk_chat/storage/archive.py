@@ -0,0 +1,240 @@
+"""
+Холодное хранилище сообщений. Сообщения старых диалогов переносятся из бд в
+сжатые gzip-файлы в формате JSON Lines, по одному файлу на диалог. Каждый
+перенос дописывает в конец файла новый gzip-фрагмент, поэтому диалог можно
+архивировать несколько раз без перезаписи уже заархивированной истории.
+Рядом с архивом хранится индекс фрагментов: смещение каждого фрагмента в
+файле и диапазон идентификаторов его сообщений, по нему страница истории
+читается с конца архива без распаковки всего файла.
+
+Перенос сообщений и их обратная загрузка выполняются методами
+:meth:`~.database.DialogRepository.archive_dialogs` и
+:meth:`~.database.DialogRepository.rehydrate`
+"""
+import collections
+import datetime
+import gzip
+import io
+import json
+import os
+import typing
+
+from oneweb_helpdesk_chat import config
+from . import domain
+
+
+def message_to_record(message) -> dict:
+    """
+    Преобразует сообщение(или строку результата запроса с такими же полями) в
+    запись архива
+    :param message:
+    :return:
+    """
+    record = {
+        "id": message.id,
+        "user_id": message.user_id,
+        "channel": message.channel.value,
+        "text": message.text,
+        "created_at": message.created_at.isoformat(),
+        "seq": message.seq,
+    }
+    if message.attachment_sha256 is not None:
+        record["attachment"] = [
+            message.attachment_sha256, message.attachment_type,
+            message.attachment_size, message.attachment_name
+        ]
+    return record
+
+
+def record_to_message(record: dict, dialog: domain.Dialog) -> domain.Message:
+    """
+    Восстанавливает сообщение из записи архива. Сообщение не привязано к
+    сессии бд
+    :param record: Запись архива
+    :param dialog: Диалог, к которому относится сообщение
+    :return:
+    """
+    return domain.Message(
+        ident=record["id"],
+        channel=domain.Channel(record["channel"]),
+        text=record["text"],
+        created_at=datetime.datetime.fromisoformat(record["created_at"]),
+        dialog=dialog,
+        user_id=record["user_id"],
+        seq=record.get("seq"),
+        attachment=domain.Attachment(*record["attachment"])
+        if record.get("attachment") else None
+    )
+
+
+class Archive:
+    """
+    Архив сообщений на локальном диске. Все методы синхронные и предназначены
+    для вызова в пуле потоков
+    """
+
+    def __init__(self, directory: str = config.ARCHIVE_DIR) -> None:
+        super().__init__()
+        self.directory = directory
+
+    def path(self, dialog_id: int) -> str:
+        """
+        Путь к файлу архива диалога. Файлы раскладываются по подкаталогам,
+        чтобы в одном каталоге не оказалось слишком много файлов
+        :param dialog_id:
+        :return:
+        """
+        return os.path.join(
+            self.directory, str(dialog_id // 1000),
+            "{}.jsonl.gz".format(dialog_id)
+        )
+
+    def index_path(self, dialog_id: int) -> str:
+        """
+        Путь к индексу фрагментов архива диалога
+        :param dialog_id:
+        :return:
+        """
+        return self.path(dialog_id) + ".index"
+
+    def size(self, dialog_id: int) -> int:
+        """
+        Размер файла архива диалога в байтах, 0 если архива нет
+        :param dialog_id:
+        :return:
+        """
+        try:
+            return os.path.getsize(self.path(dialog_id))
+        except FileNotFoundError:
+            return 0
+
+    def append(
+            self, dialog_id: int, messages: typing.Iterable
+    ) -> typing.Tuple[int, typing.Optional[int]]:
+        """
+        Дописывает сообщения в архив диалога. Сообщения записываются по мере
+        чтения из messages, поэтому потребление памяти не зависит от их
+        количества. Данные сбрасываются на диск до возврата из метода
+        :param dialog_id: Идентификатор диалога
+        :param messages: Сообщения в порядке возрастания идентификаторов
+        :return: Количество записанных сообщений и идентификатор последнего
+        """
+        path = self.path(dialog_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        count, first_id, last_id = 0, None, None
+        with open(path, "ab") as raw_file:
+            offset = raw_file.tell()
+            with gzip.GzipFile(fileobj=raw_file, mode="ab") as gzip_file:
+                for message in messages:
+                    gzip_file.write(
+                        json.dumps(message_to_record(message)).encode("utf8")
+                        + b"\n"
+                    )
+                    if first_id is None:
+                        first_id = message.id
+                    count, last_id = count + 1, message.id
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+            end = raw_file.tell()
+        if count:
+            # индекс пишется после данных: фрагмент, не попавший в индекс,
+            # все равно будет прочитан в read_last
+            with open(self.index_path(dialog_id), "a") as index_file:
+                index_file.write(json.dumps({
+                    "offset": offset, "end": end,
+                    "first_id": first_id, "last_id": last_id
+                }) + "\n")
+        return count, last_id
+
+    def _read_index(self, dialog_id: int) -> typing.List[dict]:
+        try:
+            with open(self.index_path(dialog_id)) as index_file:
+                return [json.loads(line) for line in index_file]
+        except FileNotFoundError:
+            return []
+
+    def truncate(self, dialog_id: int, size: int):
+        """
+        Обрезает архив до указанного размера. Используется для отката
+        :meth:`append`, если сообщения не удалось удалить из бд
+        :param dialog_id:
+        :param size: Размер архива до вызова :meth:`append`
+        :return:
+        """
+        if size:
+            os.truncate(self.path(dialog_id), size)
+            entries = [
+                entry for entry in self._read_index(dialog_id)
+                if entry["end"] <= size
+            ]
+            with open(self.index_path(dialog_id), "w") as index_file:
+                for entry in entries:
+                    index_file.write(json.dumps(entry) + "\n")
+        else:
+            self.remove(dialog_id)
+
+    def read(self, dialog_id: int) -> typing.Iterator[dict]:
+        """
+        Последовательно читает записи архива диалога
+        :param dialog_id:
+        :return:
+        """
+        try:
+            gzip_file = gzip.open(self.path(dialog_id), "rt", encoding="utf8")
+        except FileNotFoundError:
+            return
+        with gzip_file:
+            for line in gzip_file:
+                yield json.loads(line)
+
+    def read_last(self, dialog_id: int, limit: int,
+                  before_id: int = None) -> typing.List[dict]:
+        """
+        Возвращает последние limit записей архива с идентификатором меньше
+        before_id, начиная с самой свежей. Фрагменты архива распаковываются с
+        конца файла по одному, пока не наберется limit записей; фрагменты,
+        все сообщения которых не раньше before_id, пропускаются по индексу
+        :param dialog_id:
+        :param limit:
+        :param before_id:
+        :return:
+        """
+        size = self.size(dialog_id)
+        if not size or limit <= 0:
+            return []
+        # участки файла без индекса(архив без индекса или сбой между записью
+        # данных и индекса) читаются целиком
+        segments, position = [], 0
+        for entry in self._read_index(dialog_id):
+            if entry["offset"] > position:
+                segments.append({"offset": position, "end": entry["offset"]})
+            segments.append(entry)
+            position = entry["end"]
+        if position < size:
+            segments.append({"offset": position, "end": size})
+
+        result = []
+        with open(self.path(dialog_id), "rb") as raw_file:
+            for segment in reversed(segments):
+                if (before_id is not None and "first_id" in segment
+                        and segment["first_id"] >= before_id):
+                    continue
+                raw_file.seek(segment["offset"])
+                data = raw_file.read(segment["end"] - segment["offset"])
+                last = collections.deque(maxlen=limit - len(result))
+                with gzip.GzipFile(fileobj=io.BytesIO(data)) as gzip_file:
+                    for line in gzip_file:
+                        record = json.loads(line)
+                        if before_id is None or record["id"] < before_id:
+                            last.append(record)
+                result.extend(reversed(last))
+                if len(result) == limit:
+                    break
+        return result
+
+    def remove(self, dialog_id: int):
+        for path in (self.path(dialog_id), self.index_path(dialog_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
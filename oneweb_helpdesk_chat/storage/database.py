@@ -3,20 +3,30 @@
 объявления моделей
 """
 import asyncio
+import datetime
 import typing
 from abc import ABCMeta
 from concurrent.futures import ThreadPoolExecutor
 
 import sqlalchemy
 from sqlalchemy import (
-    Column, Integer, String, ForeignKey, Text, DateTime, func
+    Column, Integer, String, ForeignKey, Text, DateTime, func, Index, and_,
+    or_, UniqueConstraint, event
 )
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import (
-    relationship, sessionmaker, Query, scoped_session, Session)
+    relationship, sessionmaker, Query, scoped_session, Session, joinedload,
+    contains_eager)
+from sqlalchemy.orm.attributes import set_committed_value
 
 from oneweb_helpdesk_chat import config
-from . import domain
+from oneweb_helpdesk_chat.tracing import tracer
+from . import domain, identity, querylog
+from .archive import Archive, record_to_message
+
+if typing.TYPE_CHECKING:
+    from .search import SearchIndex
 
 _engine = None
 
@@ -25,9 +35,21 @@ def engine():
     global _engine
     if _engine is None:
         # todo: сделать вариацию для получения именно тестовой бд
-        _engine = sqlalchemy.create_engine(
-            config.DB_URL, echo=False, pool_size=10, max_overflow=0
-        )
+        url = sqlalchemy.engine.url.make_url(config.DB_URL)
+        if url.get_backend_name() == "sqlite":
+            # запросы выполняются в пуле потоков, поэтому соединение sqlite
+            # не привязывается к создавшему его потоку. Бд в памяти существует,
+            # пока открыто соединение, поэтому оно одно на все потоки
+            options = {"connect_args": {"check_same_thread": False}}
+            if url.database in (None, "", ":memory:"):
+                options["poolclass"] = sqlalchemy.pool.StaticPool
+        else:
+            options = {"pool_size": 10, "max_overflow": 0}
+        if url.drivername in ("postgresql", "postgresql+psycopg2"):
+            # executemany для вставки нескольких строк отправляется одним
+            # запросом INSERT ... VALUES (...), (...)
+            options["executemany_mode"] = "values"
+        _engine = sqlalchemy.create_engine(config.DB_URL, echo=False, **options)
     return _engine
 
 
@@ -37,50 +59,167 @@ ScopedAppSession = scoped_session(sessionmaker())
 executor = ThreadPoolExecutor(10)
 
 
+def setup_process():
+    """
+    Подготавливает модуль к работе в новом процессе-воркере: у каждого
+    процесса свои движок, пул соединений и пул потоков, унаследованные от
+    родительского процесса не используются
+    :return:
+    """
+    global _engine, executor
+    _engine = None
+    executor = ThreadPoolExecutor(10)
+    ScopedAppSession.remove()
+    ScopedAppSession.configure(bind=engine())
+
+
+def reserve_ids(session: Session, objects: typing.Iterable):
+    """
+    Заранее присваивает новым объектам идентификаторы из последовательностей
+    postgres, по одному запросу на таблицу. Строки с известными
+    идентификаторами orm вставляет одним executemany
+    :param session:
+    :param objects: Новые объекты
+    :return:
+    """
+    by_table = {}
+    for obj in objects:
+        table = getattr(type(obj), "__table__", None)
+        if table is not None and "id" in table.c and obj.id is None:
+            by_table.setdefault(table, []).append(obj)
+    for table, table_objects in by_table.items():
+        sequence = "{}_id_seq".format(table.name)
+        ids = session.execute(
+            sqlalchemy.select([func.nextval(sequence)]).select_from(
+                func.generate_series(1, len(table_objects))
+            )
+        ).fetchall()
+        for obj, (pk,) in zip(table_objects, ids):
+            obj.id = pk
+
+
+def executor_backlog() -> int:
+    """
+    Количество задач, ожидающих свободного потока в пуле для работы с бд
+    :return:
+    """
+    return executor._work_queue.qsize()
+
+
+def pool_usage() -> float:
+    """
+    Доля занятых соединений пула бд. Если движок еще не создан, то 0
+    :return:
+    """
+    if _engine is None or not hasattr(_engine.pool, "checkedout"):
+        return 0
+    capacity = _engine.pool.size() + max(_engine.pool._max_overflow, 0)
+    return _engine.pool.checkedout() / capacity if capacity else 0
+
+
 async def fetch_results(query: Query, fetch_method="all", *args):
     """
     Простая обертка для получения результатов запроса асинхронно(внутри используется
-    asyncio.get_event_loop().run_in_executor)
+    asyncio.get_event_loop().run_in_executor). Внутри трассы запрос
+    покрывается интервалом db.fetch
     :param query: Запрос, который нужно выполнить
     :param fetch_method: Метод, который используется для получения
     :param args: Аргументы для метода fetch_method
     :return:
     """
-    return await asyncio.get_event_loop().run_in_executor(
-        executor,
-        getattr(query, fetch_method),
-        *args
+    return await tracer.run_in_executor(
+        executor, "db.fetch",
+        querylog.bind_origin(getattr(query, fetch_method)), *args,
+        attributes={"db.fetch_method": fetch_method}
     )
 
 
 async def perform_commit(session: sqlalchemy.orm.Session):
     """
-    Обертка для асинхронного коммита в бд
+    Обертка для асинхронного коммита в бд. Внутри трассы коммит покрывается
+    интервалом db.commit
     :param session: Сессия, которую нужно закоммитить
     :return:
     """
-    return await asyncio.get_event_loop().run_in_executor(
-        executor, session.commit
+    return await tracer.run_in_executor(
+        executor, "db.commit", querylog.bind_origin(session.commit)
     )
 
 Base = declarative_base()
 
 
+def messages_foreign_key(name: str, **kwargs) -> tuple:
+    """
+    Внешний ключ на таблицу сообщений для передачи в :class:`Column`. У
+    партиционированной таблицы сообщений нет уникального ограничения только по
+    id(оно обязано включать ключ партиционирования), поэтому в этом случае
+    внешние ключи на нее не создаются
+    :param name: Название ограничения
+    :param kwargs: Дополнительные параметры для :class:`ForeignKey`
+    :return: Кортеж из внешнего ключа или пустой кортеж
+    """
+    if config.MESSAGES_PARTITIONED:
+        return ()
+    return (ForeignKey("messages.id", name=name, **kwargs),)
+
+
 class Customer(Base, domain.Customer):
     """
     Клиент. Тот, кто обращается к нам
     :type dialogs: list(Dialog)
-    :ivar str phone_number: Номер телефона клиента, по нему мы связываем нескольких клиентов, пришедших из разных
-      каналов.
-      todo: некоторые каналы могут не иметь номер телефона, тогда нам нужно еще добавить какие-то другие
-        алиасы, причем по нескольку, но это довольно сложная задача
+    :ivar str phone_number: Номер телефона клиента в формате E.164, по нему мы
+      связываем нескольких клиентов, пришедших из разных каналов. У клиентов
+      из каналов без номера телефона его нет
+    :type aliases: list(CustomerAlias)
     """
     __tablename__ = "customers"
+    __table_args__ = (
+        Index("ux_customers_phone_number", "phone_number", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
-    phone_number = Column(String, nullable=False)
+    phone_number = Column(String, nullable=True)
     dialogs = relationship("Dialog", back_populates="customer")  # type:
+    aliases = relationship("CustomerAlias", back_populates="customer")
+
+    def identities(self) -> typing.List[domain.Identity]:
+        """
+        Все идентификаторы клиента: номер телефона и алиасы
+        :return:
+        """
+        identities = [
+            domain.Identity(alias.channel, alias.external_id)
+            for alias in self.aliases
+        ]
+        if self.phone_number:
+            identities.append(domain.Identity.phone(self.phone_number))
+        return identities
+
+
+class CustomerAlias(Base):
+    """
+    Идентификатор клиента в канале, в котором нет номера телефона. У клиента
+    может быть несколько алиасов в разных каналах
+    """
+    __tablename__ = "customer_aliases"
+    __table_args__ = (
+        UniqueConstraint(
+            "channel", "external_id", name="uq_customer_aliases_identity"
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    customer_id = Column(
+        Integer, ForeignKey("customers.id"), nullable=False, index=True
+    )
+    channel = Column(String(32), nullable=False)
+    external_id = Column(String, nullable=False)
+    customer = relationship("Customer", back_populates="aliases")
+
+    @property
+    def identity(self) -> domain.Identity:
+        return domain.Identity(self.channel, self.external_id)
 
 
 class User(Base, domain.User):
@@ -93,21 +232,134 @@ class User(Base, domain.User):
     name = Column(String, nullable=False)
     login = Column(String, nullable=False)
     password = Column(String, nullable=False)
+    team = Column(String(64), nullable=True)
     dialogs = relationship("Dialog", back_populates="assigned_user")
 
 
+class CannedResponse(Base, domain.CannedResponse):
+    """
+    Шаблон ответа команды сотрудников тп
+    """
+    __tablename__ = "canned_responses"
+    __table_args__ = (
+        UniqueConstraint(
+            "team", "shortcut", name="uq_canned_responses_team_shortcut"
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    team = Column(String(64), nullable=True)
+    shortcut = Column(String(64), nullable=False)
+    text = Column(Text, nullable=False)
+
+
+# условие частичных индексов, в которые попадают только незакрытые диалоги
+_DIALOG_NOT_CLOSED = sqlalchemy.text(
+    "state <> '{}'".format(domain.DialogState.CLOSED.name)
+)
+
+
 class Dialog(Base, domain.Dialog):
     __tablename__ = "dialogs"
+    __table_args__ = (
+        # индекс для постраничного вывода списка диалогов по свежести
+        Index("ix_dialogs_last_message_at_id", "last_message_at", "id"),
+        # поиск незакрытого диалога клиента, размер индекса зависит от
+        # количества активных обращений, а не от количества всех клиентов
+        Index(
+            "ix_dialogs_open_customer_id", "customer_id",
+            postgresql_where=_DIALOG_NOT_CLOSED,
+            sqlite_where=_DIALOG_NOT_CLOSED
+        ),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     customer_id = Column(Integer, ForeignKey("customers.id"))
-    # assigned_user_id будет постоянно меняться
-    # todo: нужно будет добавть логгирование смены пользователя
+    # меняется только передачей диалога(см. DialogRepository.transfer),
+    # каждая смена записывается в журнал DialogAssignment
     assigned_user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
 
+    # денормализованная сводка по диалогу, обновляется при добавлении каждого
+    # сообщения(см. :meth:`domain.Dialog.add_message`). last_seq и
+    # incoming_messages_count сохраненных диалогов увеличиваются в бд при
+    # сохранении сообщений(см. _assign_message_sequences)
+    last_message_id = Column(
+        Integer,
+        *messages_foreign_key(
+            "fk_dialogs_last_message_id", use_alter=True, ondelete="SET NULL"
+        ),
+        nullable=True
+    )
+    last_message_at = Column(DateTime, nullable=True)
+    incoming_messages_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    last_seq = Column(Integer, nullable=False, default=0, server_default="0")
+    # количество сообщений, перенесенных в архив(см. модуль :mod:`.archive`)
+    archived_messages_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    archived_at = Column(DateTime, nullable=True)
+    state = Column(
+        sqlalchemy.Enum(domain.DialogState, name="dialog_states"),
+        nullable=False, default=domain.DialogState.OPEN,
+        server_default=domain.DialogState.OPEN.name
+    )
+    closed_at = Column(DateTime, nullable=True)
+
     customer = relationship("Customer", back_populates="dialogs")
     assigned_user = relationship("User", back_populates="dialogs")
-    messages = relationship("Message", back_populates="dialog")  # type: list
+    messages = relationship(
+        "Message", back_populates="dialog", foreign_keys="Message.dialog_id"
+    )  # type: list
+    # post_update нужен, т.к. диалог и его последнее сообщение ссылаются друг
+    # на друга
+    last_message = relationship(
+        "Message", primaryjoin="foreign(Dialog.last_message_id) == Message.id",
+        post_update=True
+    )
+
+    def _attach_message(self, message: 'Message'):
+        # связь устанавливается со стороны сообщения: backref добавит его в
+        # коллекцию messages без загрузки всей истории диалога из бд
+        message.dialog = self
+
+
+class DialogReadState(Base, domain.DialogReadState):
+    """
+    Состояние прочтения диалога отдельным пользователем
+    """
+    __tablename__ = "dialog_read_states"
+
+    dialog_id = Column(Integer, ForeignKey("dialogs.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    read_count = Column(Integer, nullable=False, default=0)
+    last_read_message_id = Column(Integer, nullable=True)
+
+
+class DialogAssignment(Base, domain.DialogAssignment):
+    """
+    Запись журнала назначений диалога
+    """
+    __tablename__ = "dialog_assignments"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    dialog_id = Column(
+        Integer, ForeignKey("dialogs.id"), nullable=False, index=True
+    )
+    from_user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    to_user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    changed_by_user_id = Column(
+        Integer, ForeignKey("users.id"), nullable=False
+    )
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+# порядок сообщений в истории определяется id, поэтому в sqlite идентификаторы
+# удаленных(заархивированных) сообщений не должны переиспользоваться
+_messages_table_options = {"sqlite_autoincrement": True}
+if config.MESSAGES_PARTITIONED:
+    _messages_table_options["postgresql_partition_by"] = "RANGE (created_at)"
 
 
 class Message(Base, domain.Message):
@@ -118,6 +370,16 @@ class Message(Base, domain.Message):
       клиентом из указанного диалога
     """
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_dialog_id_id", "dialog_id", "id"),
+        # уникальный индекс на партиционированной таблице должен включать ключ
+        # партиционирования, поэтому там он обычный
+        Index(
+            "ix_messages_dialog_id_seq", "dialog_id", "seq",
+            unique=not config.MESSAGES_PARTITIONED
+        ),
+        _messages_table_options
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
@@ -131,15 +393,83 @@ class Message(Base, domain.Message):
     # идентификатор связанного диалога
     dialog_id = Column(Integer, ForeignKey("dialogs.id"), nullable=True)
 
-    # todo: добавить обработку случаев, когда в сообщении отправлен не текст(
-    #  пока что будем делать уведомление, что такие сообщения не принимаются)
+    # текст или подпись к вложению, для сообщений без подписи -- пустой
     text = Column(Text, nullable=False)
-    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    # вложение(см. domain.Attachment), содержимое лежит в MediaStore
+    attachment_sha256 = Column(String(64), nullable=True)
+    attachment_type = Column(String(255), nullable=True)
+    attachment_size = Column(Integer, nullable=True)
+    attachment_name = Column(String(255), nullable=True)
+    seq = Column(Integer, nullable=True)
+    # при партиционировании ключ партиционирования должен входить в первичный
+    # ключ таблицы, для orm идентификатором сообщения остается id
+    created_at = Column(
+        DateTime, nullable=False, server_default=func.now(),
+        primary_key=config.MESSAGES_PARTITIONED
+    )
+
+    dialog = relationship(
+        "Dialog", back_populates="messages", foreign_keys=[dialog_id]
+    )
+
+    __mapper_args__ = {"primary_key": [id]}
 
-    dialog = relationship("Dialog", back_populates="messages")
 
+@event.listens_for(Session, "before_flush")
+def _assign_message_sequences(session: Session, flush_context, instances):
+    """
+    Назначает порядковые номера новым сообщениям уже сохраненных диалогов и
+    обновляет счетчик входящих сообщений в бд, а не по загруженным в процесс
+    значениям: диалог может одновременно пополняться из нескольких сессий или
+    процессов. Строка диалога обновляется одним запросом ``UPDATE`` с
+    приращением, который блокирует ее до конца транзакции, поэтому номера не
+    повторяются и приращения счетчика не теряются. Значения, посчитанные
+    :meth:`domain.Dialog.add_message`, используются только для упорядочивания
+    сообщений внутри сессии
+    """
+    by_dialog = {}
+    for obj in session.new:
+        if not isinstance(obj, Message):
+            continue
+        dialog = obj.dialog
+        if dialog is None or dialog.id is None or dialog in session.new:
+            continue
+        by_dialog.setdefault(dialog, []).append(obj)
 
-DT = typing.TypeVar("DT", domain.Dialog, domain.Customer, User)
+    table = Dialog.__table__
+    returning = session.get_bind().dialect.name == "postgresql"
+    for dialog, messages in by_dialog.items():
+        messages.sort(key=lambda message: message.seq or 0)
+        statement = table.update().where(table.c.id == dialog.id).values(
+            last_seq=table.c.last_seq + len(messages),
+            incoming_messages_count=table.c.incoming_messages_count + sum(
+                1 for message in messages if message.user_id is None
+            )
+        )
+        columns = [table.c.last_seq, table.c.incoming_messages_count]
+        if returning:
+            last_seq, incoming_count = session.execute(
+                statement.returning(*columns)
+            ).one()
+        else:
+            session.execute(statement)
+            last_seq, incoming_count = session.execute(
+                sqlalchemy.select(columns).where(table.c.id == dialog.id)
+            ).one()
+        first_seq = last_seq - len(messages) + 1
+        for offset, message in enumerate(messages):
+            message.seq = first_seq + offset
+        # значения уже записаны в бд, orm не должен перезаписать их
+        # посчитанными в процессе
+        set_committed_value(dialog, "last_seq", last_seq)
+        set_committed_value(
+            dialog, "incoming_messages_count", incoming_count
+        )
+
+
+DT = typing.TypeVar(
+    "DT", domain.Dialog, domain.Customer, User, domain.CannedResponse
+)
 DBT = typing.TypeVar("DBT", Dialog, Customer)
 
 
@@ -193,10 +523,87 @@ class BaseRepository(typing.Generic[DT], metaclass=ABCMeta):
         return await fetch_results(query, 'first')
 
 
+class AssignmentConflict(Exception):
+    """
+    Диалог закрыт или уже передан другому пользователю, например,
+    одновременной передачей из другого процесса
+    """
+
+
+# значение expected_user_id по умолчанию: текущий пользователь диалога не
+# проверяется
+_ANY_USER = object()
+
+
+class IdentityConflict(Exception):
+    """
+    Клиент с одним из идентификаторов новых клиентов уже сохранен, например,
+    другим процессом после загрузки индекса известных идентификаторов
+    """
+
+
+def _possible_identities(
+        index: identity.IdentityIndex,
+        identities: typing.Iterable[domain.Identity], use_index: bool
+) -> typing.Tuple[typing.List[str], typing.List[domain.Identity]]:
+    """
+    Отбрасывает точно неизвестные идентификаторы и разделяет оставшиеся на
+    номера телефонов и алиасы
+    :param index: Индекс известных идентификаторов
+    :param identities:
+    :param use_index: Использовать ли индекс
+    :return: Номера телефонов и алиасы
+    """
+    phones, aliases = [], []
+    for identity_ in identities:
+        if use_index and not index.might_exist(identity_):
+            continue
+        if identity_.is_phone:
+            phones.append(identity_.external_id)
+        else:
+            aliases.append(identity_)
+    return phones, aliases
+
+
+def _aliases_filter(identities: typing.Iterable[domain.Identity]):
+    """
+    Условие поиска алиасов по идентификаторам, использующее уникальный индекс
+    (channel, external_id)
+    :param identities:
+    :return:
+    """
+    by_channel = {}
+    for identity_ in identities:
+        by_channel.setdefault(identity_.channel, []).append(
+            identity_.external_id
+        )
+    return or_(*(
+        and_(
+            CustomerAlias.channel == channel,
+            CustomerAlias.external_id.in_(external_ids)
+        )
+        for channel, external_ids in by_channel.items()
+    ))
+
+
 class CustomerRepository(BaseRepository[domain.Customer]):
     """
     Репозиторий для работы с клиентами
     """
+    model_class = Customer
+
+    def __init__(
+            self,
+            session_constructor: typing.Callable[[], Session] = ScopedAppSession,
+            identity_index: identity.IdentityIndex = None
+    ) -> None:
+        """
+        :param session_constructor: Фабрика сессий бд
+        :param identity_index: Индекс известных идентификаторов клиентов, по
+          умолчанию используется индекс процесса
+        """
+        super().__init__(session_constructor)
+        self.identity_index = identity_index or identity.index
 
     async def get_by_phone(self, phone_number: str) -> domain.Customer:
         """
@@ -206,31 +613,763 @@ class CustomerRepository(BaseRepository[domain.Customer]):
         """
         session = self.session_constructor()
         query = session.query(Customer).filter(
-            Customer.phone_number == phone_number
+            Customer.phone_number == identity.normalize_phone(phone_number)
         )
         return await fetch_results(query, 'first')
 
+    async def get_by_phones(
+            self, phone_numbers: typing.Iterable[str]
+    ) -> typing.Dict[str, Customer]:
+        """
+        Возвращает клиентов по номерам телефонов одним запросом
+        :param phone_numbers:
+        :return: Клиенты по номерам телефонов, ненайденных номеров в нем нет
+        """
+        query = self.session_constructor().query(Customer).filter(
+            Customer.phone_number.in_(list(phone_numbers))
+        ).order_by(Customer.id.desc())
+        return {
+            customer.phone_number: customer
+            for customer in await fetch_results(query)
+        }
+
+    async def resolve(
+            self, identities: typing.Iterable[domain.Identity],
+            use_index: bool = True
+    ) -> typing.Dict[domain.Identity, Customer]:
+        """
+        Находит клиентов по идентификаторам: номера телефонов ищутся по индексу
+        номеров клиентов, остальные идентификаторы -- по индексу алиасов, т.е.
+        не больше одного запроса на каждый вид идентификаторов. Точно
+        неизвестные идентификаторы отсекаются индексом известных
+        идентификаторов без запроса
+        :param identities:
+        :param use_index: Использовать ли индекс известных идентификаторов
+        :return: Клиенты по идентификаторам, ненайденных идентификаторов в нем
+          нет
+        """
+        phones, aliases = _possible_identities(
+            self.identity_index, identities, use_index
+        )
+        session = self.session_constructor()  # type: Session
+        customers = {}
+        if phones:
+            query = session.query(Customer).filter(
+                Customer.phone_number.in_(phones)
+            )
+            for customer in await fetch_results(query):
+                customers[domain.Identity.phone(customer.phone_number)] = (
+                    customer
+                )
+        if aliases:
+            query = session.query(CustomerAlias).options(
+                joinedload(CustomerAlias.customer)
+            ).filter(_aliases_filter(aliases))
+            for alias in await fetch_results(query):
+                customers[alias.identity] = alias.customer
+        for identity_ in customers:
+            self.identity_index.add(identity_)
+        return customers
+
+    async def add_alias(self, customer: Customer,
+                        identity_: domain.Identity):
+        """
+        Привязывает к клиенту идентификатор в канале
+        :param customer:
+        :param identity_:
+        :return:
+        :raises IdentityConflict: Если идентификатор уже привязан к клиенту
+        """
+        session = self.session_constructor()  # type: Session
+        session.add(CustomerAlias(
+            customer=customer, channel=identity_.channel,
+            external_id=identity_.external_id
+        ))
+        try:
+            await perform_commit(session)
+        except IntegrityError as e:
+            session.rollback()
+            raise IdentityConflict() from e
+        self.identity_index.add(identity_)
+
+    def _known_identities(self) -> typing.Iterator[domain.Identity]:
+        with engine().connect() as connection:
+            phones = connection.execution_options(stream_results=True).execute(
+                sqlalchemy.select([Customer.phone_number]).where(
+                    Customer.phone_number.isnot(None)
+                )
+            )
+            for phone_number, in phones:
+                yield domain.Identity.phone(phone_number)
+            aliases = connection.execution_options(stream_results=True).execute(
+                sqlalchemy.select(
+                    [CustomerAlias.channel, CustomerAlias.external_id]
+                )
+            )
+            for channel, external_id in aliases:
+                yield domain.Identity(channel, external_id)
+
+    async def load_identity_index(self):
+        """
+        Загружает индекс известных идентификаторов из бд. Индекс строится в
+        пуле потоков для работы с бд
+        :return:
+        """
+        bloom = await asyncio.get_event_loop().run_in_executor(
+            executor, lambda: self.identity_index.build(
+                self._known_identities()
+            )
+        )
+        self.identity_index.install(bloom)
+
 
 class DialogRepository(BaseRepository[domain.Dialog]):
     """
     Репозиторий для работы с диалогами. базовая реализация взаимодействует с бд
     посредством sqlalchemy
     """
+    model_class = Dialog
+
+    def __init__(
+            self,
+            session_constructor: typing.Callable[[], Session] = ScopedAppSession,
+            archive: Archive = None,
+            identity_index: identity.IdentityIndex = None,
+            search_index: 'SearchIndex' = None
+    ) -> None:
+        """
+        :param session_constructor: Фабрика сессий бд
+        :param archive: Архив сообщений, по умолчанию используется каталог
+          :data:`~oneweb_helpdesk_chat.config.ARCHIVE_DIR`
+        :param identity_index: Индекс известных идентификаторов клиентов, по
+          умолчанию используется индекс процесса
+        :param search_index: Поисковый индекс, в который добавляются
+          сообщения, восстановленные из архива
+        """
+        super().__init__(session_constructor)
+        self.archive = archive or Archive()
+        self.identity_index = identity_index or identity.index
+        self.search_index = search_index
+
+    async def close(self, dialog: Dialog):
+        """
+        Закрывает диалог
+        :param dialog:
+        :return:
+        """
+        dialog.close()
+        await perform_commit(self.session_constructor())
+
+    async def close_inactive(
+            self, older_than: datetime.datetime, batch_size: int = 1000
+    ) -> typing.List[int]:
+        """
+        Закрывает диалоги, в которых не было сообщений с момента older_than
+        :param older_than: Граница времени последнего сообщения
+        :param batch_size: Максимальное количество диалогов за один вызов
+        :return: Идентификаторы закрытых диалогов
+        """
+        return await tracer.run_in_executor(
+            executor, "db.close_inactive",
+            querylog.bind_origin(self._close_inactive), older_than, batch_size
+        )
+
+    def _close_inactive(self, older_than: datetime.datetime,
+                        batch_size: int) -> typing.List[int]:
+        session = self.session_constructor()  # type: Session
+        condition = and_(
+            Dialog.state != domain.DialogState.CLOSED,
+            Dialog.last_message_at < older_than
+        )
+        dialog_ids = [
+            dialog_id for dialog_id, in
+            session.query(Dialog.id).filter(condition).limit(batch_size)
+        ]
+        if not dialog_ids:
+            return []
+        # условие проверяется повторно: в диалог могло прийти сообщение между
+        # выборкой и обновлением. Такой диалог останется открытым, но будет
+        # вытеснен из памяти вместе с закрытыми, что безопасно
+        try:
+            session.query(Dialog).filter(
+                Dialog.id.in_(dialog_ids), condition
+            ).update({
+                Dialog.state: domain.DialogState.CLOSED,
+                Dialog.closed_at: datetime.datetime.now(),
+            }, synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return dialog_ids
+
+    async def get_history(
+            self, dialog: Dialog, limit: int = 50, before_id: int = None
+    ) -> typing.List[domain.Message]:
+        """
+        Возвращает страницу истории сообщений диалога, начиная с самых свежих.
+        Если в бд сообщений меньше, чем limit, то страница дополняется
+        сообщениями из архива, поэтому для вызывающего кода история выглядит
+        непрерывной
+        :param dialog: Диалог
+        :param limit: Размер страницы
+        :param before_id: Вернуть сообщения с идентификатором меньше указанного
+        :return:
+        """
+        session = self.session_constructor()  # type: Session
+        query = session.query(Message).filter(Message.dialog_id == dialog.id)
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        query = query.order_by(Message.id.desc()).limit(limit)
+        messages = await fetch_results(query)  # type: list
+
+        if len(messages) < limit and dialog.archived_messages_count:
+            if messages:
+                before_id = messages[-1].id
+            records = await asyncio.get_event_loop().run_in_executor(
+                executor, self.archive.read_last, dialog.id,
+                limit - len(messages), before_id
+            )
+            messages.extend(
+                record_to_message(record, dialog) for record in records
+            )
+        return messages
+
+    async def get_channel(
+            self, dialog_id: int
+    ) -> typing.Optional[domain.Channel]:
+        """
+        Канал последнего сообщения диалога, в него отправляются ответы
+        клиенту. Если все сообщения диалога перенесены в архив, то канал
+        берется из последнего заархивированного сообщения
+        :param dialog_id:
+        :return: None, если в диалоге нет сообщений
+        """
+        query = self.session_constructor().query(Message.channel).filter(
+            Message.dialog_id == dialog_id
+        ).order_by(Message.id.desc()).limit(1)
+        rows = await fetch_results(query)
+        if rows:
+            return rows[0].channel
+        records = await asyncio.get_event_loop().run_in_executor(
+            executor, self.archive.read_last, dialog_id, 1
+        )
+        return domain.Channel(records[0]["channel"]) if records else None
+
+    async def archive_dialogs(
+            self, older_than: datetime.datetime, batch_size: int = 100
+    ) -> int:
+        """
+        Переносит в архив сообщения диалогов, в которых не было сообщений с
+        момента older_than. Сообщения читаются из бд курсором и пишутся в
+        архив потоково, поэтому размер диалога не влияет на потребление памяти
+        :param older_than: Граница времени последнего сообщения
+        :param batch_size: Максимальное количество диалогов за один вызов
+        :return: Количество заархивированных диалогов, без диалогов, которые
+          в это время архивирует другой процесс
+        """
+        session = self.session_constructor()  # type: Session
+        query = session.query(Dialog.id).filter(
+            *self._archive_criteria(older_than)
+        ).limit(batch_size)
+        dialog_ids = [dialog_id for dialog_id, in await fetch_results(query)]
+        archived = 0
+        for dialog_id in dialog_ids:
+            message_ids = await asyncio.get_event_loop().run_in_executor(
+                executor, self._archive_dialog, dialog_id, older_than
+            )
+            if message_ids is None:
+                continue
+            archived += 1
+            if message_ids and self.search_index is not None:
+                await self.search_index.remove(message_ids)
+        return archived
+
+    @staticmethod
+    def _archive_criteria(older_than: datetime.datetime):
+        return (
+            Dialog.last_message_at < older_than,
+            or_(
+                Dialog.archived_at.is_(None),
+                Dialog.last_message_at > Dialog.archived_at
+            )
+        )
+
+    def _archive_dialog(
+            self, dialog_id: int, older_than: datetime.datetime,
+            chunk_size: int = 1000
+    ) -> typing.Optional[typing.List[int]]:
+        """
+        Синхронная часть архивации одного диалога, выполняется в пуле потоков.
+        Строка диалога блокируется до конца архивации(``FOR UPDATE SKIP
+        LOCKED``), и условие отбора проверяется повторно, поэтому диалог,
+        который архивирует другой процесс или который уже заархивирован
+        после выборки, пропускается. Сообщения удаляются из бд только после
+        того, как архив записан на диск, при ошибке удаления архив
+        откатывается. Удаляются ровно записанные в архив сообщения:
+        сообщение, зафиксированное во время архивации, остается в бд до
+        следующей архивации
+        :param dialog_id:
+        :param older_than: Граница времени последнего сообщения
+        :param chunk_size: Количество идентификаторов в одном запросе удаления
+        :return: Идентификаторы перенесенных сообщений, None если диалог
+          пропущен
+        """
+        session = self.session_constructor()  # type: Session
+        locked = session.query(Dialog.id).filter(
+            Dialog.id == dialog_id, *self._archive_criteria(older_than)
+        ).with_for_update(skip_locked=True).first()
+        if locked is None:
+            session.rollback()
+            return None
+        archived_ids = []
+
+        def track(archived_rows):
+            for row in archived_rows:
+                archived_ids.append(row.id)
+                yield row
+
+        rows = session.query(
+            Message.id, Message.user_id, Message.channel, Message.text,
+            Message.created_at, Message.seq, Message.attachment_sha256,
+            Message.attachment_type, Message.attachment_size,
+            Message.attachment_name
+        ).filter(Message.dialog_id == dialog_id).order_by(
+            Message.id
+        ).yield_per(1000)
+
+        archive_size = self.archive.size(dialog_id)
+        count, last_id = self.archive.append(dialog_id, track(rows))
+        try:
+            session.query(Dialog).filter(Dialog.id == dialog_id).update({
+                Dialog.archived_messages_count:
+                    Dialog.archived_messages_count + count,
+                Dialog.archived_at: datetime.datetime.now(),
+                # ссылка на последнее сообщение сохраняется, если оно пришло
+                # после выборки и осталось в бд
+                Dialog.last_message_id: sqlalchemy.case(
+                    [(Dialog.last_message_id > (last_id or 0),
+                      Dialog.last_message_id)],
+                    else_=None
+                ),
+            }, synchronize_session=False)
+            for start in range(0, len(archived_ids), chunk_size):
+                session.query(Message).filter(
+                    Message.dialog_id == dialog_id,
+                    Message.id.in_(archived_ids[start:start + chunk_size])
+                ).delete(synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            self.archive.truncate(dialog_id, archive_size)
+            raise
+        return archived_ids
+
+    async def rehydrate(self, dialog: Dialog) -> int:
+        """
+        Возвращает заархивированные сообщения диалога обратно в бд и удаляет
+        архив. Восстановленные сообщения снова добавляются в поисковый индекс
+        :param dialog: Диалог
+        :return: Количество восстановленных сообщений
+        """
+        count = await asyncio.get_event_loop().run_in_executor(
+            executor, self._rehydrate_dialog, dialog.id
+        )
+        set_committed_value(dialog, "archived_messages_count", 0)
+        set_committed_value(dialog, "archived_at", None)
+        if count and self.search_index is not None:
+            await self.search_index.add_dialog(dialog.id)
+        return count
+
+    def _rehydrate_dialog(self, dialog_id: int, chunk_size: int = 1000) -> int:
+        session = self.session_constructor()  # type: Session
+        count, chunk = 0, []
+        try:
+            for record in self.archive.read(dialog_id):
+                message = record_to_message(record, None)
+                chunk.append({
+                    "id": message.id,
+                    "user_id": message.user_id,
+                    "channel": message.channel,
+                    "dialog_id": dialog_id,
+                    "text": message.text,
+                    "created_at": message.created_at,
+                    "seq": message.seq,
+                    "attachment_sha256": message.attachment_sha256,
+                    "attachment_type": message.attachment_type,
+                    "attachment_size": message.attachment_size,
+                    "attachment_name": message.attachment_name,
+                })
+                if len(chunk) == chunk_size:
+                    session.execute(Message.__table__.insert(), chunk)
+                    count, chunk = count + len(chunk), []
+            if chunk:
+                session.execute(Message.__table__.insert(), chunk)
+                count += len(chunk)
+            session.query(Dialog).filter(Dialog.id == dialog_id).update({
+                Dialog.archived_messages_count: 0,
+                Dialog.archived_at: None,
+            }, synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.archive.remove(dialog_id)
+        return count
+
+    async def get_messages_since(
+            self, dialog_id: int, seq: int, limit: int
+    ) -> typing.List[Message]:
+        """
+        Возвращает сообщения диалога с порядковым номером больше указанного.
+        Используется для досылки сообщений после переподключения клиента
+        :param dialog_id: Идентификатор диалога
+        :param seq: Последний полученный клиентом порядковый номер
+        :param limit: Максимальное количество сообщений
+        :return: Сообщения в порядке возрастания порядкового номера
+        """
+        query = self.session_constructor().query(Message).options(
+            joinedload(Message.dialog).joinedload(Dialog.customer)
+        ).filter(
+            Message.dialog_id == dialog_id, Message.seq > seq
+        ).order_by(Message.seq).limit(limit)
+        return await fetch_results(query)
+
+    async def get_inbox(
+            self, user_id: int, limit: int = 50,
+            before: typing.Tuple[datetime.datetime, int] = None,
+            assigned_user_id: int = None, unassigned: bool = False,
+            closed: bool = False
+    ) -> typing.List[typing.Tuple[Dialog, int]]:
+        """
+        Возвращает страницу списка диалогов, отсортированного по времени
+        последнего сообщения(сначала свежие), вместе с количеством
+        непрочитанных пользователем сообщений. Используется постраничная
+        навигация по ключу, поэтому стоимость запроса зависит только от размера
+        страницы, но не от объема истории
+        :param user_id: Пользователь, для которого считаются непрочитанные
+        :param limit: Размер страницы
+        :param before: Ключ последнего диалога предыдущей страницы: пара из
+          времени последнего сообщения и идентификатора диалога
+        :param assigned_user_id: Если указан, то будут возвращены только
+          диалоги, назначенные на этого пользователя
+        :param unassigned: Вернуть только диалоги без ответственного
+        :param closed: Вернуть закрытые диалоги вместо незакрытых
+        :return: Список пар (диалог, количество непрочитанных)
+        """
+        session = self.session_constructor()  # type: Session
+        query = session.query(Dialog, DialogReadState).outerjoin(
+            DialogReadState, and_(
+                DialogReadState.dialog_id == Dialog.id,
+                DialogReadState.user_id == user_id
+            )
+        ).options(
+            joinedload(Dialog.customer),
+            joinedload(Dialog.assigned_user),
+            joinedload(Dialog.last_message),
+        ).filter(Dialog.last_message_at.isnot(None))
+        if closed:
+            query = query.filter(Dialog.state == domain.DialogState.CLOSED)
+        else:
+            query = query.filter(Dialog.state != domain.DialogState.CLOSED)
+
+        if assigned_user_id is not None:
+            query = query.filter(Dialog.assigned_user_id == assigned_user_id)
+        elif unassigned:
+            query = query.filter(Dialog.assigned_user_id.is_(None))
+
+        if before is not None:
+            before_at, before_id = before
+            query = query.filter(or_(
+                Dialog.last_message_at < before_at,
+                and_(
+                    Dialog.last_message_at == before_at,
+                    Dialog.id < before_id
+                )
+            ))
+
+        query = query.order_by(
+            Dialog.last_message_at.desc(), Dialog.id.desc()
+        ).limit(limit)
+
+        rows = await fetch_results(query)
+        return [
+            (dialog, dialog.unread_count(read_state))
+            for dialog, read_state in rows
+        ]
+
+    async def mark_read(self, dialog: Dialog, user_id: int):
+        """
+        Помечает все сообщения диалога как прочитанные пользователем
+        :param dialog: Диалог
+        :param user_id: Идентификатор пользователя
+        :return:
+        """
+        session = self.session_constructor()  # type: Session
+        session.merge(DialogReadState(
+            dialog_id=dialog.id,
+            user_id=user_id,
+            read_count=dialog.incoming_messages_count,
+            last_read_message_id=dialog.last_message_id
+        ))
+        await perform_commit(session)
+
+    async def mark_read_many(
+            self, receipts: typing.Iterable[typing.Tuple[int, int]]
+    ):
+        """
+        Помечает диалоги прочитанными пользователями пачкой: счетчики
+        диалогов и существующие состояния прочтения выбираются двумя
+        запросами, а все состояния записываются одним коммитом
+        :param receipts: Пары (идентификатор диалога, идентификатор
+          пользователя)
+        :return:
+        """
+        receipts = set(receipts)
+        if not receipts:
+            return
+        await tracer.run_in_executor(
+            executor, "db.mark_read_many",
+            querylog.bind_origin(self._mark_read_many), receipts,
+            attributes={"db.receipts": len(receipts)}
+        )
+
+    def _mark_read_many(self, receipts: typing.Set[typing.Tuple[int, int]]):
+        session = self.session_constructor()  # type: Session
+        dialog_ids = {dialog_id for dialog_id, _ in receipts}
+        user_ids = {user_id for _, user_id in receipts}
+        try:
+            counts = {
+                dialog_id: (read_count, last_message_id)
+                for dialog_id, read_count, last_message_id in session.query(
+                    Dialog.id, Dialog.incoming_messages_count,
+                    Dialog.last_message_id
+                ).filter(Dialog.id.in_(dialog_ids))
+            }
+            states = {
+                (state.dialog_id, state.user_id): state
+                for state in session.query(DialogReadState).filter(
+                    DialogReadState.dialog_id.in_(dialog_ids),
+                    DialogReadState.user_id.in_(user_ids)
+                )
+            }
+            for key in receipts:
+                if key[0] not in counts:
+                    continue
+                state = states.get(key)
+                if state is None:
+                    state = DialogReadState(dialog_id=key[0], user_id=key[1])
+                    session.add(state)
+                state.read_count, state.last_read_message_id = counts[key[0]]
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    async def transfer(
+            self, dialog: Dialog, to_user: typing.Optional[User],
+            changed_by: int, expected_user_id: typing.Optional[int] = _ANY_USER
+    ) -> domain.DialogAssignment:
+        """
+        Передает диалог другому пользователю. Смена пользователя выполняется
+        одним условным обновлением по текущему значению в бд и записывается в
+        журнал назначений тем же коммитом, поэтому из одновременных передач
+        одного диалога проходит только одна
+        :param dialog: Диалог
+        :param to_user: Новый пользователь, None -- снять привязку
+        :param changed_by: Идентификатор пользователя, передающего диалог
+        :param expected_user_id: Если указан, то диалог передается, только
+          если сейчас он привязан к этому пользователю(None -- ни к кому)
+        :return: Запись журнала назначений
+        :raises AssignmentConflict:
+        """
+        assignment = await tracer.run_in_executor(
+            executor, "db.transfer", querylog.bind_origin(self._transfer),
+            dialog.id, getattr(to_user, "id", None), changed_by,
+            expected_user_id
+        )
+        set_committed_value(dialog, "assigned_user_id", assignment.to_user_id)
+        set_committed_value(dialog, "assigned_user", to_user)
+        return assignment
+
+    def _transfer(self, dialog_id: int, to_user_id: typing.Optional[int],
+                  changed_by: int,
+                  expected_user_id) -> domain.DialogAssignment:
+        session = self.session_constructor()  # type: Session
+        not_closed = Dialog.state != domain.DialogState.CLOSED
+        try:
+            current = session.query(Dialog.assigned_user_id).filter(
+                Dialog.id == dialog_id, not_closed
+            ).first()
+            if current is None or expected_user_id not in (
+                    _ANY_USER, current[0]
+            ):
+                raise AssignmentConflict()
+            from_user_id = current[0]
+            # условие по прочитанному значению не дает перезаписать
+            # передачу, закоммиченную между выборкой и обновлением
+            updated = session.query(Dialog).filter(
+                Dialog.id == dialog_id, not_closed,
+                Dialog.assigned_user_id.is_(None) if from_user_id is None
+                else Dialog.assigned_user_id == from_user_id
+            ).update(
+                {Dialog.assigned_user_id: to_user_id},
+                synchronize_session=False
+            )
+            if not updated:
+                raise AssignmentConflict()
+            created_at = datetime.datetime.now()
+            record = DialogAssignment(
+                dialog_id=dialog_id, from_user_id=from_user_id,
+                to_user_id=to_user_id, changed_by_user_id=changed_by,
+                created_at=created_at
+            )
+            session.add(record)
+            session.flush()
+            assignment = domain.DialogAssignment(
+                record.id, dialog_id, from_user_id, to_user_id, changed_by,
+                created_at
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return assignment
+
+    async def get_assignments(
+            self, dialog_id: int
+    ) -> typing.List[domain.DialogAssignment]:
+        """
+        Журнал назначений диалога от старых записей к новым
+        :param dialog_id:
+        :return:
+        """
+        query = self.session_constructor().query(DialogAssignment).filter(
+            DialogAssignment.dialog_id == dialog_id
+        ).order_by(DialogAssignment.id)
+        return await fetch_results(query)
 
     async def get_by_phone(self, phone_number: str) -> domain.Dialog:
         """
-        Возвращает диалог по номеру телефона кастомера
+        Возвращает незакрытый диалог по номеру телефона кастомера
         :param phone_number: Номер телефона для поиска диалога.
         :return:
         """
-        # todo: добавить форматирование номера телефона при помощи google phone
-        #  library
         session = self.session_constructor()  # type: Session
         query = session.query(Dialog).join(Customer).filter(
-            Customer.phone_number == phone_number
+            Customer.phone_number == identity.normalize_phone(phone_number),
+            Dialog.state != domain.DialogState.CLOSED
         )
         return await fetch_results(query, 'first')
 
+    async def get_by_phones(
+            self, phone_numbers: typing.Iterable[str]
+    ) -> typing.Dict[str, Dialog]:
+        """
+        Возвращает незакрытые диалоги по номерам телефонов кастомеров одним
+        запросом. Если у номера несколько диалогов, то возвращается первый из
+        них
+        :param phone_numbers:
+        :return: Диалоги по номерам телефонов, ненайденных номеров в нем нет
+        """
+        session = self.session_constructor()  # type: Session
+        query = session.query(Dialog).join(Customer).options(
+            contains_eager(Dialog.customer)
+        ).filter(
+            Customer.phone_number.in_(list(phone_numbers)),
+            Dialog.state != domain.DialogState.CLOSED
+        ).order_by(Dialog.id.desc())
+        return {
+            dialog.customer.phone_number: dialog
+            for dialog in await fetch_results(query)
+        }
+
+    async def get_by_identities(
+            self, identities: typing.Iterable[domain.Identity],
+            use_index: bool = True
+    ) -> typing.Dict[domain.Identity, Dialog]:
+        """
+        Возвращает незакрытые диалоги клиентов по их идентификаторам, не
+        больше одного запроса на каждый вид идентификаторов(см.
+        :meth:`CustomerRepository.resolve`). Если у клиента несколько
+        диалогов, то возвращается первый из них
+        :param identities:
+        :param use_index: Использовать ли индекс известных идентификаторов
+        :return: Диалоги по идентификаторам, ненайденных идентификаторов в нем
+          нет
+        """
+        phones, aliases = _possible_identities(
+            self.identity_index, identities, use_index
+        )
+        session = self.session_constructor()  # type: Session
+        dialogs = {}
+        if phones:
+            query = session.query(Dialog).join(Customer).options(
+                contains_eager(Dialog.customer)
+            ).filter(
+                Customer.phone_number.in_(phones),
+                Dialog.state != domain.DialogState.CLOSED
+            ).order_by(Dialog.id.desc())
+            for dialog in await fetch_results(query):
+                dialogs[domain.Identity.phone(dialog.customer.phone_number)] = (
+                    dialog
+                )
+        if aliases:
+            query = session.query(
+                Dialog, CustomerAlias.channel, CustomerAlias.external_id
+            ).select_from(Dialog).join(Customer).join(CustomerAlias).options(
+                contains_eager(Dialog.customer)
+            ).filter(
+                _aliases_filter(aliases),
+                Dialog.state != domain.DialogState.CLOSED
+            ).order_by(Dialog.id.desc())
+            for dialog, channel, external_id in await fetch_results(query):
+                dialogs[domain.Identity(channel, external_id)] = dialog
+        for identity_ in dialogs:
+            self.identity_index.add(identity_)
+        return dialogs
+
+    async def save_all(self, dialogs: typing.Iterable[Dialog]):
+        """
+        Сохраняет диалоги вместе с новыми клиентами и сообщениями одним
+        коммитом. В postgres идентификаторы новых объектов заранее выбираются
+        из последовательностей одним запросом на таблицу, поэтому вставка
+        строк каждой таблицы выполняется одним запросом, а не запросом на
+        строку. Идентификаторы новых клиентов добавляются в индекс известных
+        идентификаторов
+        :param dialogs:
+        :return:
+        :raises IdentityConflict: Если клиент с идентификатором одного из
+          новых клиентов уже сохранен
+        """
+        session = self.session_constructor()  # type: Session
+        session.add_all(dialogs)
+        new_identities = [
+            identity_ for obj in session.new if isinstance(obj, Customer)
+            for identity_ in obj.identities()
+        ]
+        try:
+            await tracer.run_in_executor(
+                executor, "db.save_all", querylog.bind_origin(self._save_all),
+                session,
+                attributes={"db.new_objects": len(session.new)}
+            )
+        except IntegrityError as e:
+            if new_identities:
+                raise IdentityConflict() from e
+            raise
+        for identity_ in new_identities:
+            self.identity_index.add(identity_)
+
+    def _save_all(self, session: Session):
+        try:
+            if session.bind.dialect.name == "postgresql":
+                reserve_ids(session, session.new)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
 
 class UserRepository(BaseRepository[User]):
     """
@@ -247,3 +1386,20 @@ class UserRepository(BaseRepository[User]):
         return await self.get_one_by_field('login', login)
 
 
+class CannedResponseRepository(BaseRepository[CannedResponse]):
+    """
+    Репозиторий шаблонов ответов
+    """
+    model_class = CannedResponse
+
+    async def get_all(self) -> typing.List[CannedResponse]:
+        """
+        Возвращает шаблоны всех команд. Шаблонов немного, они целиком
+        загружаются в память(см.
+        :class:`~oneweb_helpdesk_chat.canned.CannedResponses`)
+        :return:
+        """
+        session = self.session_constructor()  # type: Session
+        return await fetch_results(session.query(CannedResponse))
+
+
@@ -23,14 +23,70 @@ class Channel(Enum):
     VIBER = "VIBER"
 
 
+class DialogState(Enum):
+    """
+    Состояние диалога:
+      * OPEN: последнее сообщение от клиента, ждет ответа техподдержки
+      * PENDING: техподдержка ответила, ждем ответа клиента
+      * CLOSED: обращение закрыто, новое сообщение клиента откроет новый
+        диалог
+    """
+    OPEN = "open"
+    PENDING = "pending"
+    CLOSED = "closed"
+
+
+class Identity(typing.NamedTuple):
+    """
+    Идентификатор клиента во внешнем сервисе. Номер телефона -- общий для
+    всех каналов идентификатор, для него используется псевдоканал
+    :data:`PHONE`, остальные идентификаторы привязаны к своему каналу
+
+    :ivar str channel: Канал или :data:`PHONE`
+    :ivar str external_id: Идентификатор клиента в канале или номер телефона
+      в формате E.164
+    """
+    channel: str
+    external_id: str
+
+    @classmethod
+    def phone(cls, phone_number: str) -> "Identity":
+        return cls(PHONE, phone_number)
+
+    @property
+    def is_phone(self) -> bool:
+        return self.channel == PHONE
+
+
+# псевдоканал для номеров телефонов
+PHONE = "phone"
+
+
+class Attachment(typing.NamedTuple):
+    """
+    Вложение сообщения: изображение, голосовое сообщение, документ. Само
+    содержимое хранится в :class:`~.media.MediaStore` по хешу, поэтому
+    одинаковые файлы из разных сообщений хранятся один раз
+
+    :ivar str sha256: Хеш содержимого в hex
+    :ivar str content_type: MIME-тип без параметров
+    :ivar int size: Размер в байтах
+    :ivar str filename: Исходное имя файла, если канал его передает
+    """
+    sha256: str
+    content_type: str
+    size: int
+    filename: typing.Optional[str] = None
+
+
 class Customer:
     """
     Клиент. Тот, кто обращается к нам
     :type dialogs: list(Dialog)
-    :ivar str phone_number: Номер телефона клиента, по нему мы связываем
-      нескольких клиентов, пришедших из разных каналов.
-      todo: некоторые каналы могут не иметь номер телефона, тогда нам нужно еще добавить какие-то другие
-        алиасы, причем по нескольку, но это довольно сложная задача
+    :ivar str phone_number: Номер телефона клиента в формате E.164, по нему мы
+      связываем нескольких клиентов, пришедших из разных каналов. Клиенты из
+      каналов без номера телефона находятся по алиасам(см. :class:`Identity`),
+      у клиента их может быть несколько
     """
 
     def __init__(self, ident: int = None, name: str = None,
@@ -49,17 +105,40 @@ class Customer:
 class User:
     """
     Пользователь, сотрудник техподдержки
+
+    :ivar str team: Команда, в которой работает сотрудник, от нее зависят
+      доступные ему шаблоны ответов(см. :class:`CannedResponse`)
     """
 
     def __init__(self, ident: int = None, name: str = None, login: str = None,
-                 password: str = None, dialogs: typing.List['Dialog'] = None
-                 ) -> None:
+                 password: str = None, dialogs: typing.List['Dialog'] = None,
+                 team: str = None) -> None:
         super().__init__()
         self.id = ident
         self.name = name
         self.login = login
         self.password = password
         self.dialogs = dialogs
+        self.team = team
+
+
+class CannedResponse:
+    """
+    Шаблон ответа, который сотрудник тп вставляет в диалог по короткому
+    имени(см. :mod:`oneweb_helpdesk_chat.canned`)
+
+    :ivar str team: Команда, которой доступен шаблон, None -- всем командам
+    :ivar str shortcut: Короткое имя, уникальное в пределах команды
+    :ivar str text: Текст шаблона с подстановками
+    """
+
+    def __init__(self, ident: int = None, team: str = None,
+                 shortcut: str = None, text: str = None) -> None:
+        super().__init__()
+        self.id = ident
+        self.team = team
+        self.shortcut = shortcut
+        self.text = text
 
 
 class Dialog:
@@ -67,11 +146,31 @@ class Dialog:
     Диалог хранит ссылки на сообщения, отправленные каждой из сторон. Диалог
     всегда привязан к одному клиенту. Также может быть привязан или не привязан
     к отдельному сотрутнику тех. поддержки.
-    todo: Описать, когда привязка к сотруднику т.п. появляется, а когда исчезает
-    todo: В будущем, каждый диалог будет отображать отдельное обращение клиента
-      в тех. поддержку: у диалога будет несколько доступных состояний и когда
-      проблема клиента решена, диалог будет помечаться как "закрытый", при
-      последующем обращении будет создан новый диалог.
+
+    Новый диалог ни к кому не привязан. Сотрудник назначается и меняется
+    только передачей диалога(см. ``DialogRepository.transfer``), передача
+    на null снимает привязку. Каждая передача записывается в журнал
+    назначений(:class:`DialogAssignment`). Закрытый диалог передать нельзя
+
+    Каждый диалог отображает отдельное обращение клиента в тех. поддержку(см.
+    :class:`DialogState`). Когда проблема клиента решена или в диалоге давно
+    не было сообщений, диалог закрывается, при последующем обращении будет
+    создан новый диалог. Закрытые диалоги не держатся в памяти процесса и не
+    участвуют в поиске диалога по клиенту
+
+
+    :ivar Message last_message: Последнее сообщение в диалоге
+    :ivar datetime last_message_at: Время последнего сообщения, по нему
+      сортируется список диалогов
+    :ivar int incoming_messages_count: Количество сообщений от клиента за все
+      время. Вместе с :class:`DialogReadState` позволяет посчитать количество
+      непрочитанных сообщений без агрегации по всем сообщениям диалога
+    :ivar int last_seq: Порядковый номер последнего сообщения диалога
+    :ivar int archived_messages_count: Количество сообщений, перенесенных в
+      архив
+    :ivar datetime archived_at: Время последней архивации диалога
+    :ivar DialogState state: Состояние диалога
+    :ivar datetime closed_at: Время закрытия диалога
     """
 
     def __init__(self, ident: int = None, customer: Customer = None,
@@ -85,6 +184,113 @@ class Dialog:
         self.customer = customer
         self.assigned_user = assigned_user
         self.messages = messages
+        self.last_message = None
+        self.last_message_at = None
+        self.incoming_messages_count = 0
+        self.last_seq = 0
+        self.archived_messages_count = 0
+        self.archived_at = None
+        self.state = DialogState.OPEN
+        self.closed_at = None
+
+    @property
+    def is_closed(self) -> bool:
+        return self.state == DialogState.CLOSED
+
+    def close(self):
+        """
+        Закрывает диалог
+        :return:
+        """
+        if not self.is_closed:
+            self.state = DialogState.CLOSED
+            self.closed_at = datetime.now()
+
+    def add_message(self, message: 'Message'):
+        """
+        Добавляет сообщение в диалог и обновляет сводку по диалогу(последнее
+        сообщение и счетчик входящих сообщений). Сводка обновляется
+        инкрементально, поэтому ее стоимость не зависит от размера истории.
+        Сообщение клиента переводит диалог в состояние OPEN, ответ
+        техподдержки -- в PENDING, в том числе если диалог был закрыт.
+        Хранилище в бд заново назначает порядковый номер и счетчик входящих
+        при сохранении, т.к. диалог может пополняться одновременно из
+        нескольких процессов
+        :param message: Новое сообщение
+        :return:
+        """
+        if message.created_at is None:
+            message.created_at = datetime.now()
+        self.last_seq = (self.last_seq or 0) + 1
+        message.seq = self.last_seq
+        self._attach_message(message)
+        self.last_message = message
+        self.last_message_at = message.created_at
+        self.closed_at = None
+        if message.user_id is None:
+            self.state = DialogState.OPEN
+            self.incoming_messages_count = (
+                (self.incoming_messages_count or 0) + 1
+            )
+        else:
+            self.state = DialogState.PENDING
+
+    def _attach_message(self, message: 'Message'):
+        """
+        Привязывает сообщение к диалогу
+        :param message:
+        :return:
+        """
+        self.messages.append(message)
+        message.dialog = self
+
+    def unread_count(self, read_state: 'DialogReadState' = None) -> int:
+        """
+        Количество непрочитанных пользователем сообщений от клиента
+        :param read_state: Состояние прочтения диалога пользователем, если не
+          указано, то считается, что пользователь не читал диалог
+        :return:
+        """
+        read_count = read_state.read_count if read_state else 0
+        return max((self.incoming_messages_count or 0) - (read_count or 0), 0)
+
+
+class DialogReadState:
+    """
+    Состояние прочтения диалога отдельным пользователем. Хранит количество
+    входящих сообщений диалога на момент последнего прочтения, т.е. счетчик
+    непрочитанных для пользователя -- это разница между
+    :attr:`Dialog.incoming_messages_count` и :attr:`read_count`
+    """
+
+    def __init__(self, dialog_id: int = None, user_id: int = None,
+                 read_count: int = 0, last_read_message_id: int = None
+                 ) -> None:
+        super().__init__()
+        self.dialog_id = dialog_id
+        self.user_id = user_id
+        self.read_count = read_count
+        self.last_read_message_id = last_read_message_id
+
+
+class DialogAssignment:
+    """
+    Запись журнала назначений диалога: кто и кому передал диалог. None в
+    from_user_id или to_user_id означает, что диалог был или стал ни к кому
+    не привязан
+    """
+
+    def __init__(self, ident: int = None, dialog_id: int = None,
+                 from_user_id: int = None, to_user_id: int = None,
+                 changed_by_user_id: int = None,
+                 created_at: datetime = None) -> None:
+        super().__init__()
+        self.id = ident
+        self.dialog_id = dialog_id
+        self.from_user_id = from_user_id
+        self.to_user_id = to_user_id
+        self.changed_by_user_id = changed_by_user_id
+        self.created_at = created_at
 
 
 class Message:
@@ -93,14 +299,47 @@ class Message:
 
     :ivar int user_id: Идентификатор работника тп-отправителя сообщения, если null, значит сообщение было отправлено
       клиентом из указанного диалога
+    :ivar int seq: Порядковый номер сообщения в диалоге, монотонно возрастает
+      без пропусков. По нему клиент запрашивает пропущенные сообщения после
+      переподключения
+    :ivar str text: Текст сообщения или подпись к вложению, у сообщений
+      только с вложением -- пустая строка
     """
+    attachment_sha256 = None
+    attachment_type = None
+    attachment_size = None
+    attachment_name = None
+
     def __init__(self, ident:int = None, channel: Channel = None,
                  text: str = None, created_at: datetime = None,
-                 dialog: Dialog = None) -> None:
+                 dialog: Dialog = None, user_id: int = None,
+                 seq: int = None, attachment: Attachment = None) -> None:
         super().__init__()
         self.id = ident
+        self.user_id = user_id
+        self.seq = seq
         self.channel = channel
         self.text = text
         self.created_at = created_at
         self.dialog = dialog
+        self.attachment = attachment
+
+    @property
+    def attachment(self) -> typing.Optional[Attachment]:
+        """
+        Вложение сообщения. В хранилище поля вложения лежат в отдельных
+        колонках сообщения
+        :return:
+        """
+        if self.attachment_sha256 is None:
+            return None
+        return Attachment(
+            self.attachment_sha256, self.attachment_type,
+            self.attachment_size, self.attachment_name
+        )
+
+    @attachment.setter
+    def attachment(self, attachment: typing.Optional[Attachment]):
+        (self.attachment_sha256, self.attachment_type, self.attachment_size,
+         self.attachment_name) = attachment or (None, None, None, None)
 
@@ -0,0 +1,148 @@
+"""
+Идентификация клиентов. Входящий идентификатор клиента(см.
+:class:`~oneweb_helpdesk_chat.storage.domain.Identity`) находится одним
+запросом по индексу: номер телефона -- по уникальному индексу нормализованных
+номеров в таблице клиентов, идентификаторы каналов без номеров телефонов -- по
+уникальному индексу (channel, external_id) таблицы ``customer_aliases``.
+
+Большая часть идентификаторов, для которых клиента еще нет, отсекается без
+запроса к бд фильтром Блума известных идентификаторов(:class:`IdentityIndex`).
+Фильтр загружается из бд при запуске и пополняется при сохранении новых
+клиентов. Клиент, созданный другим процессом после загрузки фильтра, будет
+принят за нового, но сохранить его не даст уникальный индекс, после чего
+поиск повторяется без фильтра
+"""
+import hashlib
+import math
+import re
+import typing
+
+from oneweb_helpdesk_chat import config
+from .domain import Identity
+
+_PHONE_SEPARATORS_RE = re.compile(r"[\s().\-]")
+
+
+def normalize_phone(phone_number: str,
+                    country_code: str = config.DEFAULT_PHONE_COUNTRY_CODE
+                    ) -> str:
+    """
+    Приводит номер телефона к формату E.164: "+" и от 8 до 15 цифр. Номер
+    без кода страны(10 цифр или 11 цифр, начинающихся с 8, для кода 7)
+    дополняется кодом страны по умолчанию. Если номер не удается разобрать, то
+    он возвращается без разделителей как есть
+    :param phone_number: Номер телефона
+    :param country_code: Код страны по умолчанию
+    :return:
+    """
+    cleaned = _PHONE_SEPARATORS_RE.sub("", str(phone_number))
+    if cleaned.startswith("+"):
+        digits = cleaned[1:]
+    elif cleaned.startswith("00"):
+        digits = cleaned[2:]
+    elif len(cleaned) == 10:
+        digits = country_code + cleaned
+    elif len(cleaned) == 11 and country_code == "7" and cleaned[0] == "8":
+        digits = country_code + cleaned[1:]
+    else:
+        digits = cleaned
+    if not digits.isdigit() or not 8 <= len(digits) <= 15:
+        return cleaned
+    return "+" + digits
+
+
+class BloomFilter:
+    """
+    Фильтр Блума для строковых ключей. Ключ, которого нет в фильтре, точно не
+    добавлялся, ключ, который есть, добавлялся с вероятностью ошибки
+    error_rate при количестве ключей не больше capacity
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        super().__init__()
+        self.size = max(
+            int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64
+        )
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> typing.Iterator[int]:
+        digest = hashlib.blake2b(key.encode("utf8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class IdentityIndex:
+    """
+    Индекс известных идентификаторов клиентов. Пока индекс не загружен,
+    любой идентификатор считается возможно известным
+
+    :ivar bool loaded: Индекс загружен из бд
+    """
+
+    def __init__(self, capacity: int = config.IDENTITY_INDEX_CAPACITY,
+                 error_rate: float = config.IDENTITY_INDEX_ERROR_RATE
+                 ) -> None:
+        super().__init__()
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.loaded = False
+        self.filter = BloomFilter(capacity, error_rate)
+
+    @staticmethod
+    def _key(identity: Identity) -> str:
+        return "{}:{}".format(identity.channel, identity.external_id)
+
+    def might_exist(self, identity: Identity) -> bool:
+        """
+        Проверяет, может ли существовать клиент с указанным идентификатором.
+        Если нет, то искать его в бд не нужно
+        :param identity:
+        :return:
+        """
+        return not self.loaded or self._key(identity) in self.filter
+
+    def add(self, identity: Identity):
+        self.filter.add(self._key(identity))
+
+    def build(self, identities: typing.Iterable[Identity]) -> BloomFilter:
+        """
+        Строит фильтр из всех известных идентификаторов. Построение может
+        выполняться в другом потоке, готовый фильтр устанавливается
+        :meth:`install`
+        :param identities:
+        :return:
+        """
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        for identity in identities:
+            bloom.add(self._key(identity))
+        return bloom
+
+    def install(self, bloom: BloomFilter):
+        """
+        Устанавливает построенный фильтр. Идентификаторы, добавленные во время
+        построения, переносятся в него
+        :param bloom:
+        :return:
+        """
+        merged = (int.from_bytes(bloom.bits, "little")
+                  | int.from_bytes(self.filter.bits, "little"))
+        bloom.bits = bytearray(merged.to_bytes(len(bloom.bits), "little"))
+        self.filter = bloom
+        self.loaded = True
+
+
+# индекс известных идентификаторов клиентов процесса
+index = IdentityIndex()
@@ -0,0 +1,238 @@
+"""
+Хранилище вложений сообщений на локальном диске с адресацией по содержимому.
+Файл вложения называется по sha256 своего содержимого с расширением по
+MIME-типу(ключ вложения, см. :func:`key`), поэтому одинаковые вложения
+хранятся один раз, а записанный файл больше никогда не меняется и может
+кешироваться клиентами бессрочно.
+
+Вложение пишется по фрагментам по мере скачивания у сервиса и целиком в
+памяти не держится: каждый фрагмент хешируется и дописывается во временный
+файл в пуле потоков, после чего временный файл атомарно переименовывается
+в файл вложения. Отдаются вложения через ``sendfile`` с поддержкой
+range-запросов(:class:`aiohttp.web.FileResponse`).
+
+Миниатюры изображений генерируются при первом запросе в пуле процессов:
+декодирование изображения нагружает процессор и не должно занимать ни цикл
+событий, ни GIL. Для генерации нужен пакет Pillow, без него миниатюры
+недоступны
+"""
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import typing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from oneweb_helpdesk_chat import config
+from . import domain
+
+# ключ вложения: sha256 в hex и необязательное расширение
+KEY_RE = re.compile(r"[0-9a-f]{64}(\.[0-9a-z]+)?")
+
+# пул потоков для работы с файлами вложений, отдельный от пула для бд, чтобы
+# запись вложений не задерживала запросы к бд
+io_executor = ThreadPoolExecutor(4)
+
+_thumbnail_executor = None
+
+
+def thumbnail_executor() -> ProcessPoolExecutor:
+    """
+    Пул процессов для генерации миниатюр. Создается при первом обращении,
+    т.е. уже в процессе-воркере, а не в родительском процессе сервера
+    :return:
+    """
+    global _thumbnail_executor
+    if _thumbnail_executor is None:
+        _thumbnail_executor = ProcessPoolExecutor(
+            config.MEDIA_THUMBNAIL_WORKERS
+        )
+    return _thumbnail_executor
+
+
+class MediaTooLarge(ValueError):
+    """
+    Вложение больше :data:`~oneweb_helpdesk_chat.config.MEDIA_MAX_SIZE`
+    """
+
+
+def normalize_content_type(content_type: typing.Optional[str]) -> str:
+    """
+    MIME-тип без параметров: ``audio/ogg; codecs=opus`` -> ``audio/ogg``
+    :param content_type:
+    :return:
+    """
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return content_type or "application/octet-stream"
+
+
+def key(attachment: domain.Attachment) -> str:
+    """
+    Ключ вложения -- имя его файла в хранилище. Расширение нужно, чтобы тип
+    содержимого при отдаче файла определялся без обращения к бд
+    :param attachment:
+    :return:
+    """
+    extension = mimetypes.guess_extension(attachment.content_type) or ""
+    return attachment.sha256 + extension
+
+
+def _render_thumbnail(source: str, target: str, size: int) -> bool:
+    """
+    Генерирует миниатюру изображения в JPEG. Выполняется в пуле процессов
+    :param source: Путь к изображению
+    :param target: Путь к миниатюре
+    :param size: Размер большей стороны миниатюры
+    :return: False, если файл не удалось прочитать как изображение
+    """
+    temporary = "{}.{}.tmp".format(target, os.getpid())
+    try:
+        with Image.open(source) as image:
+            image.thumbnail((size, size))
+            image.convert("RGB").save(temporary, "JPEG", quality=80)
+    except (OSError, Image.DecompressionBombError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        return False
+    os.replace(temporary, target)
+    return True
+
+
+class MediaStore:
+    """
+    Хранилище вложений. Файлы раскладываются по подкаталогам по первым
+    символам хеша, чтобы в одном каталоге не оказалось слишком много файлов
+    """
+
+    def __init__(self, directory: str = config.MEDIA_DIR,
+                 max_size: int = config.MEDIA_MAX_SIZE,
+                 thumbnail_size: int = config.MEDIA_THUMBNAIL_SIZE) -> None:
+        """
+        :param directory: Каталог хранилища
+        :param max_size: Максимальный размер вложения в байтах
+        :param thumbnail_size: Размер большей стороны миниатюр
+        """
+        super().__init__()
+        self.directory = directory
+        self.max_size = max_size
+        self.thumbnail_size = thumbnail_size
+        # генерируемые сейчас миниатюры, одновременные запросы одной
+        # миниатюры ждут одной генерации
+        self._rendering = {}  # type: typing.Dict[str, asyncio.Future]
+
+    def path(self, media_key: str) -> str:
+        """
+        Путь к файлу вложения по его ключу
+        :param media_key:
+        :return:
+        """
+        return os.path.join(
+            self.directory, media_key[:2], media_key[2:4], media_key
+        )
+
+    def thumbnail_path(self, media_key: str) -> str:
+        return os.path.join(
+            self.directory, "thumbnails", media_key[:2],
+            media_key.partition(".")[0] + ".jpg"
+        )
+
+    async def save(self, chunks: typing.AsyncIterable[bytes],
+                   content_type: str = None,
+                   filename: str = None) -> domain.Attachment:
+        """
+        Сохраняет вложение, читая его по фрагментам. Если такое содержимое
+        уже есть в хранилище, то повторно оно не сохраняется
+        :param chunks: Фрагменты содержимого
+        :param content_type: MIME-тип
+        :param filename: Исходное имя файла
+        :return:
+        :raises MediaTooLarge: Если вложение больше max_size, частично
+          записанное содержимое удаляется
+        """
+        loop = asyncio.get_event_loop()
+        temporary = await loop.run_in_executor(io_executor, self._open)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > self.max_size:
+                    raise MediaTooLarge(size)
+                await loop.run_in_executor(
+                    io_executor, self._write, temporary, digest, chunk
+                )
+            attachment = domain.Attachment(
+                digest.hexdigest(), normalize_content_type(content_type),
+                size, filename
+            )
+            await loop.run_in_executor(
+                io_executor, self._commit, temporary,
+                self.path(key(attachment))
+            )
+        except BaseException:
+            temporary.close()
+            if os.path.exists(temporary.name):
+                os.remove(temporary.name)
+            raise
+        return attachment
+
+    def _open(self) -> typing.BinaryIO:
+        # временные файлы лежат в том же каталоге, что и вложения, чтобы
+        # переименование было атомарным
+        directory = os.path.join(self.directory, "tmp")
+        os.makedirs(directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=directory, delete=False)
+
+    @staticmethod
+    def _write(temporary: typing.BinaryIO, digest, chunk: bytes):
+        digest.update(chunk)
+        temporary.write(chunk)
+
+    @staticmethod
+    def _commit(temporary: typing.BinaryIO, path: str):
+        temporary.flush()
+        os.fsync(temporary.fileno())
+        temporary.close()
+        if os.path.exists(path):
+            os.remove(temporary.name)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temporary.name, path)
+
+    async def thumbnail(self, media_key: str) -> typing.Optional[str]:
+        """
+        Путь к миниатюре изображения, миниатюра генерируется при первом
+        запросе
+        :param media_key: Ключ вложения
+        :return: None, если вложение не изображение, его нет в хранилище или
+          Pillow не установлен
+        """
+        content_type, _ = mimetypes.guess_type(media_key)
+        if Image is None or not (content_type or "").startswith("image/"):
+            return None
+        target = self.thumbnail_path(media_key)
+        if os.path.exists(target):
+            return target
+        source = self.path(media_key)
+        if not os.path.exists(source):
+            return None
+
+        rendering = self._rendering.get(target)
+        if rendering is None:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            rendering = asyncio.get_event_loop().run_in_executor(
+                thumbnail_executor(), _render_thumbnail, source, target,
+                self.thumbnail_size
+            )
+            self._rendering[target] = rendering
+            rendering.add_done_callback(
+                lambda _: self._rendering.pop(target, None)
+            )
+        return target if await asyncio.shield(rendering) else None
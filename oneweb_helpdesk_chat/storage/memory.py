@@ -0,0 +1,412 @@
+"""
+Хранилище в памяти процесса. Репозитории этого модуля реализуют тот же
+интерфейс, что и репозитории :mod:`.database`, и повторяют семантику бд:
+идентификаторы выдаются последовательно, номера телефонов и алиасы клиентов
+уникальны(:class:`~.database.IdentityConflict`), поиск диалога клиента
+учитывает только незакрытые диалоги. Вместо индексов бд используются словари.
+
+Хранилище выбирается настройкой
+:data:`~oneweb_helpdesk_chat.config.STORAGE_BACKEND` и предназначено для
+тестов и микробенчмарков, в которых бд не нужна: данные не переживают
+перезапуск процесса и не разделяются между процессами-воркерами
+"""
+import datetime
+import heapq
+import itertools
+import typing
+
+from . import domain, identity
+from .database import (
+    CannedResponse, Customer, CustomerAlias, Dialog, DialogAssignment,
+    DialogReadState, Message, User, CannedResponseRepository,
+    CustomerRepository, DialogRepository, UserRepository, AssignmentConflict,
+    IdentityConflict, _ANY_USER
+)
+
+
+class MemoryStore:
+    """
+    Таблицы и индексы хранилища в памяти, общие для всех репозиториев
+
+    :ivar dict tables: Объекты по классу модели и идентификатору
+    :ivar dict customers_by_identity: Клиенты по номерам телефонов и алиасам
+    :ivar dict open_dialogs: Идентификаторы незакрытых диалогов по
+      идентификатору клиента
+    :ivar dict messages: Сообщения по идентификатору диалога в порядке
+      порядковых номеров
+    :ivar dict read_states: Состояния прочтения по паре (диалог, пользователь)
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.tables = {
+            model: {} for model in (
+                User, Customer, Dialog, Message, CannedResponse,
+                DialogAssignment
+            )
+        }  # type: typing.Dict[type, typing.Dict[int, typing.Any]]
+        self.users_by_login = {}  # type: typing.Dict[str, User]
+        self.customers_by_identity = {
+        }  # type: typing.Dict[domain.Identity, Customer]
+        self.open_dialogs = {}  # type: typing.Dict[int, typing.Set[int]]
+        self.messages = {}  # type: typing.Dict[int, typing.List[Message]]
+        self.read_states = {
+        }  # type: typing.Dict[typing.Tuple[int, int], DialogReadState]
+        self._ids = {model: itertools.count(1) for model in self.tables}
+
+    def _assign_id(self, obj):
+        if obj.id is None:
+            obj.id = next(self._ids[type(obj)])
+        self.tables[type(obj)][obj.id] = obj
+
+    def check_identities(self, customers: typing.Iterable[Customer]):
+        """
+        Проверяет уникальность идентификаторов клиентов, как уникальные
+        индексы бд
+        :param customers:
+        :return:
+        :raises IdentityConflict: Если идентификатор уже принадлежит другому
+          клиенту
+        """
+        for customer in customers:
+            for identity_ in customer.identities():
+                owner = self.customers_by_identity.get(identity_)
+                if owner is not None and owner is not customer:
+                    raise IdentityConflict()
+
+    def add(self, obj):
+        """
+        Сохраняет объект любой модели вместе со связанными объектами
+        :param obj:
+        :return:
+        """
+        if isinstance(obj, Dialog):
+            self.add_dialog(obj)
+        elif isinstance(obj, Customer):
+            self.add_customer(obj)
+        elif isinstance(obj, User):
+            self._assign_id(obj)
+            self.users_by_login[obj.login] = obj
+        elif isinstance(obj, DialogReadState):
+            self.read_states[(obj.dialog_id, obj.user_id)] = obj
+        else:
+            self._assign_id(obj)
+
+    def add_customer(self, customer: Customer):
+        self.check_identities([customer])
+        self._assign_id(customer)
+        for alias in customer.aliases:
+            alias.customer_id = customer.id
+        for identity_ in customer.identities():
+            self.customers_by_identity[identity_] = customer
+
+    def add_dialog(self, dialog: Dialog):
+        if dialog.customer is not None:
+            self.add_customer(dialog.customer)
+            dialog.customer_id = dialog.customer.id
+        if dialog.assigned_user is not None:
+            dialog.assigned_user_id = dialog.assigned_user.id
+        dialog.state = dialog.state or domain.DialogState.OPEN
+        self._assign_id(dialog)
+        # сообщения добавляются в диалог только в конец, поэтому новые --
+        # те, что идут после уже сохраненных
+        stored = self.messages.setdefault(dialog.id, [])
+        for message in dialog.messages[len(stored):]:
+            message.dialog_id = dialog.id
+            self._assign_id(message)
+            stored.append(message)
+        if dialog.last_message is not None:
+            dialog.last_message_id = dialog.last_message.id
+        self.index_dialog(dialog)
+
+    def index_dialog(self, dialog: Dialog):
+        """
+        Обновляет индекс незакрытых диалогов клиента
+        :param dialog:
+        :return:
+        """
+        open_dialogs = self.open_dialogs.setdefault(dialog.customer_id, set())
+        if dialog.is_closed:
+            open_dialogs.discard(dialog.id)
+        else:
+            open_dialogs.add(dialog.id)
+
+    def open_dialog(self, customer: Customer) -> typing.Optional[Dialog]:
+        """
+        Последний незакрытый диалог клиента
+        :param customer:
+        :return:
+        """
+        dialog_ids = self.open_dialogs.get(customer.id)
+        if not dialog_ids:
+            return None
+        return self.tables[Dialog][max(dialog_ids)]
+
+
+# хранилище процесса
+store = MemoryStore()
+
+
+class MemoryRepositoryMixin:
+    """
+    Общие методы репозиториев в памяти
+    """
+
+    def __init__(self, memory_store: MemoryStore = None) -> None:
+        super().__init__()
+        self.store = memory_store or store
+
+    async def save(self, obj):
+        self.store.add(obj)
+
+    async def get_by_id(self, pk: int):
+        try:
+            return self.store.tables[self.model_class].get(int(pk))
+        except (TypeError, ValueError):
+            return None
+
+    async def get_one_by_field(self, field: str, value: typing.Any):
+        for obj in self.store.tables[self.model_class].values():
+            if getattr(obj, field) == value:
+                return obj
+        return None
+
+
+class MemoryUserRepository(MemoryRepositoryMixin, UserRepository):
+    """
+    Репозиторий пользователей в памяти
+    """
+
+    async def get_by_login(self, login: str) -> User:
+        return self.store.users_by_login.get(login)
+
+
+class MemoryCannedResponseRepository(MemoryRepositoryMixin,
+                                     CannedResponseRepository):
+    """
+    Репозиторий шаблонов ответов в памяти
+    """
+
+    async def get_all(self) -> typing.List[CannedResponse]:
+        return list(self.store.tables[CannedResponse].values())
+
+
+class MemoryCustomerRepository(MemoryRepositoryMixin, CustomerRepository):
+    """
+    Репозиторий клиентов в памяти
+    """
+
+    async def get_by_phone(self, phone_number: str) -> Customer:
+        return self.store.customers_by_identity.get(
+            domain.Identity.phone(identity.normalize_phone(phone_number))
+        )
+
+    async def get_by_phones(
+            self, phone_numbers: typing.Iterable[str]
+    ) -> typing.Dict[str, Customer]:
+        customers = {}
+        for phone_number in phone_numbers:
+            customer = self.store.customers_by_identity.get(
+                domain.Identity.phone(phone_number)
+            )
+            if customer is not None:
+                customers[phone_number] = customer
+        return customers
+
+    async def resolve(
+            self, identities: typing.Iterable[domain.Identity],
+            use_index: bool = True
+    ) -> typing.Dict[domain.Identity, Customer]:
+        customers = {}
+        for identity_ in identities:
+            customer = self.store.customers_by_identity.get(identity_)
+            if customer is not None:
+                customers[identity_] = customer
+        return customers
+
+    async def add_alias(self, customer: Customer,
+                        identity_: domain.Identity):
+        owner = self.store.customers_by_identity.get(identity_)
+        if owner is not None and owner is not customer:
+            raise IdentityConflict()
+        CustomerAlias(
+            customer=customer, channel=identity_.channel,
+            external_id=identity_.external_id
+        )
+        self.store.add_customer(customer)
+
+    async def load_identity_index(self):
+        # индексы хранилища точные, фильтр известных идентификаторов не нужен
+        pass
+
+
+class MemoryDialogRepository(MemoryRepositoryMixin, DialogRepository):
+    """
+    Репозиторий диалогов в памяти. История диалогов целиком хранится в
+    памяти, поэтому архивация не выполняется
+    """
+
+    async def close(self, dialog: Dialog):
+        dialog.close()
+        self.store.index_dialog(dialog)
+
+    async def close_inactive(
+            self, older_than: datetime.datetime, batch_size: int = 1000
+    ) -> typing.List[int]:
+        dialogs = self.store.tables[Dialog]
+        inactive = [
+            dialogs[dialog_id]
+            for dialog_ids in self.store.open_dialogs.values()
+            for dialog_id in dialog_ids
+            if dialogs[dialog_id].last_message_at is not None
+            and dialogs[dialog_id].last_message_at < older_than
+        ][:batch_size]
+        for dialog in inactive:
+            await self.close(dialog)
+        return [dialog.id for dialog in inactive]
+
+    async def get_history(
+            self, dialog: Dialog, limit: int = 50, before_id: int = None
+    ) -> typing.List[domain.Message]:
+        messages = []
+        for message in reversed(self.store.messages.get(dialog.id, ())):
+            if len(messages) == limit:
+                break
+            if before_id is None or message.id < before_id:
+                messages.append(message)
+        return messages
+
+    async def get_channel(
+            self, dialog_id: int
+    ) -> typing.Optional[domain.Channel]:
+        messages = self.store.messages.get(int(dialog_id))
+        return messages[-1].channel if messages else None
+
+    async def archive_dialogs(
+            self, older_than: datetime.datetime, batch_size: int = 100
+    ) -> int:
+        return 0
+
+    async def rehydrate(self, dialog: Dialog) -> int:
+        return 0
+
+    async def get_messages_since(
+            self, dialog_id: int, seq: int, limit: int
+    ) -> typing.List[Message]:
+        # порядковые номера сообщений диалога идут подряд с единицы, поэтому
+        # сообщение с номером seq + 1 лежит в списке по индексу seq
+        messages = self.store.messages.get(int(dialog_id), [])
+        return messages[max(seq, 0):max(seq, 0) + limit]
+
+    async def get_inbox(
+            self, user_id: int, limit: int = 50,
+            before: typing.Tuple[datetime.datetime, int] = None,
+            assigned_user_id: int = None, unassigned: bool = False,
+            closed: bool = False
+    ) -> typing.List[typing.Tuple[Dialog, int]]:
+        def matches(dialog: Dialog) -> bool:
+            if dialog.last_message_at is None or dialog.is_closed != closed:
+                return False
+            if assigned_user_id is not None:
+                if dialog.assigned_user_id != assigned_user_id:
+                    return False
+            elif unassigned and dialog.assigned_user_id is not None:
+                return False
+            return before is None or (
+                (dialog.last_message_at, dialog.id) < tuple(before)
+            )
+
+        dialogs = heapq.nlargest(
+            limit, filter(matches, self.store.tables[Dialog].values()),
+            key=lambda dialog: (dialog.last_message_at, dialog.id)
+        )
+        return [
+            (dialog, dialog.unread_count(
+                self.store.read_states.get((dialog.id, user_id))
+            ))
+            for dialog in dialogs
+        ]
+
+    async def mark_read(self, dialog: Dialog, user_id: int):
+        self.store.add(DialogReadState(
+            dialog_id=dialog.id, user_id=user_id,
+            read_count=dialog.incoming_messages_count,
+            last_read_message_id=dialog.last_message_id
+        ))
+
+    async def mark_read_many(
+            self, receipts: typing.Iterable[typing.Tuple[int, int]]
+    ):
+        dialogs = self.store.tables[Dialog]
+        for dialog_id, user_id in set(receipts):
+            if dialog_id in dialogs:
+                await self.mark_read(dialogs[dialog_id], user_id)
+
+    async def transfer(
+            self, dialog: Dialog, to_user: typing.Optional[User],
+            changed_by: int, expected_user_id: typing.Optional[int] = _ANY_USER
+    ) -> domain.DialogAssignment:
+        if dialog.is_closed or expected_user_id not in (
+                _ANY_USER, dialog.assigned_user_id
+        ):
+            raise AssignmentConflict()
+        record = DialogAssignment(
+            dialog_id=dialog.id, from_user_id=dialog.assigned_user_id,
+            to_user_id=getattr(to_user, "id", None),
+            changed_by_user_id=changed_by,
+            created_at=datetime.datetime.now()
+        )
+        self.store.add(record)
+        dialog.assigned_user = to_user
+        dialog.assigned_user_id = record.to_user_id
+        return record
+
+    async def get_assignments(
+            self, dialog_id: int
+    ) -> typing.List[domain.DialogAssignment]:
+        return sorted((
+            record for record in self.store.tables[DialogAssignment].values()
+            if record.dialog_id == int(dialog_id)
+        ), key=lambda record: record.id)
+
+    async def get_by_phone(self, phone_number: str) -> domain.Dialog:
+        customer = self.store.customers_by_identity.get(
+            domain.Identity.phone(identity.normalize_phone(phone_number))
+        )
+        return self.store.open_dialog(customer) if customer else None
+
+    async def get_by_phones(
+            self, phone_numbers: typing.Iterable[str]
+    ) -> typing.Dict[str, Dialog]:
+        identities = {
+            domain.Identity.phone(phone_number): phone_number
+            for phone_number in phone_numbers
+        }
+        return {
+            identities[identity_]: dialog
+            for identity_, dialog in (
+                await self.get_by_identities(identities)
+            ).items()
+        }
+
+    async def get_by_identities(
+            self, identities: typing.Iterable[domain.Identity],
+            use_index: bool = True
+    ) -> typing.Dict[domain.Identity, Dialog]:
+        dialogs = {}
+        for identity_ in identities:
+            customer = self.store.customers_by_identity.get(identity_)
+            dialog = self.store.open_dialog(customer) if customer else None
+            if dialog is not None:
+                dialogs[identity_] = dialog
+        return dialogs
+
+    async def save_all(self, dialogs: typing.Iterable[Dialog]):
+        dialogs = list(dialogs)
+        # как и в бд, при конфликте не сохраняется ничего
+        self.store.check_identities(
+            dialog.customer for dialog in dialogs
+            if dialog.customer is not None
+        )
+        for dialog in dialogs:
+            self.store.add_dialog(dialog)
@@ -0,0 +1,153 @@
+"""
+Управление помесячными партициями таблицы сообщений. Партиционирование
+включается настройкой :data:`~oneweb_helpdesk_chat.config.MESSAGES_PARTITIONED`
+и поддерживается только для postgres: таблица сообщений создается с
+``PARTITION BY RANGE (created_at)``, а партиции на текущий и следующие месяцы
+создаются сразу после нее и затем поддерживаются периодической задачей.
+Сообщения, для месяца которых партиции еще нет, попадают в партицию по
+умолчанию и переносятся из нее при создании партиции месяца
+"""
+import contextlib
+import datetime
+import typing
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Connectable, Engine
+
+from oneweb_helpdesk_chat import config
+from .database import Message
+
+_TABLE_NAME = Message.__tablename__
+
+
+def month_start(dt: datetime.date) -> datetime.date:
+    return datetime.date(dt.year, dt.month, 1)
+
+
+def next_month(dt: datetime.date) -> datetime.date:
+    if dt.month == 12:
+        return datetime.date(dt.year + 1, 1, 1)
+    return datetime.date(dt.year, dt.month + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    """
+    Название партиции для месяца
+    :param month: Любая дата внутри месяца
+    :return:
+    """
+    return "{}_y{:04d}m{:02d}".format(_TABLE_NAME, month.year, month.month)
+
+
+@contextlib.contextmanager
+def _transaction(connection: Connectable):
+    if isinstance(connection, Engine):
+        with connection.begin() as transaction_connection:
+            yield transaction_connection
+    elif connection.in_transaction():
+        yield connection
+    else:
+        with connection.begin():
+            yield connection
+
+
+def _exists(connection: Connectable, name: str) -> bool:
+    return connection.execute(
+        text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}
+    ).scalar()
+
+
+def create_partition(connection: Connectable, month: datetime.date) -> str:
+    """
+    Создает партицию месяца и переносит в нее сообщения этого месяца из
+    партиции по умолчанию. Партиция создается отдельной таблицей и
+    присоединяется после переноса: ``CREATE TABLE ... PARTITION OF`` завершился
+    бы ошибкой, если в партиции по умолчанию уже есть строки этого месяца.
+    Партиция по умолчанию блокируется на время переноса, чтобы в нее не
+    попали новые сообщения месяца
+    :param connection: Соединение или движок бд
+    :param month: Любая дата внутри месяца
+    :return: Название партиции
+    """
+    name = partition_name(month)
+    params = {
+        "name": name, "table": _TABLE_NAME,
+        "start": month_start(month).isoformat(),
+        "end": next_month(month).isoformat(),
+    }
+    with _transaction(connection) as transaction_connection:
+        transaction_connection.execute(text(
+            "LOCK TABLE {table}_default IN ACCESS EXCLUSIVE MODE".format(
+                **params
+            )
+        ))
+        if _exists(transaction_connection, name):
+            return name
+        transaction_connection.execute(text(
+            "CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS "
+            "INCLUDING CONSTRAINTS)".format(**params)
+        ))
+        transaction_connection.execute(text(
+            "WITH moved AS (DELETE FROM {table}_default "
+            "WHERE created_at >= '{start}' AND created_at < '{end}' "
+            "RETURNING *) INSERT INTO {name} SELECT * FROM moved".format(
+                **params
+            )
+        ))
+        transaction_connection.execute(text(
+            "ALTER TABLE {table} ATTACH PARTITION {name} "
+            "FOR VALUES FROM ('{start}') TO ('{end}')".format(**params)
+        ))
+    return name
+
+
+def ensure_partitions(
+        connection: Connectable, start: datetime.date = None,
+        months_ahead: int = config.MESSAGES_PARTITIONS_AHEAD
+) -> typing.List[str]:
+    """
+    Создает партицию по умолчанию для сообщений вне созданных партиций и
+    недостающие партиции начиная с месяца start и на months_ahead месяцев
+    вперед. Функция идемпотентна
+    :param connection: Соединение или движок бд
+    :param start: Первый месяц, по умолчанию текущий
+    :param months_ahead: Количество месяцев после start
+    :return: Названия партиций диапазона
+    """
+    with _transaction(connection) as transaction_connection:
+        transaction_connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} "
+            "DEFAULT".format(table=_TABLE_NAME)
+        ))
+
+    month = month_start(start or datetime.date.today())
+    names = []
+    for _ in range(months_ahead + 1):
+        name = partition_name(month)
+        if not _exists(connection, name):
+            create_partition(connection, month)
+        names.append(name)
+        month = next_month(month)
+    return names
+
+
+def detach_partition(connection: Connectable, month: datetime.date):
+    """
+    Отсоединяет партицию месяца от таблицы сообщений. Используется после
+    переноса всех сообщений месяца в архив, чтобы удалить ее без блокировки
+    основной таблицы
+    :param connection: Соединение или движок бд
+    :param month: Любая дата внутри месяца
+    :return:
+    """
+    connection.execute(text(
+        "ALTER TABLE {table} DETACH PARTITION {name}".format(
+            table=_TABLE_NAME, name=partition_name(month)
+        )
+    ))
+
+
+@event.listens_for(Message.__table__, "after_create")
+def _create_initial_partitions(target, connection, **kwargs):
+    if config.MESSAGES_PARTITIONED and connection.dialect.name == "postgresql":
+        ensure_partitions(connection)
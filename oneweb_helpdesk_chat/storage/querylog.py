@@ -0,0 +1,124 @@
+"""
+Журнал медленных запросов к бд. Время выполнения каждого запроса измеряется
+по событиям движка sqlalchemy, запросы дольше
+:data:`~oneweb_helpdesk_chat.config.SLOW_QUERY_MS` пишутся в лог вместе с
+методом, из которого они были вызваны(например,
+``DialogRepository.get_by_phones``), учитываются в метрике
+``db_slow_queries_total`` и сохраняются в списке последних медленных запросов.
+
+Запросы выполняются в пуле потоков, где стека асинхронного метода
+репозитория уже нет, поэтому место вызова определяется в потоке цикла
+событий(см. :func:`bind_origin`) и передается потоку пула
+"""
+import collections
+import functools
+import sys
+import threading
+import time
+import typing
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from oneweb_helpdesk_chat import config, logs, metrics
+
+logger = logs.get_logger(__name__)
+
+slow_counter = metrics.registry.counter(
+    "db_slow_queries_total", "Database statements slower than SLOW_QUERY_MS"
+)
+
+# последние медленные запросы
+slow_queries = collections.deque(maxlen=50)
+
+# максимальная длина текста запроса в логе
+STATEMENT_LIMIT = 1000
+
+# модули-обертки, которые не считаются местом вызова запроса
+_SKIPPED_MODULES = (__name__, "oneweb_helpdesk_chat.tracing")
+# модуль, функции которого(fetch_results, perform_commit) -- тоже обертки,
+# а методы репозиториев -- места вызова
+_DATABASE_MODULE = "oneweb_helpdesk_chat.storage.database"
+
+_origin = threading.local()
+
+
+def find_origin(frame) -> typing.Optional[str]:
+    """
+    Ищет в стеке ближайший вызов из кода приложения, не считая оберток
+    для работы с бд
+    :param frame: Кадр, с которого начинается поиск
+    :return: Место вызова в виде ``Класс.метод`` или ``модуль.функция``
+    """
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        code = frame.f_code
+        if (module.startswith("oneweb_helpdesk_chat")
+                and module not in _SKIPPED_MODULES):
+            owner = None
+            if code.co_argcount and code.co_varnames[0] == "self":
+                owner = frame.f_locals.get("self")
+            if owner is not None:
+                return "{}.{}".format(type(owner).__name__, code.co_name)
+            if module != _DATABASE_MODULE:
+                return "{}.{}".format(module, code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def bind_origin(func: typing.Callable) -> typing.Callable:
+    """
+    Запоминает место вызова и возвращает функцию, которая при выполнении в
+    другом потоке передает его журналу запросов. Если журнал выключен, то
+    функция возвращается без изменений
+    :param func: Функция для выполнения в пуле потоков
+    :return:
+    """
+    if config.SLOW_QUERY_MS <= 0:
+        return func
+    origin = find_origin(sys._getframe(1))
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        _origin.value = origin
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _origin.value = None
+
+    return run
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None:
+        started = context.connection.info.get("query_started_at")
+        if started:
+            started.pop()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info["query_started_at"].pop()
+    duration = (time.perf_counter() - started) * 1000
+    if config.SLOW_QUERY_MS <= 0 or duration < config.SLOW_QUERY_MS:
+        return
+    origin = (getattr(_origin, "value", None)
+              or find_origin(sys._getframe(1)) or "unknown")
+    statement = statement[:STATEMENT_LIMIT]
+    slow_counter.inc(origin=origin)
+    slow_queries.append({
+        "at": time.time(), "duration_ms": round(duration, 3),
+        "origin": origin, "statement": statement,
+    })
+    logger.warning(
+        "db.slow_query", duration_ms=round(duration, 3), origin=origin,
+        statement=statement
+    )
@@ -0,0 +1,431 @@
+"""
+Полнотекстовый поиск по истории сообщений. Поиск выполняется по заранее
+построенному индексу, а не по таблице сообщений. Доступны две реализации
+индекса:
+
+* :class:`PostgresSearchIndex` -- tsvector-документы в отдельной таблице с
+  GIN-индексом, основная реализация
+* :class:`InvertedIndex` -- инвертированный индекс в памяти процесса, для
+  тестов и sqlite. Индекс не восстанавливается из бд при запуске и в каждом
+  процессе свой, поэтому используется только при запуске в один процесс
+
+Индекс пополняется инкрементально фоновой задачей :class:`Indexer`, поэтому
+построение индекса не происходит в обработчике хука шлюза.
+"""
+import asyncio
+import datetime
+import math
+import re
+import typing
+from abc import ABCMeta, abstractmethod
+from collections import defaultdict
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, Text, Index, bindparam, func
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from sqlalchemy.orm import Session, joinedload
+
+from oneweb_helpdesk_chat import config, logs
+from . import domain
+from .database import (
+    Base, Message, Dialog, ScopedAppSession, fetch_results, executor,
+    messages_foreign_key
+)
+
+logger = logs.get_logger(__name__)
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+class MessageSearchDocument(Base):
+    """
+    Поисковый документ для отдельного сообщения
+    """
+    __tablename__ = "message_search_documents"
+    __table_args__ = (
+        Index(
+            "ix_message_search_documents_document", "document",
+            postgresql_using="gin"
+        ),
+    )
+
+    message_id = Column(
+        Integer,
+        *messages_foreign_key(
+            "fk_message_search_documents_message_id", ondelete="CASCADE"
+        ),
+        primary_key=True, autoincrement=False
+    )
+    document = Column(
+        Text().with_variant(TSVECTOR(), "postgresql"), nullable=False
+    )
+
+
+class SearchDocument:
+    """
+    Снимок данных сообщения, необходимых для индексации. Индексация выполняется
+    в фоне, поэтому индекс не держит ссылок на объекты сессии
+    """
+
+    def __init__(self, message_id: int, dialog_id: int, customer_id: int,
+                 channel: domain.Channel, created_at: datetime.datetime,
+                 text: str) -> None:
+        super().__init__()
+        self.message_id = message_id
+        self.dialog_id = dialog_id
+        self.customer_id = customer_id
+        self.channel = channel
+        self.created_at = created_at
+        self.text = text
+
+    @classmethod
+    def from_message(cls, message: domain.Message) -> 'SearchDocument':
+        # используются только внешние ключи: обращение к связи с клиентом
+        # загружало бы его из бд в цикле событий
+        return cls(
+            message_id=message.id,
+            dialog_id=message.dialog_id,
+            customer_id=message.dialog.customer_id,
+            channel=message.channel,
+            created_at=message.created_at,
+            text=message.text
+        )
+
+
+class SearchQuery:
+    """
+    Параметры поиска
+
+    :ivar str text: Строка поиска, ищутся сообщения, содержащие все слова
+    :ivar channel: Фильтр по каналу
+    :ivar customer_id: Фильтр по клиенту
+    :ivar date_from: Сообщения, созданные не раньше указанного времени
+    :ivar date_to: Сообщения, созданные раньше указанного времени
+    """
+
+    def __init__(self, text: str, channel: domain.Channel = None,
+                 customer_id: int = None,
+                 date_from: datetime.datetime = None,
+                 date_to: datetime.datetime = None,
+                 limit: int = 20, offset: int = 0) -> None:
+        super().__init__()
+        self.text = text
+        self.channel = channel
+        self.customer_id = customer_id
+        self.date_from = date_from
+        self.date_to = date_to
+        self.limit = limit
+        self.offset = offset
+
+
+def tokenize(text: str) -> typing.List[str]:
+    """
+    Разбивает текст на нормализованные термы
+    :param text:
+    :return:
+    """
+    return _TOKEN_RE.findall(text.lower())
+
+
+class SearchIndex(metaclass=ABCMeta):
+    """
+    Базовый класс для поисковых индексов. Наследники реализуют добавление
+    документов и поиск идентификаторов сообщений, загрузка самих сообщений
+    выполняется одним запросом в :meth:`search`
+    """
+
+    def __init__(
+            self,
+            session_constructor: typing.Callable[[], Session] = ScopedAppSession
+    ) -> None:
+        super().__init__()
+        self.session_constructor = session_constructor
+
+    @abstractmethod
+    async def add(self, documents: typing.List[SearchDocument]):
+        """
+        Добавляет документы в индекс
+        :param documents:
+        :return:
+        """
+
+    async def remove(self, message_ids: typing.List[int]):
+        """
+        Удаляет из индекса сообщения, перенесенные в архив. По умолчанию
+        ничего не делает: документы индекса в бд удаляются вместе с
+        сообщениями
+        :param message_ids:
+        :return:
+        """
+
+    async def add_dialog(self, dialog_id: int):
+        """
+        Добавляет в индекс все сообщения диалога, находящиеся в бд. Используется
+        для сообщений, восстановленных из архива, уже проиндексированные
+        сообщения пропускаются
+        :param dialog_id: Идентификатор диалога
+        :return:
+        """
+        query = self.session_constructor().query(Message).options(
+            joinedload(Message.dialog)
+        ).filter(Message.dialog_id == dialog_id).order_by(Message.id)
+        await self.add([
+            SearchDocument.from_message(message)
+            for message in await fetch_results(query)
+        ])
+
+    @abstractmethod
+    async def find(
+            self, query: SearchQuery
+    ) -> typing.List[typing.Tuple[int, float]]:
+        """
+        Ищет сообщения по индексу
+        :param query: Параметры поиска
+        :return: Список пар (идентификатор сообщения, релевантность),
+          отсортированный по убыванию релевантности
+        """
+
+    async def search(
+            self, query: SearchQuery
+    ) -> typing.List[typing.Tuple[Message, float]]:
+        """
+        Ищет сообщения и загружает их из хранилища
+        :param query: Параметры поиска
+        :return: Список пар (сообщение, релевантность)
+        """
+        hits = await self.find(query)
+        if not hits:
+            return []
+        db_query = self.session_constructor().query(Message).options(
+            joinedload(Message.dialog).joinedload(Dialog.customer)
+        ).filter(Message.id.in_([message_id for message_id, _ in hits]))
+        messages = {
+            message.id: message for message in await fetch_results(db_query)
+        }
+        return [
+            (messages[message_id], rank)
+            for message_id, rank in hits if message_id in messages
+        ]
+
+
+class PostgresSearchIndex(SearchIndex):
+    """
+    Индекс на базе tsvector и GIN-индекса postgres
+    """
+
+    def __init__(
+            self,
+            session_constructor: typing.Callable[[], Session] = ScopedAppSession,
+            language: str = config.SEARCH_LANGUAGE
+    ) -> None:
+        super().__init__(session_constructor)
+        self.language = language
+
+    async def _execute(self, statement, *multiparams):
+        """
+        Выполняет запрос в отдельной транзакции на собственном соединении, а не
+        в общей сессии: ошибка индексации не должна оставлять сессию
+        обработчиков запросов в неконсистентном состоянии, а фиксация --
+        сбрасывать в бд чужие изменения
+        :param statement:
+        :param multiparams:
+        :return:
+        """
+        bind = self.session_constructor().get_bind()
+
+        def execute():
+            with bind.begin() as connection:
+                connection.execute(statement, *multiparams)
+
+        await asyncio.get_event_loop().run_in_executor(executor, execute)
+
+    async def add(self, documents: typing.List[SearchDocument]):
+        if not documents:
+            return
+        statement = insert(MessageSearchDocument.__table__).values(
+            message_id=bindparam("id"),
+            document=func.to_tsvector(self.language, bindparam("text"))
+        ).on_conflict_do_nothing()
+        await self._execute(statement, [
+            {"id": document.message_id, "text": document.text}
+            for document in documents
+        ])
+
+    async def add_dialog(self, dialog_id: int):
+        # документы строятся одним запросом на стороне бд, без загрузки
+        # сообщений в процесс
+        statement = insert(MessageSearchDocument.__table__).from_select(
+            ["message_id", "document"],
+            sqlalchemy.select([
+                Message.id, func.to_tsvector(self.language, Message.text)
+            ]).where(Message.dialog_id == dialog_id)
+        ).on_conflict_do_nothing()
+        await self._execute(statement)
+
+    async def find(
+            self, query: SearchQuery
+    ) -> typing.List[typing.Tuple[int, float]]:
+        ts_query = func.plainto_tsquery(self.language, query.text)
+        rank = func.ts_rank(MessageSearchDocument.document, ts_query)
+        db_query = self.session_constructor().query(
+            MessageSearchDocument.message_id, rank
+        ).join(
+            Message, Message.id == MessageSearchDocument.message_id
+        ).filter(MessageSearchDocument.document.op("@@")(ts_query))
+
+        if query.channel is not None:
+            db_query = db_query.filter(Message.channel == query.channel)
+        if query.customer_id is not None:
+            db_query = db_query.join(
+                Dialog, Dialog.id == Message.dialog_id
+            ).filter(Dialog.customer_id == query.customer_id)
+        if query.date_from is not None:
+            db_query = db_query.filter(Message.created_at >= query.date_from)
+        if query.date_to is not None:
+            db_query = db_query.filter(Message.created_at < query.date_to)
+
+        db_query = db_query.order_by(
+            rank.desc(), MessageSearchDocument.message_id.desc()
+        ).offset(query.offset).limit(query.limit)
+        return [
+            (message_id, float(message_rank))
+            for message_id, message_rank in await fetch_results(db_query)
+        ]
+
+
+class InvertedIndex(SearchIndex):
+    """
+    Инвертированный индекс в памяти процесса. Для каждого терма хранится список
+    вхождений(идентификатор сообщения -> количество вхождений терма), для
+    сообщений -- поля, по которым возможна фильтрация. Релевантность считается
+    по tf-idf
+    """
+
+    def __init__(
+            self,
+            session_constructor: typing.Callable[[], Session] = ScopedAppSession
+    ) -> None:
+        super().__init__(session_constructor)
+        self.postings = defaultdict(
+            dict
+        )  # type: typing.Dict[str, typing.Dict[int, int]]
+        self.documents = {}  # type: typing.Dict[int, SearchDocument]
+        # термы каждого сообщения, для удаления его вхождений
+        self.terms = {}  # type: typing.Dict[int, typing.Set[str]]
+
+    async def add(self, documents: typing.List[SearchDocument]):
+        for document in documents:
+            if document.message_id in self.documents:
+                continue
+            # текст в индексе не нужен, храним только поля для фильтрации
+            self.documents[document.message_id] = SearchDocument(
+                document.message_id, document.dialog_id, document.customer_id,
+                document.channel, document.created_at, None
+            )
+            terms = tokenize(document.text)
+            for term in terms:
+                postings = self.postings[term]
+                postings[document.message_id] = (
+                    postings.get(document.message_id, 0) + 1
+                )
+            self.terms[document.message_id] = set(terms)
+
+    async def remove(self, message_ids: typing.List[int]):
+        for message_id in message_ids:
+            self.documents.pop(message_id, None)
+            for term in self.terms.pop(message_id, ()):
+                postings = self.postings[term]
+                postings.pop(message_id, None)
+                if not postings:
+                    del self.postings[term]
+
+    def _matches(self, document: SearchDocument, query: SearchQuery) -> bool:
+        if query.channel is not None and document.channel != query.channel:
+            return False
+        if (query.customer_id is not None
+                and document.customer_id != query.customer_id):
+            return False
+        if query.date_from is not None and document.created_at < query.date_from:
+            return False
+        if query.date_to is not None and document.created_at >= query.date_to:
+            return False
+        return True
+
+    async def find(
+            self, query: SearchQuery
+    ) -> typing.List[typing.Tuple[int, float]]:
+        terms = set(tokenize(query.text))
+        if not terms or any(term not in self.postings for term in terms):
+            return []
+        # пересечение начинаем с самого короткого списка вхождений
+        postings = sorted(
+            (self.postings[term] for term in terms), key=len
+        )
+        candidates = set(postings[0])
+        for term_postings in postings[1:]:
+            candidates.intersection_update(term_postings)
+
+        total = len(self.documents)
+        ranked = []
+        for message_id in candidates:
+            if not self._matches(self.documents[message_id], query):
+                continue
+            rank = sum(
+                term_postings[message_id]
+                * math.log(1 + total / len(term_postings))
+                for term_postings in postings
+            )
+            ranked.append((message_id, rank))
+
+        ranked.sort(key=lambda hit: (hit[1], hit[0]), reverse=True)
+        return ranked[query.offset:query.offset + query.limit]
+
+
+class Indexer:
+    """
+    Фоновая задача индексации. Сообщения ставятся в очередь методом
+    :meth:`submit`, не дожидаясь индексации, и добавляются в индекс пачками
+    """
+
+    def __init__(self, index: SearchIndex, batch_size: int = 100) -> None:
+        super().__init__()
+        self.index = index
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue()
+        self._task = None  # type: asyncio.Task
+
+    def submit(self, message: domain.Message):
+        """
+        Ставит сообщение в очередь на индексацию
+        :param message: Сохраненное сообщение
+        :return:
+        """
+        self.queue.put_nowait(SearchDocument.from_message(message))
+
+    async def run(self):
+        """
+        Цикл индексации: ждет первого документа и забирает из очереди все
+        накопившиеся, но не больше batch_size
+        :return:
+        """
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.index.add(batch)
+            except Exception:
+                logger.exception("search.index_failed", size=len(batch))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,328 @@
+"""
+Трассировка обработки запросов. Трасса -- дерево интервалов(span) с временем
+начала и окончания, интервалы покрывают этапы обработки: ожидание свободного
+потока в пуле для работы с бд и сам запрос или коммит, разбор тела запроса
+шлюзом и отправку сообщения в сервис, преобразование сообщения в json, запись
+в хвост диалога и рассылку подписчикам, отправку кадра в вебсокет.
+
+Трассировка выключена, пока не задан экспортер(см. :func:`setup` и настройку
+:data:`~oneweb_helpdesk_chat.config.TRACE_FILE`). Интервалы создаются только
+внутри трассы, начатой :meth:`Tracer.trace`, поэтому без трассы вызов
+:meth:`Tracer.span` почти ничего не стоит::
+
+    with tracing.tracer.trace("http.request", path=request.path):
+        with tracing.tracer.span("gateway.parse") as span:
+            ...
+
+Интервалы экспортируются в формате OTLP/JSON(по одному интервалу на строку
+файла), идентификатор трассы совпадает с идентификатором корреляции запроса
+из :mod:`~oneweb_helpdesk_chat.logs`, если тот имеет подходящий формат
+"""
+import asyncio
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import typing
+from concurrent.futures import Executor
+
+from oneweb_helpdesk_chat import config, logs
+
+# текущий интервал трассы
+current_span = contextvars.ContextVar(
+    "current_span", default=None
+)  # type: contextvars.ContextVar[typing.Optional[Span]]
+
+_TRACE_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+
+class Span:
+    """
+    Интервал трассы
+
+    :ivar str name: Название этапа
+    :ivar str trace_id: Идентификатор трассы, 32 шестнадцатеричных символа
+    :ivar str span_id: Идентификатор интервала, 16 шестнадцатеричных символов
+    :ivar str parent_id: Идентификатор родительского интервала
+    :ivar int start: Время начала в наносекундах от начала эпохи
+    :ivar int end: Время окончания в наносекундах от начала эпохи
+    :ivar dict attributes: Атрибуты интервала
+    :ivar str error: Описание исключения, если этап завершился с ошибкой
+    """
+    __slots__ = (
+        "name", "trace_id", "span_id", "parent_id", "start", "end",
+        "attributes", "error"
+    )
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None,
+                 attributes: dict = None, start: int = None) -> None:
+        super().__init__()
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time_ns() if start is None else start
+        self.end = None  # type: typing.Optional[int]
+        self.attributes = attributes or {}
+        self.error = None  # type: typing.Optional[str]
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> float:
+        """
+        Длительность в миллисекундах
+        :return:
+        """
+        return (self.end - self.start) / 1e6
+
+    def as_otlp(self) -> dict:
+        """
+        Интервал в формате OTLP/JSON
+        :return:
+        """
+        data = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+        }
+        if self.parent_id is not None:
+            data["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            data["status"] = {"code": 2, "message": self.error}
+        return data
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class InMemoryExporter:
+    """
+    Сохраняет завершенные интервалы в списке, используется в тестах
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.spans = []  # type: typing.List[Span]
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def names(self) -> typing.List[str]:
+        return [span.name for span in self.spans]
+
+    def stop(self):
+        pass
+
+
+class FileExporter:
+    """
+    Дописывает интервалы в файл, по одному json-объекту OTLP на строку.
+    Запись выполняется фоновым потоком, интервалы передаются ему через
+    очередь
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._write, name="trace-exporter", daemon=True
+        )
+        self._thread.start()
+
+    def export(self, span: Span):
+        self.queue.put(span)
+
+    def _write(self):
+        with open(self.path, "a", encoding="utf8") as trace_file:
+            while True:
+                span = self.queue.get()
+                if span is None:
+                    break
+                trace_file.write(json.dumps(span.as_otlp()) + "\n")
+                if self.queue.empty():
+                    trace_file.flush()
+
+    def stop(self):
+        """
+        Дописывает накопившиеся интервалы и останавливает поток
+        :return:
+        """
+        self.queue.put(None)
+        self._thread.join()
+
+
+class _NoopSpanContext:
+    """
+    Контекст интервала, который не записывается
+    """
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NOOP = _NoopSpanContext()
+
+
+class _SpanContext:
+    """
+    Контекст записываемого интервала: делает интервал текущим на время
+    выполнения блока и экспортирует его по завершении
+    """
+    __slots__ = ("tracer", "span", "token")
+
+    def __init__(self, tracer: "Tracer", span: Span) -> None:
+        super().__init__()
+        self.tracer = tracer
+        self.span = span
+        self.token = None
+
+    def __enter__(self) -> Span:
+        self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        current_span.reset(self.token)
+        if exc_type is not None:
+            self.span.error = "{}: {}".format(exc_type.__name__, exc_val)
+        self.tracer.finish(self.span)
+        return False
+
+
+class Tracer:
+    """
+    Создает интервалы и передает завершенные экспортеру
+
+    :ivar exporter: Экспортер, если не задан, то трассировка выключена
+    :ivar float sample_rate: Доля записываемых трасс
+    """
+
+    def __init__(self, exporter=None, sample_rate: float = 1.0) -> None:
+        super().__init__()
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def trace(self, name: str, **attributes):
+        """
+        Начинает новую трассу. Будет ли трасса записана, решается здесь с
+        вероятностью sample_rate, внутри незаписываемой трассы интервалы не
+        создаются
+        :param name: Название корневого интервала
+        :param attributes: Атрибуты интервала
+        :return: Контекстный менеджер, возвращающий интервал или None
+        """
+        if self.exporter is None or current_span.get() is not None:
+            return self.span(name, **attributes)
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return _NOOP
+        correlation = logs.correlation_id.get()
+        if correlation is not None and _TRACE_ID_RE.fullmatch(correlation):
+            trace_id = correlation
+        else:
+            trace_id = os.urandom(16).hex()
+        return _SpanContext(self, Span(name, trace_id, attributes=attributes))
+
+    def span(self, name: str, **attributes):
+        """
+        Интервал внутри текущей трассы. Если трассы нет, то интервал не
+        создается
+        :param name: Название этапа
+        :param attributes: Атрибуты интервала
+        :return: Контекстный менеджер, возвращающий интервал или None
+        """
+        parent = current_span.get()
+        if parent is None:
+            return _NOOP
+        return _SpanContext(self, Span(
+            name, parent.trace_id, parent.span_id, attributes
+        ))
+
+    def finish(self, span: Span):
+        span.end = time.time_ns()
+        exporter = self.exporter
+        if exporter is not None:
+            exporter.export(span)
+
+    async def run_in_executor(self, executor: Executor, name: str,
+                              func: typing.Callable, *args,
+                              attributes: dict = None):
+        """
+        Выполняет функцию в пуле потоков. Внутри трассы выполнение покрывается
+        интервалом name, а ожидание свободного потока -- дочерним интервалом
+        ``executor.wait``
+        :param executor: Пул потоков
+        :param name: Название этапа
+        :param func: Функция
+        :param args: Аргументы функции
+        :param attributes: Атрибуты интервала
+        :return: Результат функции
+        """
+        loop = asyncio.get_event_loop()
+        if current_span.get() is None:
+            return await loop.run_in_executor(executor, func, *args)
+
+        with self.span(name, **(attributes or {})) as span:
+            def run():
+                wait = Span(
+                    "executor.wait", span.trace_id, span.span_id,
+                    start=span.start
+                )
+                self.finish(wait)
+                return func(*args)
+
+            return await loop.run_in_executor(executor, run)
+
+
+# трассировщик приложения
+tracer = Tracer()
+
+
+def setup(path: str = config.TRACE_FILE,
+          sample_rate: float = config.TRACE_SAMPLE_RATE):
+    """
+    Включает трассировку с записью в файл path, если он задан. В пути можно
+    указать ``{pid}``, чтобы воркеры писали трассы в разные файлы
+    :param path: Путь к файлу трасс
+    :param sample_rate: Доля записываемых трасс
+    :return:
+    """
+    shutdown()
+    if path:
+        tracer.exporter = FileExporter(path.format(pid=os.getpid()))
+    tracer.sample_rate = sample_rate
+
+
+def shutdown():
+    """
+    Выключает трассировку, дописав накопившиеся интервалы
+    :return:
+    """
+    exporter, tracer.exporter = tracer.exporter, None
+    if exporter is not None:
+        exporter.stop()
@@ -0,0 +1,146 @@
+"""
+Сторож цикла событий. Задача в цикле событий периодически засыпает на
+interval и измеряет, насколько позже она проснулась(задержка цикла), а
+фоновый поток следит, чтобы это происходило вовремя. Если задача не
+просыпается дольше порога
+:data:`~oneweb_helpdesk_chat.config.LOOP_LAG_THRESHOLD`, значит поток цикла
+событий занят блокирующим вызовом: фоновый поток снимает его стек, пока
+вызов еще выполняется, и пишет его в лог.
+
+Задержка отдается в метриках ``event_loop_lag_seconds`` и
+``event_loop_lag_max_seconds``, количество зависаний -- в
+``event_loop_stalls_total``, последние зависания со стеками -- в
+административном эндпоинте ``/admin/watchdog``
+"""
+import asyncio
+import collections
+import sys
+import threading
+import time
+import traceback
+import typing
+
+from oneweb_helpdesk_chat import config, logs, metrics
+
+logger = logs.get_logger(__name__)
+
+stalls_counter = metrics.registry.counter(
+    "event_loop_stalls_total",
+    "Times the event loop was blocked longer than LOOP_LAG_THRESHOLD"
+)
+
+
+class LoopWatchdog:
+    """
+    Сторож цикла событий
+
+    :ivar float interval: Интервал между измерениями задержки в секундах
+    :ivar float threshold: Порог задержки, после которого цикл считается
+      зависшим
+    :ivar float lag: Последняя измеренная задержка
+    :ivar float max_lag: Максимальная задержка с момента запуска
+    :ivar collections.deque stalls: Последние зависания
+    """
+
+    def __init__(self, interval: float = config.LOOP_WATCHDOG_INTERVAL,
+                 threshold: float = config.LOOP_LAG_THRESHOLD,
+                 history: int = 20) -> None:
+        super().__init__()
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = collections.deque(maxlen=history)
+        self._heartbeat = time.monotonic()
+        self._captured = None  # type: typing.Optional[float]
+        self._loop_thread = None  # type: typing.Optional[int]
+        self._task = None  # type: typing.Optional[asyncio.Task]
+        self._thread = None  # type: typing.Optional[threading.Thread]
+        self._stopped = threading.Event()
+
+        metrics.registry.gauge(
+            "event_loop_lag_seconds", "Last measured event loop lag",
+            lambda: self.lag
+        )
+        metrics.registry.gauge(
+            "event_loop_lag_max_seconds", "Maximum event loop lag",
+            lambda: self.max_lag
+        )
+
+    def record_lag(self, lag: float):
+        self.lag = max(lag, 0.0)
+        self.max_lag = max(self.max_lag, self.lag)
+        self._heartbeat = time.monotonic()
+
+    async def run(self):
+        """
+        Измерение задержки цикла событий
+        :return:
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record_lag(loop.time() - started - self.interval)
+
+    def check(self) -> typing.Optional[dict]:
+        """
+        Проверяет, не завис ли цикл событий, и если завис, снимает стек
+        потока цикла. Одно зависание записывается один раз
+        :return: Описание зависания или None
+        """
+        heartbeat = self._heartbeat
+        blocked = time.monotonic() - heartbeat - self.interval
+        if blocked <= self.threshold or heartbeat == self._captured:
+            return None
+        self._captured = heartbeat
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        stall = {
+            "at": time.time(), "blocked_ms": round(blocked * 1000, 3),
+            "stack": stack,
+        }
+        self.stalls.append(stall)
+        stalls_counter.inc()
+        logger.warning(
+            "loop.blocked", blocked_ms=stall["blocked_ms"], stack=stack
+        )
+        return stall
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 2):
+            self.check()
+
+    def start(self):
+        """
+        Запускает сторожа, вызывается из потока цикла событий
+        :return:
+        """
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self.run())
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def as_json(self) -> dict:
+        return {
+            "lag_ms": round(self.lag * 1000, 3),
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+            "stalls": list(self.stalls),
+        }
@@ -0,0 +1,213 @@
+"""
+Тесты для архива сообщений
+"""
+import asyncio
+import datetime
+import os
+import shutil
+import tempfile
+
+from oneweb_helpdesk_chat.storage import database
+from oneweb_helpdesk_chat.storage.archive import Archive
+from oneweb_helpdesk_chat.storage.domain import Channel, Message
+from oneweb_helpdesk_chat.storage.search import InvertedIndex, SearchQuery
+from tests.utils import BaseTestCase
+
+
+class ArchiveTestCase(BaseTestCase):
+    """
+    Тесты для файлового архива
+    :class:`oneweb_helpdesk_chat.storage.archive.Archive`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.archive = Archive(self.directory)
+        self.started_at = datetime.datetime(2020, 1, 1)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def make_messages(self, ids):
+        return [
+            Message(
+                ident=i, channel=Channel.WHATSAPP, text="text {}".format(i),
+                created_at=self.started_at
+            )
+            for i in ids
+        ]
+
+    def test_append_and_read(self):
+        """
+        Повторная архивация дописывает сообщения в конец архива
+        """
+        self.assertEqual(
+            self.archive.append(1, self.make_messages([1, 2])), (2, 2)
+        )
+        self.assertEqual(
+            self.archive.append(1, self.make_messages([5])), (1, 5)
+        )
+        self.assertEqual(
+            [record["id"] for record in self.archive.read(1)], [1, 2, 5]
+        )
+        self.assertEqual(
+            [record["id"] for record in self.archive.read_last(1, 2)], [5, 2]
+        )
+        self.assertEqual(
+            [record["id"] for record in self.archive.read_last(1, 2, 5)],
+            [2, 1]
+        )
+
+    def test_read_last_without_index(self):
+        """
+        Архив без индекса фрагментов читается целиком с тем же результатом
+        """
+        self.archive.append(1, self.make_messages([1, 2]))
+        self.archive.append(1, self.make_messages([5, 6]))
+        os.remove(self.archive.index_path(1))
+        self.assertEqual(
+            [record["id"] for record in self.archive.read_last(1, 3, 6)],
+            [5, 2, 1]
+        )
+
+    def test_truncate(self):
+        """
+        Откат дописывания возвращает архив в исходное состояние
+        """
+        self.archive.append(1, self.make_messages([1]))
+        size = self.archive.size(1)
+        self.archive.append(1, self.make_messages([2]))
+        self.archive.truncate(1, size)
+        self.assertEqual([record["id"] for record in self.archive.read(1)], [1])
+        self.assertEqual(
+            [record["id"] for record in self.archive.read_last(1, 5)], [1]
+        )
+
+        self.archive.truncate(1, 0)
+        self.assertEqual(list(self.archive.read(1)), [])
+
+
+class DialogArchivationTestCase(BaseTestCase):
+    """
+    Тесты для переноса диалогов в архив и чтения истории
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        database.Base.metadata.drop_all(database.engine())
+        database.Base.metadata.create_all(database.engine())
+        database.ScopedAppSession.configure(bind=database.engine())
+
+        self.directory = tempfile.mkdtemp()
+        self.search_index = InvertedIndex()
+        self.repository = database.DialogRepository(
+            archive=Archive(self.directory), search_index=self.search_index
+        )
+        self.session = database.ScopedAppSession()
+        self.dialog = database.Dialog(customer=database.Customer(
+            name="Customer", phone_number="+79876543210"
+        ))
+        for i in range(5):
+            self.dialog.add_message(database.Message(
+                channel=Channel.WHATSAPP, text="text {}".format(i),
+                created_at=datetime.datetime(2020, 1, 1, 0, i)
+            ))
+        self.session.add(self.dialog)
+        self.session.commit()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+        shutil.rmtree(self.directory)
+        database.ScopedAppSession.commit()
+        database.ScopedAppSession.remove()
+        database.Base.metadata.drop_all(database.engine())
+
+    def test_history_spans_archive(self):
+        """
+        После архивации история диалога читается как из бд, так и из архива
+        """
+        archived = self.loop.run_until_complete(
+            self.repository.archive_dialogs(datetime.datetime(2021, 1, 1))
+        )
+        self.assertEqual(archived, 1)
+        self.assertEqual(self.session.query(database.Message).count(), 0)
+
+        self.session.expire_all()
+        self.dialog.add_message(database.Message(
+            channel=Channel.WHATSAPP, text="new",
+            created_at=datetime.datetime(2021, 1, 2)
+        ))
+        self.session.commit()
+
+        history = self.loop.run_until_complete(
+            self.repository.get_history(self.dialog, limit=3)
+        )
+        self.assertEqual(
+            [message.text for message in history],
+            ["new", "text 4", "text 3"]
+        )
+
+    def test_archive_twice(self):
+        """
+        Диалог, выбранный двумя запусками архивации, архивируется один раз
+        """
+        older_than = datetime.datetime(2021, 1, 1)
+        self.assertEqual(
+            len(self.repository._archive_dialog(self.dialog.id, older_than)),
+            5
+        )
+        self.assertIsNone(
+            self.repository._archive_dialog(self.dialog.id, older_than)
+        )
+        self.session.expire_all()
+        self.assertEqual(self.dialog.archived_messages_count, 5)
+        self.assertEqual(
+            len(list(self.repository.archive.read(self.dialog.id))), 5
+        )
+
+    def test_archive_removes_from_index(self):
+        """
+        Заархивированные сообщения удаляются из локального поискового индекса
+        """
+        self.loop.run_until_complete(
+            self.search_index.add_dialog(self.dialog.id)
+        )
+        self.loop.run_until_complete(
+            self.repository.archive_dialogs(datetime.datetime(2021, 1, 1))
+        )
+        self.assertEqual(
+            self.loop.run_until_complete(
+                self.search_index.find(SearchQuery("text"))
+            ),
+            []
+        )
+        self.assertFalse(self.search_index.postings)
+
+    def test_rehydrate(self):
+        """
+        Восстановленные из архива сообщения снова находятся в бд и в
+        поисковом индексе
+        """
+        self.loop.run_until_complete(
+            self.repository.archive_dialogs(datetime.datetime(2021, 1, 1))
+        )
+        restored = self.loop.run_until_complete(
+            self.repository.rehydrate(self.dialog)
+        )
+        self.assertEqual(restored, 5)
+        self.assertEqual(self.session.query(database.Message).count(), 5)
+        self.assertEqual(self.dialog.archived_messages_count, 0)
+
+        messages = self.loop.run_until_complete(
+            self.repository.get_messages_since(self.dialog.id, 3, 10)
+        )
+        self.assertEqual([message.seq for message in messages], [4, 5])
+
+        results = self.loop.run_until_complete(
+            self.search_index.search(SearchQuery("3"))
+        )
+        self.assertEqual([message.text for message, _ in results], ["text 3"])
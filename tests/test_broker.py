@@ -0,0 +1,153 @@
+"""
+Тесты для обмена сообщениями между процессами-воркерами
+"""
+import asyncio
+import datetime
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from oneweb_helpdesk_chat import config, storage
+from oneweb_helpdesk_chat.broker import BrokerServer, UnixSocketBroker
+from oneweb_helpdesk_chat.chat import MessageEncoder
+from oneweb_helpdesk_chat.connections import Connection, ConnectionRegistry
+from oneweb_helpdesk_chat.events import Event, EventType
+from oneweb_helpdesk_chat.queues import TailRepository
+from oneweb_helpdesk_chat.server import Supervisor, listen_socket, main
+from tests.utils import BaseTestCase
+
+
+class BrokerTestCase(BaseTestCase):
+    """
+    Сообщение, опубликованное в реестре одного воркера, доставляется
+    подписчикам реестра другого воркера
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.mkdtemp()
+        self.server = BrokerServer(os.path.join(self.directory, "broker.sock"))
+        self.loop.run_until_complete(self.server.start())
+        self.registries = []
+        for _ in range(2):
+            registry = ConnectionRegistry(
+                TailRepository(), MessageEncoder().default
+            )
+            registry.broker = UnixSocketBroker(self.server.path)
+            self.loop.run_until_complete(
+                registry.broker.start(registry.handle_broker_frame)
+            )
+            self.loop.run_until_complete(registry.broker.connected.wait())
+            self.registries.append(registry)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        for registry in self.registries:
+            self.loop.run_until_complete(registry.broker.stop())
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.directory)
+
+    def receive(self, connection: Connection) -> dict:
+        return self.loop.run_until_complete(
+            asyncio.wait_for(connection.outbox.get(), 1)
+        )
+
+    def test_publish(self):
+        source, target = self.registries
+        connection = Connection(mock.MagicMock(), 1)
+        target.register(connection)
+        self.loop.run_until_complete(target.subscribe(connection, "1"))
+
+        message = storage.Message(
+            text="text", seq=1, created_at=datetime.datetime(2020, 1, 1),
+            dialog=storage.Dialog(
+                id=1, customer=storage.Customer(id=1, name="Customer")
+            )
+        )
+        self.loop.run_until_complete(source.publish_message("1", message))
+        frame = self.receive(connection)
+        self.assertEqual(frame["message"]["text"], "text")
+        self.assertEqual(len(target.tails.since("1", 0)), 1)
+
+        source.publish_event(Event(EventType.NEW_UNASSIGNED_DIALOG_MESSAGE, 1))
+        self.assertEqual(self.receive(connection)["type"], "event")
+
+    def test_reconnect(self):
+        """
+        После перезапуска брокера клиент переподключается и вызывает
+        обработчик переподключения
+        """
+        reconnected = asyncio.Event()
+        broker = UnixSocketBroker(self.server.path, reconnect_interval=0.01)
+        self.loop.run_until_complete(
+            broker.start(lambda frame: None, reconnected.set)
+        )
+        self.loop.run_until_complete(broker.connected.wait())
+        self.assertFalse(reconnected.is_set())
+
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.run_until_complete(self.server.start())
+        self.loop.run_until_complete(asyncio.wait_for(reconnected.wait(), 1))
+        self.loop.run_until_complete(broker.stop())
+
+    def test_bad_frame(self):
+        """
+        Ошибка обработки кадра не останавливает чтение следующих кадров
+        """
+        source, target = self.registries
+        connection = Connection(mock.MagicMock(), 1)
+        target.register(connection)
+        source.broker.publish({"type": "message"})
+        source.publish_event(Event(EventType.NEW_UNASSIGNED_DIALOG_MESSAGE, 1))
+        self.assertEqual(self.receive(connection)["type"], "event")
+
+
+class ListenSocketTestCase(BaseTestCase):
+
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "no SO_REUSEPORT")
+    def test_reuse_port(self):
+        """
+        Несколько воркеров могут слушать один и тот же порт
+        """
+        first = listen_socket("127.0.0.1", 0, reuse_port=True)
+        port = first.getsockname()[1]
+        second = listen_socket("127.0.0.1", port, reuse_port=True)
+        self.assertEqual(second.getsockname()[1], port)
+        first.close()
+        second.close()
+
+
+class SupervisorTestCase(BaseTestCase):
+
+    def test_maintenance_worker(self):
+        """
+        Обслуживание хранилища включено только в первом воркере, каждый
+        воркер знает общее количество воркеров
+        """
+        supervisor = Supervisor("127.0.0.1", 0, 2, "broker.sock")
+        supervisor.context = mock.MagicMock()
+        for number in range(2):
+            supervisor.start_worker(number)
+        self.assertEqual(
+            [
+                call[1]["args"][-2:]
+                for call in supervisor.context.Process.call_args_list
+            ],
+            [(True, 2), (False, 2)]
+        )
+
+    def test_local_search_single_worker(self):
+        """
+        С локальным поисковым индексом несколько воркеров не запускаются
+        """
+        with mock.patch.object(config, "SEARCH_BACKEND", "local"), \
+                mock.patch("sys.stderr"), \
+                self.assertRaises(SystemExit):
+            main(["--workers", "2"])
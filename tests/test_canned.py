@@ -0,0 +1,131 @@
+"""
+Тесты для шаблонов ответов
+"""
+import json
+import time
+from unittest import mock
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.web_app import Application
+
+from oneweb_helpdesk_chat import canned, storage
+from oneweb_helpdesk_chat.chat import ChatHandler
+from tests.utils import BaseTestCase
+
+
+def make_responses():
+    return [
+        storage.CannedResponse(shortcut="hello", text="Здравствуйте!"),
+        storage.CannedResponse(shortcut="help", text="Чем помочь?"),
+        storage.CannedResponse(shortcut="bye", text="До свидания"),
+        storage.CannedResponse(
+            team="sales", shortcut="hello",
+            text="Здравствуйте, {customer.name}! Я {user.name}, {{отдел}}"
+        ),
+        storage.CannedResponse(team="sales", shortcut="hey", text="Привет"),
+        storage.CannedResponse(team="sales", shortcut="bad", text="{dialog}"),
+    ]
+
+
+class CannedResponsesTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.canned.CannedResponses`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.responses = canned.CannedResponses()
+        self.responses.load(make_responses())
+        self.dialog = storage.Dialog(
+            id=1, customer=storage.Customer(id=1, name="Иван")
+        )
+        self.user = storage.User(id=1, name="Мария", team="sales")
+
+    def test_compile(self):
+        render = canned.compile_template(
+            "#{dialog.id} {customer.phone}{user.name}"
+        )
+        self.assertEqual(render(self.dialog, self.user), "#1 Мария")
+        self.assertEqual(canned.compile_template("")(None, None), "")
+        for text in ("{customer}", "{user.name!r}", "{user.name:>10}", "{"):
+            with self.assertRaises(canned.TemplateError):
+                canned.compile_template(text)
+
+    def test_team_override(self):
+        """
+        Шаблон команды перекрывает общий шаблон, шаблоны другой команды
+        недоступны, шаблоны с ошибками не загружаются
+        """
+        self.assertEqual(
+            self.responses.render("sales", "hello", self.dialog, self.user),
+            "Здравствуйте, Иван! Я Мария, {отдел}"
+        )
+        self.assertEqual(
+            self.responses.render(None, "hello", self.dialog, self.user),
+            "Здравствуйте!"
+        )
+        for team, shortcut in ((None, "hey"), ("sales", "bad")):
+            with self.assertRaises(canned.CannedResponseNotFound):
+                self.responses.get(team, shortcut)
+
+    def test_complete(self):
+        self.assertEqual(
+            [t.shortcut for t in self.responses.complete("sales", "he")],
+            ["hello", "help", "hey"]
+        )
+        self.assertEqual(
+            self.responses.complete("sales", "hel")[0].text,
+            make_responses()[3].text
+        )
+        self.assertEqual(
+            [t.shortcut for t in self.responses.complete(None, "", 2)],
+            ["bye", "hello"]
+        )
+        self.assertEqual(self.responses.complete("support", "x"), [])
+
+    def test_build_message(self):
+        handler = ChatHandler(
+            mock.MagicMock(), self.dialog, self.user, mock.MagicMock(),
+            self.responses
+        )
+        self.assertEqual(
+            handler.build_message({"canned": "hey"}).text, "Привет"
+        )
+        self.assertEqual(handler.build_message({"text": "hi"}).text, "hi")
+
+
+class CannedResponsesViewTestCase(AioHTTPTestCase, BaseTestCase):
+    """
+    Тесты для эндпоинта ``/canned/``
+    """
+
+    async def get_application(self) -> Application:
+        from oneweb_helpdesk_chat import app
+        self.app_module = app
+        return await app.make_app()
+
+    @unittest_run_loop
+    async def test_complete(self):
+        # отдельный экземпляр, чтобы фоновая загрузка из бд его не заменила
+        responses = canned.CannedResponses()
+        responses.load(make_responses())
+        patcher = mock.patch.object(
+            self.app_module, "canned_responses", responses
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.session.cookie_jar.update_cookies({
+            "AIOHTTP_SESSION": json.dumps({
+                "created": int(time.time()),
+                "session": {"user_id": 1, "team": "sales"}
+            })
+        })
+        response = await self.client.get(
+            self.app.router["canned-responses"].url_for(),
+            params={"prefix": "he", "limit": "2"}
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            [item["shortcut"] for item in (await response.json())["items"]],
+            ["hello", "help"]
+        )
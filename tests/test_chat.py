@@ -0,0 +1,130 @@
+"""
+Тесты для ответов сотрудника клиенту через вебсокет чата
+"""
+import datetime
+import json
+import shutil
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.web_app import Application
+
+from oneweb_helpdesk_chat import storage
+from oneweb_helpdesk_chat.gateways import repository
+from oneweb_helpdesk_chat.storage import database
+from oneweb_helpdesk_chat.storage.archive import Archive
+from oneweb_helpdesk_chat.storage.domain import Channel, DialogState
+from tests.utils import AsyncMock, BaseTestCase
+
+
+class ChatReplyTestCase(AioHTTPTestCase, BaseTestCase):
+    """
+    Функциональные тесты для эндпоинта ``/chat/{dialog_id}``: кадры клиента
+    -- ответы кастомеру
+    """
+
+    async def get_application(self) -> Application:
+        from oneweb_helpdesk_chat import app
+        return await app.make_app()
+
+    def setUp(self) -> None:
+        super().setUp()
+        database.Base.metadata.drop_all(database.engine())
+        database.Base.metadata.create_all(database.engine())
+        database.ScopedAppSession.configure(bind=database.engine())
+
+        self.session = database.ScopedAppSession()
+        self.user = database.User(
+            name="User", login="user", password="", team="sales"
+        )
+        self.dialog = database.Dialog(customer=database.Customer(
+            name="Customer", phone_number="+79876543210"
+        ))
+        self.dialog.add_message(database.Message(
+            channel=Channel.WHATSAPP, text="Не приходит код",
+            created_at=datetime.datetime(2020, 1, 1)
+        ))
+        self.session.add_all([self.user, self.dialog])
+        self.session.commit()
+
+        self.gateway_stub = MagicMock()
+        self.gateway_stub.get_channel.return_value = Channel.WHATSAPP
+        self.gateway_stub.send = AsyncMock()
+        repository.register_gateway("chat-test", self.gateway_stub)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        repository.unregister_gateway("chat-test")
+        database.ScopedAppSession.commit()
+        database.ScopedAppSession.remove()
+        database.Base.metadata.drop_all(database.engine())
+
+    async def connect(self):
+        self.client.session.cookie_jar.update_cookies({
+            "AIOHTTP_SESSION": json.dumps({
+                "created": int(time.time()),
+                "session": {"user_id": self.user.id}
+            })
+        })
+        return await self.client.ws_connect(
+            "/chat/{}".format(self.dialog.id)
+        )
+
+    @unittest_run_loop
+    async def test_reply(self):
+        """
+        Ответ сохраняется в диалоге, переводит его в PENDING, приходит
+        подписчикам диалога и отправляется через шлюз канала диалога
+        """
+        ws = await self.connect()
+        await ws.send_json({"text": "Отправили повторно"})
+        frame = await ws.receive_json()
+        self.assertEqual(frame["text"], "Отправили повторно")
+        self.assertEqual(frame["seq"], 2)
+        await ws.close()
+
+        self.gateway_stub.send.assert_called_once()
+        message, = self.gateway_stub.send.call_args[0]
+        self.assertEqual(message.user_id, self.user.id)
+        self.assertEqual(message.channel, Channel.WHATSAPP)
+        self.session.expire_all()
+        self.assertEqual(self.dialog.state, DialogState.PENDING)
+        self.assertEqual(self.dialog.last_message.text, "Отправили повторно")
+
+    @unittest_run_loop
+    async def test_reply_to_archived_dialog(self):
+        """
+        Если все сообщения диалога в архиве, то ответ отправляется в канал
+        последнего заархивированного сообщения
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        dialogs = storage.default_dialogs_repository()
+        patcher = patch.object(dialogs, "archive", Archive(directory))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        dialogs._archive_dialog(self.dialog.id, datetime.datetime(2021, 1, 1))
+
+        ws = await self.connect()
+        await ws.send_json({"text": "Отправили повторно"})
+        frame = await ws.receive_json()
+        self.assertEqual(frame["seq"], 2)
+        await ws.close()
+        message, = self.gateway_stub.send.call_args[0]
+        self.assertEqual(message.channel, Channel.WHATSAPP)
+
+    @unittest_run_loop
+    async def test_unknown_canned_response(self):
+        """
+        Ответ по неизвестному шаблону не отправляется
+        """
+        ws = await self.connect()
+        await ws.send_json({"canned": "unknown"})
+        self.assertEqual(
+            await ws.receive_json(),
+            {"type": "error", "error": "unknown canned response"}
+        )
+        await ws.close()
+        self.gateway_stub.send.assert_not_called()
@@ -0,0 +1,367 @@
+"""
+Функциональные тесты для мультиплексированного вебсокета
+"""
+import asyncio
+import datetime
+import json
+import time
+import unittest
+from unittest import mock
+
+from aiohttp import WSMsgType
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.web_app import Application
+
+from oneweb_helpdesk_chat import framing, storage
+from oneweb_helpdesk_chat.connections import Connection, ConnectionRegistry
+from oneweb_helpdesk_chat.events import Event, EventType
+from oneweb_helpdesk_chat.queues import TailRepository
+from tests.utils import AsyncMock, BaseTestCase
+
+
+class MultiplexedWebsocketTestCase(AioHTTPTestCase, BaseTestCase):
+    """
+    Тесты для эндпоинта ``/ws/`` и реестра соединений
+    """
+
+    async def get_application(self) -> Application:
+        from oneweb_helpdesk_chat import app
+        self.app_module = app
+        return await app.make_app()
+
+    def make_message(self, dialog_id: int, text: str,
+                     seq: int = 1) -> storage.Message:
+        return storage.Message(
+            text=text, seq=seq,
+            created_at=datetime.datetime(2020, 1, 1),
+            dialog=storage.Dialog(
+                id=dialog_id,
+                customer=storage.Customer(id=1, name="Customer")
+            )
+        )
+
+    async def connect(self, **kwargs):
+        self.client.session.cookie_jar.update_cookies({
+            "AIOHTTP_SESSION": json.dumps({
+                "created": int(time.time()), "session": {"user_id": 1}
+            })
+        })
+        return await self.client.ws_connect(
+            self.app.router["ws"].url_for(), **kwargs
+        )
+
+    @unittest_run_loop
+    async def test_subscribe(self):
+        """
+        Одно соединение получает события и сообщения всех диалогов, на которые
+        оно подписано
+        """
+        registry = self.app_module.connection_registry
+        ws = await self.connect()
+        for dialog_id in (1, 2):
+            await ws.send_json(
+                {"command": "subscribe", "dialog_id": dialog_id}
+            )
+            self.assertEqual(
+                await ws.receive_json(),
+                {"type": "subscribed", "dialog_id": dialog_id}
+            )
+
+        await registry.publish_message("2", self.make_message(2, "text"))
+        frame = await ws.receive_json()
+        self.assertEqual(frame["type"], "message")
+        self.assertEqual(frame["dialog_id"], 2)
+        self.assertEqual(frame["message"]["text"], "text")
+
+        registry.publish_event(
+            Event(EventType.NEW_UNASSIGNED_DIALOG_MESSAGE, 2)
+        )
+        frame = await ws.receive_json()
+        self.assertEqual(frame["type"], "event")
+
+        await ws.send_json({"command": "unsubscribe", "dialog_id": 2})
+        await ws.receive_json()
+        self.assertNotIn("2", registry.dialogs)
+
+        await ws.close()
+
+    @unittest_run_loop
+    async def test_send_not_subscribed(self):
+        """
+        Ответ принимается только в диалог, на который подписано соединение
+        """
+        ws = await self.connect()
+        await ws.send_json({"command": "send", "dialog_id": 1, "text": "hi"})
+        self.assertEqual(
+            await ws.receive_json(),
+            {"type": "error", "error": "not subscribed"}
+        )
+        await ws.close()
+
+    @unittest_run_loop
+    async def test_pending_messages(self):
+        """
+        Сообщения, пропущенные клиентом, досылаются при подписке с last_seq
+        """
+        registry = self.app_module.connection_registry
+        for seq in (1, 2):
+            await registry.publish_message(
+                "3", self.make_message(3, "pending {}".format(seq), seq)
+            )
+
+        ws = await self.connect()
+        await ws.send_json({"command": "subscribe", "dialog_id": 3,
+                            "last_seq": 1})
+        self.assertEqual(await ws.receive_json(),
+                         {"type": "subscribed", "dialog_id": 3})
+        frame = await ws.receive_json()
+        self.assertEqual(frame["message"]["text"], "pending 2")
+        self.assertEqual(frame["message"]["seq"], 2)
+        await ws.close()
+
+    async def receive_batch(self, ws, protocol: str):
+        registry = self.app_module.connection_registry
+        await ws.send_json({"command": "subscribe", "dialog_id": 4})
+        ws_message = await ws.receive()
+        self.assertEqual(ws.protocol, protocol)
+        for seq in (1, 2, 3):
+            await registry.publish_message(
+                "4", self.make_message(4, "text {}".format(seq), seq)
+            )
+        return ws_message, await ws.receive()
+
+    @unittest_run_loop
+    async def test_json_batch(self):
+        """
+        С подпротоколом helpdesk.json кадры, опубликованные подряд,
+        приходят одним сообщением
+        """
+        ws = await self.connect(protocols=("helpdesk.json",), compress=15)
+        self.assertEqual(ws.compress, 15)
+        ack, batch = await self.receive_batch(ws, "helpdesk.json")
+        self.assertEqual(
+            json.loads(ack.data), [{"type": "subscribed", "dialog_id": 4}]
+        )
+        self.assertEqual(
+            [frame["message"]["seq"] for frame in json.loads(batch.data)],
+            [1, 2, 3]
+        )
+        await ws.close()
+
+    @unittest.skipIf(framing.msgpack is None, "msgpack is not installed")
+    @unittest_run_loop
+    async def test_msgpack_batch(self):
+        ws = await self.connect(protocols=("helpdesk.msgpack",))
+        ack, batch = await self.receive_batch(ws, "helpdesk.msgpack")
+        self.assertEqual(batch.type, WSMsgType.BINARY)
+        frames = framing.msgpack.unpackb(batch.data)
+        self.assertEqual(
+            [frame["message"]["text"] for frame in frames],
+            ["text 1", "text 2", "text 3"]
+        )
+        await ws.close()
+
+    @unittest_run_loop
+    async def test_unauthorized(self):
+        """
+        Без сессии соединение не устанавливается
+        """
+        response = await self.client.get(self.app.router["ws"].url_for())
+        self.assertEqual(response.status, 401)
+
+
+class ReaperTestCase(BaseTestCase):
+    """
+    Тесты для закрытия мертвых соединений реестром
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.registry = ConnectionRegistry(
+            TailRepository(), lambda message: {}, idle_timeout=10
+        )
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+
+    def make_connection(self, **kwargs) -> Connection:
+        ws = mock.MagicMock()
+        ws.ping = AsyncMock()
+        connection = Connection(ws, 1, **kwargs)
+        self.registry.register(connection)
+        self.loop.run_until_complete(self.registry.subscribe(connection, "1"))
+        return connection
+
+    def sweep(self):
+        async def sweep():
+            self.registry.sweep()
+            await asyncio.sleep(0)
+        self.loop.run_until_complete(sweep())
+
+    def test_idle(self):
+        """
+        Соединение без входящих кадров дольше таймаута закрывается, живое
+        соединение получает ping
+        """
+        alive = self.make_connection()
+        idle = self.make_connection()
+        idle.last_seen -= 11
+        reaped = self.registry.reaped_counter.get(reason="idle")
+
+        self.sweep()
+
+        self.assertEqual(idle.reaped, "idle")
+        self.assertNotIn(idle, self.registry.connections)
+        self.assertEqual(self.registry.dialogs["1"], {alive})
+        self.assertEqual(
+            self.registry.reaped_counter.get(reason="idle"), reaped + 1
+        )
+        alive.ws.ping.assert_called()
+
+    def test_overflow(self):
+        """
+        Соединение, которое не успевает читать кадры, закрывается и его очередь
+        освобождается
+        """
+        connection = self.make_connection(outbox_limit=2)
+        for _ in range(3):
+            self.registry.publish_event(
+                Event(EventType.NEW_UNASSIGNED_DIALOG_MESSAGE, 1)
+            )
+
+        self.sweep()
+
+        self.assertEqual(connection.reaped, "overflow")
+        self.assertTrue(connection.outbox.empty())
+        self.assertNotIn("1", self.registry.dialogs)
+
+
+class CatchUpTestCase(BaseTestCase):
+    """
+    Тесты для досылки пропущенных сообщений при подписке
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.history_loader = AsyncMock()
+        self.registry = ConnectionRegistry(
+            TailRepository(size=2), lambda message: {"seq": message.seq},
+            self.history_loader, replay_limit=3
+        )
+        self.connection = Connection(mock.MagicMock(), 1, multiplexed=False)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+
+    def make_messages(self, seqs):
+        return [storage.Message(seq=seq) for seq in seqs]
+
+    def publish(self, seqs):
+        for message in self.make_messages(seqs):
+            self.loop.run_until_complete(
+                self.registry.publish_message("1", message)
+            )
+
+    def sent(self):
+        sent = []
+        while not self.connection.outbox.empty():
+            sent.append(self.connection.outbox.get_nowait())
+        return sent
+
+    def subscribe(self, last_seq):
+        self.loop.run_until_complete(
+            self.registry.subscribe(self.connection, "1", last_seq)
+        )
+
+    def test_from_memory(self):
+        """
+        Сообщения, которые есть в хвосте, досылаются без обращения к бд
+        """
+        self.publish([1, 2, 3])
+        self.subscribe(1)
+        self.assertEqual(self.sent(), [{"seq": 2}, {"seq": 3}])
+        self.history_loader.assert_not_called()
+
+    def test_from_storage(self):
+        """
+        Вытесненные из хвоста сообщения загружаются из бд
+        """
+        self.publish([1, 2, 3])
+        self.history_loader.return_value = self.make_messages([1, 2, 3])
+        self.subscribe(0)
+        self.assertEqual(self.sent(), [{"seq": 1}, {"seq": 2}, {"seq": 3}])
+        self.history_loader.assert_called_with(1, 0, 4)
+
+    def test_reset(self):
+        """
+        Если пропущено слишком много сообщений или их уже нет в бд, клиент
+        получает команду на перезагрузку истории
+        """
+        self.history_loader.return_value = self.make_messages([1, 2, 3, 4])
+        self.subscribe(0)
+        self.assertEqual(self.sent(), [{"type": "reset", "dialog_id": 1}])
+
+        self.history_loader.return_value = self.make_messages([5, 6])
+        self.subscribe(2)
+        self.assertEqual(self.sent(), [{"type": "reset", "dialog_id": 1}])
+
+    def test_closed_dialog(self):
+        """
+        Закрытый диалог убирается из памяти, мультиплексированные соединения
+        отписываются от него
+        """
+        connection = Connection(mock.MagicMock(), 1)
+        self.loop.run_until_complete(
+            self.registry.subscribe(connection, "1")
+        )
+        self.registry.register(connection)
+        self.publish([1])
+        connection.outbox.get_nowait()
+
+        self.registry.close_dialogs(["1"])
+        self.assertIsNone(self.registry.tails.since("1", 0))
+        self.assertNotIn("1", self.registry.dialogs)
+        self.assertEqual(connection.outbox.get_nowait(),
+                         {"type": "closed", "dialog_id": 1})
+        self.assertEqual(connection.outbox.get_nowait()["event"], {
+            "event_type": "DIALOG_CLOSED", "payload": 1
+        })
+
+    def test_tail_gap(self):
+        """
+        Хвост с пропуском начинается заново, поэтому пропущенные сообщения
+        досылаются из бд, а не теряются
+        """
+        self.publish([1, 2, 4, 2])
+        self.assertIsNone(self.registry.tails.since("1", 1))
+        self.assertEqual(self.registry.tails.since("1", 3), [{"seq": 4}])
+
+    def test_resync(self):
+        """
+        После переподключения к брокеру соединение получает из бд сообщения
+        после последнего отправленного, а диалоги без отправленных сообщений
+        перезагружаются
+        """
+        self.connection.ws.closed = False
+        self.registry.register(self.connection)
+        self.subscribe(None)
+        self.publish([1, 2])
+        self.loop.run_until_complete(
+            self.registry.subscribe(self.connection, "2")
+        )
+        self.sent()
+
+        self.history_loader.return_value = self.make_messages([3, 4])
+        self.registry.tails.clear()
+        self.loop.run_until_complete(self.registry.resync(self.connection))
+        self.history_loader.assert_called_once_with(1, 2, 4)
+        sent = self.sent()
+        self.assertIn({"type": "reset", "dialog_id": 2}, sent)
+        self.assertEqual(
+            [frame for frame in sent if "seq" in frame],
+            [{"seq": 3}, {"seq": 4}]
+        )
@@ -0,0 +1,187 @@
+"""
+Тесты для выгрузки сообщений
+"""
+import asyncio
+import csv
+import datetime
+import io
+import json
+import time
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.web_app import Application
+
+from oneweb_helpdesk_chat import export
+from oneweb_helpdesk_chat.storage import database
+from oneweb_helpdesk_chat.storage.domain import Channel
+from tests.utils import BaseTestCase
+
+
+def create_dialogs():
+    database.Base.metadata.drop_all(database.engine())
+    database.Base.metadata.create_all(database.engine())
+    database.ScopedAppSession.configure(bind=database.engine())
+    session = database.ScopedAppSession()
+    for i, channel in enumerate((Channel.WHATSAPP, Channel.VIBER)):
+        dialog = database.Dialog(customer=database.Customer(
+            name="Customer {}".format(i), phone_number="+7{}".format(i)
+        ))
+        for day in range(1, 4):
+            dialog.add_message(database.Message(
+                channel=channel, text="текст {}".format(day),
+                created_at=datetime.datetime(2020, 1, day)
+            ))
+        session.add(dialog)
+    session.commit()
+
+
+def drop_dialogs():
+    database.ScopedAppSession.commit()
+    database.ScopedAppSession.remove()
+    database.Base.metadata.drop_all(database.engine())
+
+
+class ExportTestCase(BaseTestCase):
+    """
+    Тесты для :func:`oneweb_helpdesk_chat.export.stream`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        create_dialogs()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+        drop_dialogs()
+
+    def export(self, query: export.ExportQuery, writer) -> bytes:
+        async def collect():
+            return [
+                chunk async for chunk in export.stream(
+                    query, writer, chunk_size=2
+                )
+            ]
+        return b"".join(self.loop.run_until_complete(collect()))
+
+    def test_ndjson(self):
+        """
+        Сообщения фильтруются по диапазону дат и каналу
+        """
+        data = self.export(export.ExportQuery(
+            date_from=datetime.datetime(2020, 1, 2),
+            date_to=datetime.datetime(2020, 1, 4), channel=Channel.WHATSAPP
+        ), export.NdjsonWriter())
+        records = [json.loads(line) for line in data.decode().splitlines()]
+        self.assertEqual(
+            [(r["seq"], r["text"], r["channel"]) for r in records],
+            [(2, "текст 2", "whatsapp"), (3, "текст 3", "whatsapp")]
+        )
+        self.assertEqual(records[0]["created_at"], "2020-01-02T00:00:00")
+        self.assertEqual(records[0]["customer_phone"], "+70")
+
+    def test_interrupted(self):
+        """
+        Прерванная выгрузка закрывает курсор и соединение с бд
+        """
+        connections = []
+        iter_chunks = export.iter_chunks
+
+        def spy(connection, *args):
+            connections.append(connection)
+            return iter_chunks(connection, *args)
+
+        async def interrupt():
+            chunks = export.stream(
+                export.ExportQuery(), export.NdjsonWriter(), chunk_size=2
+            )
+            await chunks.__anext__()
+            await chunks.__anext__()
+            await chunks.aclose()
+
+        with mock.patch.object(export, "iter_chunks", spy):
+            self.loop.run_until_complete(interrupt())
+        connection, = connections
+        self.assertTrue(connection.closed)
+
+    def test_csv(self):
+        data = self.export(export.ExportQuery(), export.CsvWriter())
+        rows = list(csv.reader(io.StringIO(data.decode())))
+        self.assertEqual(tuple(rows[0]), export.FIELDS)
+        self.assertEqual(len(rows), 7)
+
+
+class ExportEndpointTestCase(AioHTTPTestCase, BaseTestCase):
+    """
+    Тесты для эндпоинта ``/export/messages``
+    """
+
+    async def get_application(self) -> Application:
+        from oneweb_helpdesk_chat import app
+        return await app.make_app()
+
+    def setUp(self) -> None:
+        super().setUp()
+        create_dialogs()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        drop_dialogs()
+
+    @unittest_run_loop
+    async def test_export(self):
+        url = self.app.router["export-messages"].url_for()
+        response = await self.client.get(url)
+        self.assertEqual(response.status, 401)
+
+        self.client.session.cookie_jar.update_cookies({
+            "AIOHTTP_SESSION": json.dumps({
+                "created": int(time.time()), "session": {"user_id": 1}
+            })
+        })
+        response = await self.client.get(
+            url.with_query(format="csv", channel="VIBER")
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers["Content-Type"], "text/csv")
+        self.assertEqual(len((await response.text()).splitlines()), 4)
+
+        response = await self.client.get(url.with_query(format="xml"))
+        self.assertEqual(response.status, 400)
+
+    @unittest_run_loop
+    async def test_disconnect(self):
+        """
+        При отключении клиента выгрузка прерывается и закрывается сразу
+        """
+        closed = []
+        # ссылка на генератор не дает сборщику мусора закрыть его за
+        # обработчик
+        streams = []
+
+        async def chunks():
+            try:
+                while True:
+                    yield b"chunk"
+            finally:
+                closed.append(True)
+
+        def stream(query, writer):
+            streams.append(chunks())
+            return streams[-1]
+
+        async def write(response, data):
+            raise ConnectionResetError()
+
+        self.client.session.cookie_jar.update_cookies({
+            "AIOHTTP_SESSION": json.dumps({
+                "created": int(time.time()), "session": {"user_id": 1}
+            })
+        })
+        with mock.patch.object(export, "stream", stream), \
+                mock.patch.object(web.StreamResponse, "write", write):
+            await self.client.get(self.app.router["export-messages"].url_for())
+        self.assertEqual(closed, [True])
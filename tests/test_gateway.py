@@ -1,6 +1,7 @@
 """
 Модульные тесты для класса шлюза
 """
+import typing
 import unittest
 import asyncio
 from unittest import mock
@@ -36,7 +37,7 @@ class GatewayTestCase(BaseTestCase):
 
     def setUp(self) -> None:
         super().setUp()
-        self.loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
         database.Base.metadata.drop_all(database.engine())
         database.Base.metadata.create_all(database.engine())
 
@@ -50,10 +51,25 @@ class GatewayTestCase(BaseTestCase):
 
     def tearDown(self) -> None:
         super().tearDown()
+        self.loop.close()
         database.ScopedAppSession.commit()
         database.ScopedAppSession.remove()
         database.Base.metadata.drop_all(database.engine())
 
+    def test_parse_message_required(self):
+        """
+        Шлюз без схемы, не реализующий parse_message, нельзя создать
+        """
+        class NoParserGateway(Gateway):
+            def send_message(self, message):
+                pass
+
+            def get_channel(self):
+                return Channel.WHATSAPP
+
+        with self.assertRaises(TypeError):
+            NoParserGateway(mock.MagicMock(), mock.MagicMock())
+
     def test_handle_message_without_dialog(self):
         """
         В случае, когда сообщение еще не привязано ни к одному диалогу, то метод
@@ -103,3 +119,34 @@ class GatewayTestCase(BaseTestCase):
             )  # type: database.Message
             self.assertEqual(message.dialog, dialog)
             self.assertEqual(dialog.messages[0], message)
+
+    def test_handle_messages(self):
+        """
+        Пакет сообщений раскладывается по диалогам, для новых номеров
+        создаются клиенты и диалоги
+        """
+        customer = database.Customer(name="Example", phone_number="+7001")
+        session = database.ScopedAppSession()  # type: Session
+        session.add(database.Dialog(customer=customer))
+        session.commit()
+
+        raw_messages = [
+            Message("+7001", "first"), Message("+7002", "second", "New"),
+            Message("+7001", "third")
+        ]
+        with mock.patch.object(
+                self.gateway, 'parse_messages', return_value=raw_messages,
+                new_callable=AsyncMock
+        ):
+            messages = self.loop.run_until_complete(
+                self.gateway.handle_messages(self.request_mock)
+            )  # type: typing.List[database.Message]
+
+        self.assertEqual([m.text for m in messages],
+                         ["first", "second", "third"])
+        self.assertIs(messages[0].dialog, messages[2].dialog)
+        self.assertEqual(messages[0].dialog.customer, customer)
+        self.assertEqual([m.seq for m in messages], [1, 1, 2])
+        self.assertEqual(messages[1].dialog.customer.name, "New")
+        self.assertEqual(session.query(database.Dialog).count(), 2)
+        self.assertEqual(session.query(database.Message).count(), 3)
@@ -2,9 +2,11 @@
 Тестовые кейсы для хука, взаимодействующего с провайдером. Здесь не тестируется
 конкретная реализация, только общий интерфейс
 """
+import datetime
+
 from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
 from aiohttp.web_app import Application
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from oneweb_helpdesk_chat import storage
 from oneweb_helpdesk_chat.gateways import repository
@@ -22,12 +24,18 @@ class GatewayHookTestCase(AioHTTPTestCase, BaseTestCase):
 
     def setUp(self) -> None:
         super().setUp()
-        self.dialog = storage.Dialog(id=1)
+        self.dialog = storage.Dialog(
+            id=1, customer=storage.Customer(id=1, name="Customer")
+        )
 
         self.gateway_stub = MagicMock()
-        self.gateway_stub.handle_message = AsyncMock(
-            return_value=storage.Message(dialog=self.dialog)
-        )
+        self.gateway_stub.handle_messages = AsyncMock(return_value=[
+            storage.Message(
+                dialog=self.dialog, seq=seq,
+                created_at=datetime.datetime(2020, 1, 1)
+            )
+            for seq in (1, 2)
+        ])
 
         repository.register_gateway("example", self.gateway_stub)
 
@@ -41,8 +49,31 @@ class GatewayHookTestCase(AioHTTPTestCase, BaseTestCase):
         Простейший тестовый кейс. Хук должен вызывать требуемый gateway из
         репозитория с необходимыми параметрами
         """
-        await self.client.request(
-            "GET",
-            self.app.router["gateway-hook"].url_for(gateway_alias="example")
+        from oneweb_helpdesk_chat import app
+        with patch.object(app.connection_registry, "publish_event") as event:
+            response = await self.client.request(
+                "GET",
+                self.app.router["gateway-hook"].url_for(
+                    gateway_alias="example"
+                ),
+                headers={"X-Request-Id": "request-1"}
+            )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers["X-Request-Id"], "request-1")
+        self.gateway_stub.handle_messages.assert_called()
+        # уведомление о диалоге без ответственного одно на диалог
+        event.assert_called_once()
+
+    @unittest_run_loop
+    async def test_unknown_gateway(self):
+        """
+        Запрос к незарегистрированному шлюзу получает 404
+        """
+        response = await self.client.request(
+            "POST",
+            self.app.router["gateway-hook"].url_for(gateway_alias="unknown"),
+            data=b"{}"
         )
-        self.gateway_stub.handle_message.assert_called()
+        self.assertEqual(response.status, 404)
+        # идентификатор корреляции возвращается и в ответах с ошибкой
+        self.assertTrue(response.headers["X-Request-Id"])
@@ -0,0 +1,167 @@
+"""
+Тесты для репозитория шлюзов
+"""
+import asyncio
+import json
+import os
+import tempfile
+from unittest import mock
+
+from oneweb_helpdesk_chat import gateways
+from oneweb_helpdesk_chat.gateways import (
+    Gateway, GatewayConfig, GatewayNotFound, Repository
+)
+from oneweb_helpdesk_chat.storage.domain import Channel
+from tests.utils import BaseTestCase
+
+
+class DummyGateway(Gateway):
+    """
+    Шлюз, отправка сообщений которым завершается по событию release
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.release = asyncio.Event()
+        self.stopped = False
+
+    async def stop(self, timeout: float = 30):
+        await super().stop(timeout)
+        self.stopped = True
+
+    def get_channel(self):
+        return Channel.WHATSAPP
+
+    async def parse_message(self, request):
+        pass
+
+    async def send_message(self, message):
+        await self.release.wait()
+
+
+class FailingGateway(DummyGateway):
+    """
+    Шлюз, который не удается запустить
+    """
+
+    async def start(self):
+        raise RuntimeError("start failed")
+
+
+def dummy_config(**kwargs) -> GatewayConfig:
+    return GatewayConfig(
+        "tests.test_gateway_registry.DummyGateway", **kwargs
+    )
+
+
+class RepositoryTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.gateways.Repository`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.repository = Repository()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.run_until_complete(self.repository.stop())
+        self.loop.close()
+
+    def test_alias_validation(self):
+        """
+        Псевдоним с пробельными символами или пустой не регистрируется
+        """
+        for alias in ("", "what sapp", "whatsapp\n", "a/b"):
+            with self.assertRaises(ValueError):
+                self.repository.register_gateway(alias, mock.MagicMock())
+        self.repository.register_gateway("whatsapp-2.test", mock.MagicMock())
+
+    def test_not_found(self):
+        with self.assertRaises(GatewayNotFound):
+            self.repository.get_gateway("unknown")
+
+    def test_hot_reload(self):
+        """
+        При изменении настроек шлюз пересоздается, а старый экземпляр
+        останавливается только после завершения начатой отправки
+        """
+        self.loop.run_until_complete(
+            self.repository.load({"dummy": dummy_config()})
+        )
+        old = self.repository.get_gateway("dummy")
+        self.assertIsNotNone(old.http)
+        sending = self.loop.create_task(old.send(mock.MagicMock()))
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        reload = self.loop.create_task(self.repository.load(
+            {"dummy": dummy_config(connection_limit=5)}
+        ))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        new = self.repository.get_gateway("dummy")
+        self.assertIsNot(new, old)
+        self.assertEqual(new.config.connection_limit, 5)
+        self.assertFalse(old.stopped)
+
+        old.release.set()
+        self.loop.run_until_complete(asyncio.gather(sending, reload))
+        self.assertTrue(old.stopped)
+        self.assertEqual(old.in_flight, 0)
+
+        self.loop.run_until_complete(self.repository.load({}))
+        self.assertTrue(new.stopped)
+        with self.assertRaises(GatewayNotFound):
+            self.repository.get_gateway("dummy")
+
+    def test_reload_failure(self):
+        """
+        Если один из шлюзов не запустился, то уже запущенные новые шлюзы
+        останавливаются, а прежние настройки и шлюзы остаются на месте
+        """
+        self.loop.run_until_complete(
+            self.repository.load({"dummy": dummy_config()})
+        )
+        old = self.repository.get_gateway("dummy")
+        configs = {
+            "dummy": dummy_config(connection_limit=5),
+            "extra": dummy_config(),
+            "failing": GatewayConfig(
+                "tests.test_gateway_registry.FailingGateway"
+            ),
+        }
+        created = []
+        create_gateway = self.repository.create_gateway
+
+        def create(config):
+            created.append(create_gateway(config))
+            return created[-1]
+
+        with mock.patch.object(self.repository, "create_gateway", create), \
+                self.assertRaises(RuntimeError):
+            self.loop.run_until_complete(self.repository.load(configs))
+
+        self.assertIs(self.repository.get_gateway("dummy"), old)
+        self.assertFalse(old.stopped)
+        self.assertEqual(self.repository.configs, {"dummy": dummy_config()})
+        with self.assertRaises(GatewayNotFound):
+            self.repository.get_gateway("extra")
+        self.assertEqual(len(created), 3)
+        self.assertTrue(all(gateway.stopped for gateway in created))
+
+    def test_read_config(self):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as config_file:
+            json.dump({"dummy": {
+                "class": "tests.test_gateway_registry.DummyGateway",
+                "endpoint": "http://localhost/", "connection_limit": 3
+            }}, config_file)
+        try:
+            configs = gateways.read_config(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(
+            configs,
+            {"dummy": dummy_config(endpoint="http://localhost/",
+                                   connection_limit=3)}
+        )
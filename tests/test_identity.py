@@ -0,0 +1,174 @@
+"""
+Тесты для идентификации клиентов
+"""
+import asyncio
+from unittest import mock
+
+from sqlalchemy.orm import Session
+
+from oneweb_helpdesk_chat.gateways import Message
+from oneweb_helpdesk_chat.storage import database, identity
+from oneweb_helpdesk_chat.storage.domain import Channel, Identity
+from tests.test_gateway import TestGateway
+from tests.utils import BaseTestCase
+
+
+class NormalizePhoneTestCase(BaseTestCase):
+    """
+    Тесты для :func:`oneweb_helpdesk_chat.storage.identity.normalize_phone`
+    """
+
+    def test_normalize(self):
+        for phone_number in ("+7 (987) 654-32-10", "89876543210",
+                             "9876543210", "79876543210", "0079876543210"):
+            self.assertEqual(
+                identity.normalize_phone(phone_number), "+79876543210"
+            )
+        self.assertEqual(
+            identity.normalize_phone("2025550123", "1"), "+12025550123"
+        )
+        # неразбираемые номера не изменяются
+        self.assertEqual(identity.normalize_phone("+7001"), "+7001")
+        self.assertEqual(identity.normalize_phone("abc"), "abc")
+
+
+class IdentityIndexTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.storage.identity.IdentityIndex`
+    """
+
+    def test_bloom_filter(self):
+        bloom = identity.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(str(i))
+        self.assertTrue(all(str(i) in bloom for i in range(1000)))
+        false_positives = sum(
+            str(i) in bloom for i in range(1000, 11000)
+        )
+        self.assertLess(false_positives, 300)
+
+    def test_might_exist(self):
+        index = identity.IdentityIndex(100, 0.01)
+        known = Identity.phone("+79876543210")
+        added = Identity(Channel.VIBER.value, "42")
+        unknown = Identity.phone("+70000000000")
+        # пока индекс не загружен, известным считается любой идентификатор
+        self.assertTrue(index.might_exist(unknown))
+
+        bloom = index.build([known])
+        index.add(added)
+        index.install(bloom)
+        self.assertTrue(index.might_exist(known))
+        self.assertTrue(index.might_exist(added))
+        self.assertFalse(index.might_exist(unknown))
+
+
+class ResolveTestCase(BaseTestCase):
+    """
+    Тесты для поиска клиентов и диалогов по идентификаторам
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        database.Base.metadata.drop_all(database.engine())
+        database.Base.metadata.create_all(database.engine())
+        database.ScopedAppSession.configure(bind=database.engine())
+        self.index = identity.IdentityIndex(100, 0.01)
+        self.customers = database.CustomerRepository(
+            identity_index=self.index
+        )
+        self.dialogs = database.DialogRepository(identity_index=self.index)
+        self.gateway = TestGateway(
+            customer_repository=self.customers,
+            dialog_repository=self.dialogs
+        )
+
+        self.phone_customer = database.Customer(
+            name="Phone", phone_number="+79876543210"
+        )
+        self.alias_customer = database.Customer(
+            name="Alias", aliases=[database.CustomerAlias(
+                channel=Channel.VIBER.value, external_id="42"
+            )]
+        )
+        session = database.ScopedAppSession()  # type: Session
+        session.add_all([
+            database.Dialog(customer=self.phone_customer),
+            database.Dialog(customer=self.alias_customer),
+        ])
+        session.commit()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+        database.ScopedAppSession.commit()
+        database.ScopedAppSession.remove()
+        database.Base.metadata.drop_all(database.engine())
+
+    def test_resolve(self):
+        phone = Identity.phone("+79876543210")
+        alias = Identity(Channel.VIBER.value, "42")
+        unknown = Identity(Channel.VIBER.value, "43")
+        customers = self.loop.run_until_complete(
+            self.customers.resolve([phone, alias, unknown])
+        )
+        self.assertEqual(customers, {
+            phone: self.phone_customer, alias: self.alias_customer
+        })
+        dialogs = self.loop.run_until_complete(
+            self.dialogs.get_by_identities([phone, alias, unknown])
+        )
+        self.assertEqual(
+            {key: dialog.customer for key, dialog in dialogs.items()},
+            customers
+        )
+
+    def test_index_skips_queries(self):
+        """
+        Загруженный индекс отсекает неизвестные идентификаторы без запросов
+        к бд
+        """
+        self.loop.run_until_complete(self.customers.load_identity_index())
+        with mock.patch.object(database, "fetch_results") as fetch:
+            customers = self.loop.run_until_complete(self.customers.resolve(
+                [Identity.phone("+70000000000")]
+            ))
+        self.assertEqual(customers, {})
+        fetch.assert_not_called()
+
+    def test_conflict_retry(self):
+        """
+        Клиент, которого нет в индексе, но есть в бд(создан другим процессом
+        после загрузки индекса), находится повторным поиском без индекса
+        """
+        self.index.install(self.index.build([]))
+        raw_messages = [Message("8 987 654-32-10", "hi")]
+        message, = self.loop.run_until_complete(
+            self.gateway.ingest_messages(raw_messages)
+        )
+        self.assertEqual(message.dialog.customer, self.phone_customer)
+        session = database.ScopedAppSession()  # type: Session
+        self.assertEqual(session.query(database.Customer).count(), 2)
+
+    def test_alias_customer(self):
+        """
+        Клиенты каналов без номеров телефонов создаются с алиасом
+        """
+        self.gateway.identify = lambda raw_message: Identity(
+            Channel.VIBER.value, raw_message.phone_number
+        )
+        first, second = self.loop.run_until_complete(
+            self.gateway.ingest_messages([
+                Message("42", "known"), Message("100", "new", "New")
+            ])
+        )
+        self.assertEqual(first.dialog.customer, self.alias_customer)
+        customer = second.dialog.customer
+        self.assertIsNone(customer.phone_number)
+        self.assertEqual(
+            customer.identities(), [Identity(Channel.VIBER.value, "100")]
+        )
+        self.assertTrue(self.index.might_exist(
+            Identity(Channel.VIBER.value, "100")
+        ))
@@ -0,0 +1,239 @@
+"""
+Тесты для списка диалогов(инбокса)
+"""
+import asyncio
+import datetime
+
+from oneweb_helpdesk_chat import inbox
+from oneweb_helpdesk_chat.storage import database
+from oneweb_helpdesk_chat.storage.domain import Channel, DialogState
+from tests.utils import BaseTestCase
+
+
+class InboxTestCase(BaseTestCase):
+    """
+    Тесты для метода
+    :meth:`oneweb_helpdesk_chat.storage.database.DialogRepository.get_inbox`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        database.Base.metadata.drop_all(database.engine())
+        database.Base.metadata.create_all(database.engine())
+        database.ScopedAppSession.configure(bind=database.engine())
+
+        self.repository = database.DialogRepository()
+        self.user = database.User(name="User", login="user", password="")
+        session = database.ScopedAppSession()
+        session.add(self.user)
+
+        self.dialogs = []
+        started_at = datetime.datetime(2020, 1, 1)
+        for i in range(3):
+            dialog = database.Dialog(customer=database.Customer(
+                name="Customer {}".format(i), phone_number="+7{}".format(i)
+            ))
+            for j in range(i + 1):
+                dialog.add_message(database.Message(
+                    channel=Channel.WHATSAPP, text="text",
+                    created_at=started_at + datetime.timedelta(
+                        minutes=i * 10 + j
+                    )
+                ))
+            session.add(dialog)
+            self.dialogs.append(dialog)
+        session.commit()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+        database.ScopedAppSession.commit()
+        database.ScopedAppSession.remove()
+        database.Base.metadata.drop_all(database.engine())
+
+    def test_sorted_by_last_message(self):
+        """
+        Диалоги должны быть отсортированы по времени последнего сообщения, а
+        счетчик непрочитанных равен количеству входящих сообщений
+        """
+        items = self.loop.run_until_complete(
+            self.repository.get_inbox(self.user.id)
+        )
+        self.assertEqual(
+            [dialog for dialog, _ in items], list(reversed(self.dialogs))
+        )
+        self.assertEqual([unread for _, unread in items], [3, 2, 1])
+        self.assertEqual(items[0][0].last_message.text, "text")
+
+    def test_pagination(self):
+        """
+        Следующая страница должна начинаться сразу после курсора
+        """
+        first_page = self.loop.run_until_complete(
+            self.repository.get_inbox(self.user.id, limit=2)
+        )
+        cursor = inbox.encode_cursor(first_page[-1][0])
+        second_page = self.loop.run_until_complete(
+            self.repository.get_inbox(
+                self.user.id, limit=2, before=inbox.decode_cursor(cursor)
+            )
+        )
+        self.assertEqual(
+            [dialog for dialog, _ in second_page], self.dialogs[:1]
+        )
+
+    def test_mark_read(self):
+        """
+        После прочтения диалога счетчик непрочитанных сбрасывается только для
+        прочитавшего пользователя
+        """
+        self.loop.run_until_complete(
+            self.repository.mark_read(self.dialogs[2], self.user.id)
+        )
+        items = self.loop.run_until_complete(
+            self.repository.get_inbox(self.user.id, limit=1)
+        )
+        self.assertEqual(items[0][1], 0)
+
+        items = self.loop.run_until_complete(
+            self.repository.get_inbox(self.user.id + 1, limit=1)
+        )
+        self.assertEqual(items[0][1], 3)
+
+    def test_mark_read_many(self):
+        """
+        Пачка отметок о прочтении создает новые состояния прочтения и
+        обновляет существующие, неизвестные диалоги пропускаются
+        """
+        self.loop.run_until_complete(
+            self.repository.mark_read(self.dialogs[2], self.user.id)
+        )
+        session = database.ScopedAppSession()
+        self.dialogs[2].add_message(database.Message(
+            channel=Channel.WHATSAPP, text="text",
+            created_at=datetime.datetime(2020, 1, 2)
+        ))
+        session.commit()
+
+        self.loop.run_until_complete(self.repository.mark_read_many({
+            (self.dialogs[2].id, self.user.id),
+            (self.dialogs[1].id, self.user.id),
+            (self.dialogs[2].id, self.user.id + 1),
+            (1000, self.user.id),
+        }))
+        items = self.loop.run_until_complete(
+            self.repository.get_inbox(self.user.id)
+        )
+        self.assertEqual([unread for _, unread in items], [0, 0, 1])
+        items = self.loop.run_until_complete(
+            self.repository.get_inbox(self.user.id + 1, limit=1)
+        )
+        self.assertEqual(items[0][1], 0)
+
+    def test_transfer(self):
+        """
+        Передача меняет пользователя диалога и пишется в журнал, передача с
+        устаревшим ожидаемым пользователем и передача закрытого диалога не
+        выполняются
+        """
+        dialog = self.dialogs[0]
+        self.loop.run_until_complete(
+            self.repository.transfer(dialog, self.user, self.user.id, None)
+        )
+        self.assertEqual(dialog.assigned_user_id, self.user.id)
+        self.assertIs(dialog.assigned_user, self.user)
+        with self.assertRaises(database.AssignmentConflict):
+            self.loop.run_until_complete(
+                self.repository.transfer(dialog, None, self.user.id, None)
+            )
+        self.loop.run_until_complete(
+            self.repository.transfer(dialog, None, self.user.id)
+        )
+        self.assertIsNone(dialog.assigned_user)
+        items = self.loop.run_until_complete(self.repository.get_inbox(
+            self.user.id, assigned_user_id=self.user.id
+        ))
+        self.assertEqual(items, [])
+
+        assignments = self.loop.run_until_complete(
+            self.repository.get_assignments(dialog.id)
+        )
+        self.assertEqual(
+            [(a.from_user_id, a.to_user_id) for a in assignments],
+            [(None, self.user.id), (self.user.id, None)]
+        )
+        self.assertEqual(
+            inbox.assignment_summary(assignments[0])["changed_by_user_id"],
+            self.user.id
+        )
+
+        self.loop.run_until_complete(self.repository.close(dialog))
+        with self.assertRaises(database.AssignmentConflict):
+            self.loop.run_until_complete(
+                self.repository.transfer(dialog, self.user, self.user.id)
+            )
+
+    def test_close_inactive(self):
+        """
+        Неактивные диалоги закрываются, пропадают из списка незакрытых и из
+        поиска диалога клиента
+        """
+        closed_ids = self.loop.run_until_complete(
+            self.repository.close_inactive(
+                datetime.datetime(2020, 1, 1, 0, 15)
+            )
+        )
+        self.assertEqual(
+            sorted(closed_ids), [self.dialogs[0].id, self.dialogs[1].id]
+        )
+        items = self.loop.run_until_complete(
+            self.repository.get_inbox(self.user.id)
+        )
+        self.assertEqual([dialog for dialog, _ in items], self.dialogs[2:])
+        items = self.loop.run_until_complete(
+            self.repository.get_inbox(self.user.id, closed=True)
+        )
+        self.assertEqual(
+            [dialog.state for dialog, _ in items], [DialogState.CLOSED] * 2
+        )
+        dialogs = self.loop.run_until_complete(
+            self.repository.get_by_phones(["+70", "+72"])
+        )
+        self.assertEqual(list(dialogs), ["+72"])
+        # ответ техподдержки снова открывает диалог
+        dialog = self.dialogs[0]
+        dialog.add_message(database.Message(
+            channel=Channel.WHATSAPP, text="reply", user_id=self.user.id
+        ))
+        self.assertEqual(dialog.state, DialogState.PENDING)
+        self.assertIsNone(dialog.closed_at)
+
+    def test_concurrent_messages(self):
+        """
+        Сообщения, сохраненные в один диалог из разных сессий, загрузивших
+        одинаковую сводку, получают разные порядковые номера, а счетчик
+        входящих учитывает все сообщения
+        """
+        dialog_id = self.dialogs[1].id
+        sessions = [database.AppSession(bind=database.engine())
+                    for _ in range(2)]
+        dialogs = [
+            session.query(database.Dialog).get(dialog_id)
+            for session in sessions
+        ]
+        messages = []
+        for session, dialog in zip(sessions, dialogs):
+            message = database.Message(channel=Channel.WHATSAPP, text="text")
+            dialog.add_message(message)
+            session.commit()
+            messages.append(message)
+        self.assertEqual([message.seq for message in messages], [3, 4])
+
+        session = database.ScopedAppSession()
+        session.expire_all()
+        dialog = session.query(database.Dialog).get(dialog_id)
+        self.assertEqual(dialog.last_seq, 4)
+        self.assertEqual(dialog.incoming_messages_count, 4)
+        for session in sessions:
+            session.close()
@@ -0,0 +1,182 @@
+"""
+Тесты для ограничения частоты запросов и контроля нагрузки
+"""
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import (
+    AioHTTPTestCase, unittest_run_loop, make_mocked_request
+)
+from aiohttp.web_app import Application
+
+from oneweb_helpdesk_chat import limits
+from tests.utils import BaseTestCase
+
+
+class RateLimiterTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.limits.RateLimiter`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.now = 0.0
+        self.limiter = limits.RateLimiter(
+            "test", rate=1, burst=2, max_keys=2, clock=lambda: self.now
+        )
+
+    def test_acquire(self):
+        """
+        После исчерпания всплеска токены пополняются со скоростью rate
+        """
+        self.assertEqual(self.limiter.acquire("a"), 0)
+        self.assertEqual(self.limiter.acquire("a"), 0)
+        self.assertEqual(self.limiter.acquire("a"), 1)
+        self.assertEqual(self.limiter.acquire("b"), 0)
+
+        self.now += 1.5
+        self.assertEqual(self.limiter.acquire("a"), 0)
+
+    def test_check(self):
+        """
+        При превышении лимита выбрасывается 429 и увеличивается счетчик
+        """
+        shed = limits.shed_counter.get(reason="test")
+        self.limiter.check("a", cost=2)
+        with self.assertRaises(web.HTTPTooManyRequests) as context:
+            self.limiter.check("a")
+        self.assertEqual(context.exception.headers["Retry-After"], "1")
+        self.assertEqual(limits.shed_counter.get(reason="test"), shed + 1)
+
+    def test_split(self):
+        """
+        Лимит делится между воркерами, но всплеск не меньше одного запроса
+        """
+        limiter = limits.RateLimiter("test", rate=10, burst=5)
+        limiter.split(4)
+        self.assertEqual((limiter.rate, limiter.burst), (2.5, 1.25))
+        limiter.split(8)
+        self.assertEqual((limiter.rate, limiter.burst), (1.25, 1))
+        limiter.split(1)
+        self.assertEqual((limiter.rate, limiter.burst), (10, 5))
+
+        # нулевой лимит остается нулевым
+        limiter = limits.RateLimiter("test", rate=0, burst=0)
+        limiter.split(4)
+        self.assertEqual(limiter.burst, 0)
+
+    def test_eviction(self):
+        """
+        Количество хранимых ведер ограничено, вытесняются давно не
+        обращавшиеся
+        """
+        for key in ("a", "b", "a", "c"):
+            self.limiter.acquire(key)
+        self.assertEqual(list(self.limiter.buckets), ["a", "c"])
+
+
+class ClientAddressResolverTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.limits.ClientAddressResolver`
+    """
+
+    def make_request(self, remote: str, forwarded: str = None):
+        headers = {"X-Forwarded-For": forwarded} if forwarded else {}
+        request = make_mocked_request("GET", "/", headers=headers)
+        return request.clone(remote=remote)
+
+    def test_untrusted(self):
+        """
+        Заголовок от недоверенного источника игнорируется
+        """
+        resolver = limits.ClientAddressResolver(["10.0.0.0/8"])
+        self.assertEqual(
+            resolver.resolve(self.make_request("1.2.3.4", "5.6.7.8")),
+            "1.2.3.4"
+        )
+        self.assertEqual(
+            limits.ClientAddressResolver().resolve(
+                self.make_request("10.0.0.1", "5.6.7.8")
+            ),
+            "10.0.0.1"
+        )
+
+    def test_trusted_proxy(self):
+        """
+        За доверенными прокси адресом клиента считается самый правый
+        недоверенный адрес заголовка
+        """
+        resolver = limits.ClientAddressResolver(["10.0.0.0/8"])
+        self.assertEqual(
+            resolver.resolve(self.make_request(
+                "10.0.0.1", "9.9.9.9, 5.6.7.8, 10.0.0.2"
+            )),
+            "5.6.7.8"
+        )
+        self.assertEqual(
+            resolver.resolve(self.make_request("10.0.0.1")), "10.0.0.1"
+        )
+
+
+class AdmissionControllerTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.limits.AdmissionController`
+    """
+
+    def test_overloaded(self):
+        backlog, pool_usage = 0, 0.0
+        controller = limits.AdmissionController(
+            lambda: backlog, lambda: pool_usage, max_backlog=10,
+            max_pool_usage=0.9
+        )
+        controller.check()
+
+        backlog, pool_usage = 6, 0.5
+        self.assertFalse(controller.overloaded())
+        pool_usage = 1
+        self.assertTrue(controller.overloaded())
+        backlog, pool_usage = 11, 0
+        with self.assertRaises(web.HTTPServiceUnavailable):
+            controller.check()
+
+
+class LoginRateLimitTestCase(AioHTTPTestCase, BaseTestCase):
+    """
+    Попытки логина сверх лимита отклоняются до обращения к бд
+    """
+
+    async def get_application(self) -> Application:
+        from oneweb_helpdesk_chat import app
+        self.app_module = app
+        return await app.make_app()
+
+    @unittest_run_loop
+    async def test_login_limited(self):
+        limiter = limits.RateLimiter("login", rate=0, burst=0)
+        with mock.patch.object(self.app_module, "login_limiter", limiter):
+            response = await self.client.post(
+                self.app.router["login"].url_for(),
+                data={"login": "user", "password": "password"}
+            )
+        self.assertEqual(response.status, 429)
+
+    @unittest_run_loop
+    async def test_login_ip_limiter(self):
+        """
+        Ведро ip логина не зависит от трафика хука шлюзов
+        """
+        gateway_ip_limiter = limits.RateLimiter("gateway_ip", rate=0, burst=0)
+        login_ip_limiter = limits.RateLimiter("login_ip", rate=0, burst=1)
+        with mock.patch.multiple(
+                self.app_module, gateway_ip_limiter=gateway_ip_limiter,
+                login_ip_limiter=login_ip_limiter,
+                login_limiter=limits.RateLimiter("login", rate=0, burst=0)
+        ):
+            response = await self.client.post(
+                self.app.router["login"].url_for(),
+                data={"login": "user", "password": "password"}
+            )
+        # запрос прошел ограничение по ip и отклонен ограничением по логину
+        self.assertEqual(response.status, 429)
+        self.assertEqual(len(login_ip_limiter.buckets), 1)
+        self.assertFalse(gateway_ip_limiter.buckets)
@@ -0,0 +1,74 @@
+"""
+Тесты для структурированного логгирования
+"""
+import io
+import json
+import logging
+
+from oneweb_helpdesk_chat import logs
+from tests.utils import BaseTestCase
+
+
+class LogsTestCase(BaseTestCase):
+    """
+    Тесты для :mod:`oneweb_helpdesk_chat.logs`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.stream = io.StringIO()
+        logs.setup(level="DEBUG", path="", stream=self.stream)
+        self.logger = logs.get_logger("oneweb_helpdesk_chat.tests")
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        logs.shutdown()
+        logger = logging.getLogger(logs.ROOT_LOGGER)
+        logger.handlers.clear()
+        logger.setLevel(logging.NOTSET)
+        logger.propagate = True
+
+    def records(self) -> list:
+        # записи дописываются фоновым потоком при остановке
+        logs.shutdown()
+        return [
+            json.loads(line) for line in self.stream.getvalue().splitlines()
+        ]
+
+    def test_fields(self):
+        """
+        Поля записи и идентификатор корреляции попадают в json
+        """
+        token = logs.correlation_id.set("abc")
+        try:
+            self.logger.info("message.delivered", dialog_id="1", seq=2)
+        finally:
+            logs.correlation_id.reset(token)
+        self.logger.warning("no.correlation")
+        first, second = self.records()
+        self.assertEqual(first["event"], "message.delivered")
+        self.assertEqual(first["level"], "INFO")
+        self.assertEqual(first["correlation_id"], "abc")
+        self.assertEqual((first["dialog_id"], first["seq"]), ("1", 2))
+        self.assertNotIn("correlation_id", second)
+
+    def test_exception(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            self.logger.exception("failed")
+        record, = self.records()
+        self.assertIn("ValueError: boom", record["exc_info"])
+
+    def test_sampling(self):
+        """
+        При доле 0 отладочные события не пишутся, при доле 1 -- пишутся все
+        """
+        never = logs.get_logger("oneweb_helpdesk_chat.tests", sample_rate=0)
+        always = logs.get_logger("oneweb_helpdesk_chat.tests", sample_rate=1)
+        for i in range(10):
+            never.debug_sampled("never", i=i)
+            always.debug_sampled("always", i=i)
+        records = self.records()
+        self.assertEqual([r["i"] for r in records], list(range(10)))
+        self.assertTrue(all(r["sample_rate"] == 1 for r in records))
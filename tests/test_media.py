@@ -0,0 +1,225 @@
+"""
+Тесты для вложений сообщений
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.web_app import Application
+
+from oneweb_helpdesk_chat import storage
+from oneweb_helpdesk_chat.gateways import MediaReference, Message
+from oneweb_helpdesk_chat.storage import database, media
+from tests.test_gateway import TestGateway
+from tests.utils import BaseTestCase
+
+
+async def stream(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+class MediaGateway(TestGateway):
+    """
+    Шлюз, отдающий вложение фрагментами по его идентификатору
+    """
+    contents = {"voice": [b"OggS", b"-voice"]}
+
+    async def fetch_media(self, media_: MediaReference):
+        for chunk in self.contents[media_.media_id]:
+            yield chunk
+
+
+class MediaStoreTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.storage.media.MediaStore`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = media.MediaStore(self.directory.name, max_size=10)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+        self.directory.cleanup()
+
+    def save(self, *chunks: bytes, **kwargs) -> storage.Attachment:
+        return self.loop.run_until_complete(
+            self.store.save(stream(*chunks), **kwargs)
+        )
+
+    def test_save(self):
+        """
+        Вложение сохраняется по хешу содержимого, одинаковое содержимое
+        хранится один раз
+        """
+        first = self.save(b"abc", b"def", content_type="image/jpeg; q=1")
+        second = self.save(b"abcdef", content_type="image/jpeg",
+                           filename="photo.jpg")
+
+        self.assertEqual(
+            first, (hashlib.sha256(b"abcdef").hexdigest(), "image/jpeg", 6,
+                    None)
+        )
+        self.assertEqual(second.sha256, first.sha256)
+        self.assertEqual(media.key(first), first.sha256 + ".jpg")
+        with open(self.store.path(media.key(first)), "rb") as media_file:
+            self.assertEqual(media_file.read(), b"abcdef")
+        self.assertEqual(
+            os.listdir(os.path.join(self.directory.name, "tmp")), []
+        )
+
+    def test_too_large(self):
+        with self.assertRaises(storage.MediaTooLarge):
+            self.save(b"abcdef", b"ghijkl")
+        self.assertEqual(
+            os.listdir(os.path.join(self.directory.name, "tmp")), []
+        )
+
+    @unittest.skipIf(media.Image is None, "Pillow is not installed")
+    def test_thumbnail(self):
+        image = media.Image.new("RGB", (1000, 500))
+        path = os.path.join(self.directory.name, "image.png")
+        image.save(path)
+        with open(path, "rb") as image_file:
+            attachment = self.loop.run_until_complete(media.MediaStore(
+                self.directory.name
+            ).save(stream(image_file.read()), content_type="image/png"))
+
+        thumbnail = self.loop.run_until_complete(
+            self.store.thumbnail(media.key(attachment))
+        )
+        with media.Image.open(thumbnail) as image:
+            self.assertEqual(image.size, (320, 160))
+
+
+class MediaIngestTestCase(BaseTestCase):
+    """
+    Тесты для скачивания вложений шлюзом
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.TemporaryDirectory()
+        database.Base.metadata.drop_all(database.engine())
+        database.Base.metadata.create_all(database.engine())
+        database.ScopedAppSession.configure(bind=database.engine())
+        self.gateway = MediaGateway(
+            customer_repository=database.CustomerRepository(),
+            dialog_repository=database.DialogRepository(),
+            media_store=media.MediaStore(self.directory.name)
+        )
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+        self.directory.cleanup()
+        database.ScopedAppSession.commit()
+        database.ScopedAppSession.remove()
+        database.Base.metadata.drop_all(database.engine())
+
+    def test_ingest(self):
+        """
+        Вложение скачивается до сохранения сообщения, сообщение, вложение
+        которого скачать не удалось, сохраняется без вложения
+        """
+        voice, broken = self.loop.run_until_complete(
+            self.gateway.ingest_messages([
+                Message("+7001", "", media=MediaReference(
+                    "voice", "audio/ogg; codecs=opus"
+                )),
+                Message("+7001", "caption", media=MediaReference("missing")),
+            ])
+        )
+        database.ScopedAppSession.expire_all()
+
+        self.assertEqual(voice.attachment, storage.Attachment(
+            hashlib.sha256(b"OggS-voice").hexdigest(), "audio/ogg", 10
+        ))
+        self.assertIsNone(broken.attachment)
+        self.assertEqual(broken.text, "caption")
+        self.assertTrue(os.path.exists(
+            self.gateway.media_store.path(media.key(voice.attachment))
+        ))
+
+    def test_unsupported(self):
+        """
+        Шлюз без поддержки вложений сохраняет сообщение без вложения
+        """
+        self.gateway = TestGateway(
+            customer_repository=database.CustomerRepository(),
+            dialog_repository=database.DialogRepository(),
+            media_store=media.MediaStore(self.directory.name)
+        )
+        message, = self.loop.run_until_complete(
+            self.gateway.ingest_messages([
+                Message("+7001", "caption", media=MediaReference("voice"))
+            ])
+        )
+        self.assertIsNone(message.attachment)
+        self.assertEqual(message.text, "caption")
+
+
+class MediaViewTestCase(AioHTTPTestCase, BaseTestCase):
+    """
+    Тесты для эндпоинта ``/media/{key}``
+    """
+
+    async def get_application(self) -> Application:
+        from oneweb_helpdesk_chat import app
+        return await app.make_app()
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(
+            storage, "_ms_instance", media.MediaStore(self.directory.name)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def login(self):
+        self.client.session.cookie_jar.update_cookies({
+            "AIOHTTP_SESSION": json.dumps({
+                "created": int(time.time()), "session": {"user_id": 1}
+            })
+        })
+
+    @unittest_run_loop
+    async def test_range(self):
+        attachment = await storage.default_media_store().save(
+            stream(b"0123456789"), content_type="image/png"
+        )
+        url = self.app.router["media"].url_for(key=media.key(attachment))
+        response = await self.client.get(url)
+        self.assertEqual(response.status, 401)
+
+        self.login()
+        response = await self.client.get(url, headers={"Range": "bytes=2-4"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(await response.read(), b"234")
+        self.assertEqual(response.content_type, "image/png")
+
+        response = await self.client.get(
+            self.app.router["media"].url_for(key="0" * 64)
+        )
+        self.assertEqual(response.status, 404)
+        response = await self.client.get(
+            self.app.router["media-thumbnail"].url_for(key="0" * 64 + ".png")
+        )
+        self.assertEqual(response.status, 404)
+        response = await self.client.get(
+            self.app.router["media"].url_for(key="..")
+        )
+        self.assertEqual(response.status, 404)
@@ -0,0 +1,128 @@
+"""
+Тесты для хранилища в памяти
+"""
+import asyncio
+import datetime
+
+from oneweb_helpdesk_chat.gateways import Message
+from oneweb_helpdesk_chat.storage import database, memory
+from oneweb_helpdesk_chat.storage.domain import Channel, Identity
+from tests.test_gateway import TestGateway
+from tests.utils import BaseTestCase
+
+
+class MemoryRepositoriesTestCase(BaseTestCase):
+    """
+    Тесты для репозиториев :mod:`oneweb_helpdesk_chat.storage.memory`: без
+    бд шлюз сохраняет сообщения так же, как с бд
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.store = memory.MemoryStore()
+        self.users = memory.MemoryUserRepository(self.store)
+        self.customers = memory.MemoryCustomerRepository(self.store)
+        self.dialogs = memory.MemoryDialogRepository(self.store)
+        self.gateway = TestGateway(
+            customer_repository=self.customers,
+            dialog_repository=self.dialogs
+        )
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+
+    def ingest(self, *raw_messages):
+        return self.loop.run_until_complete(
+            self.gateway.ingest_messages(list(raw_messages))
+        )
+
+    def test_ingest(self):
+        first, second = self.ingest(
+            Message("+79876543210", "first", "Customer"),
+            Message("89876543210", "second")
+        )
+        self.assertIs(first.dialog, second.dialog)
+        self.assertEqual([first.id, second.id], [1, 2])
+        self.assertEqual(first.dialog_id, 1)
+        third, = self.ingest(Message("+79876543210", "third"))
+        self.assertIs(third.dialog, first.dialog)
+        self.assertEqual(third.seq, 3)
+
+        dialog = self.loop.run_until_complete(self.dialogs.get_by_id("1"))
+        self.assertIs(dialog, first.dialog)
+        self.assertEqual(dialog.customer.name, "Customer")
+        since = self.loop.run_until_complete(
+            self.dialogs.get_messages_since(1, 1, 10)
+        )
+        self.assertEqual([m.text for m in since], ["second", "third"])
+        history = self.loop.run_until_complete(
+            self.dialogs.get_history(dialog, limit=2, before_id=3)
+        )
+        self.assertEqual([m.text for m in history], ["second", "first"])
+
+    def test_identity_conflict(self):
+        self.ingest(Message("+79876543210", "first"))
+        duplicate = database.Dialog(customer=database.Customer(
+            name="Duplicate", phone_number="+79876543210"
+        ))
+        with self.assertRaises(database.IdentityConflict):
+            self.loop.run_until_complete(self.dialogs.save_all([duplicate]))
+        self.assertEqual(len(self.store.tables[database.Customer]), 1)
+
+        customer = self.loop.run_until_complete(
+            self.customers.get_by_phone("8 (987) 654-32-10")
+        )
+        alias = Identity(Channel.VIBER.value, "42")
+        self.loop.run_until_complete(self.customers.add_alias(customer, alias))
+        self.assertEqual(
+            self.loop.run_until_complete(self.customers.resolve([alias])),
+            {alias: customer}
+        )
+
+    def test_inbox(self):
+        user = database.User(name="User", login="user", password="")
+        self.loop.run_until_complete(self.users.save(user))
+        self.assertIs(
+            self.loop.run_until_complete(self.users.get_by_login("user")), user
+        )
+        self.ingest(Message("+7001", "a"), Message("+7002", "b"),
+                    Message("+7002", "c"))
+        items = self.loop.run_until_complete(self.dialogs.get_inbox(user.id))
+        self.assertEqual(
+            [(dialog.id, unread) for dialog, unread in items], [(2, 2), (1, 1)]
+        )
+        self.loop.run_until_complete(self.dialogs.mark_read(items[0][0], 1))
+        items = self.loop.run_until_complete(
+            self.dialogs.get_inbox(user.id, limit=1)
+        )
+        self.assertEqual(items[0][1], 0)
+
+        closed = self.loop.run_until_complete(self.dialogs.close_inactive(
+            datetime.datetime.now() + datetime.timedelta(seconds=1)
+        ))
+        self.assertEqual(sorted(closed), [1, 2])
+        self.assertEqual(
+            self.loop.run_until_complete(self.dialogs.get_by_phones(["+7001"])),
+            {}
+        )
+        # следующее сообщение клиента открывает новый диалог
+        message, = self.ingest(Message("+7001", "again"))
+        self.assertEqual(message.dialog.id, 3)
+        self.assertEqual(message.dialog.customer.id, 1)
+
+        self.loop.run_until_complete(
+            self.dialogs.transfer(message.dialog, user, user.id, None)
+        )
+        items = self.loop.run_until_complete(
+            self.dialogs.get_inbox(user.id, assigned_user_id=user.id)
+        )
+        self.assertEqual([dialog.id for dialog, _ in items], [3])
+        with self.assertRaises(database.AssignmentConflict):
+            self.loop.run_until_complete(
+                self.dialogs.transfer(items[0][0], None, user.id, None)
+            )
+        self.assertEqual(len(self.loop.run_until_complete(
+            self.dialogs.get_assignments(3)
+        )), 1)
@@ -0,0 +1,125 @@
+"""
+Тесты для декларативных схем тел запросов от сервисов
+"""
+import asyncio
+import os
+from unittest import mock
+
+from aiohttp import web
+
+from oneweb_helpdesk_chat.gateways import Message, WhatsappGateway
+from oneweb_helpdesk_chat.schema import Field, Schema, SchemaError
+from tests.utils import AsyncMock, BaseTestCase
+
+PAYLOADS_DIR = os.path.join(os.path.dirname(__file__), "payloads")
+
+
+def read_payload(name: str) -> bytes:
+    with open(os.path.join(PAYLOADS_DIR, name), "rb") as payload_file:
+        return payload_file.read()
+
+
+class SchemaTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.schema.Schema`
+    """
+
+    class Payload(Schema):
+        phone_number = Field("contact.phone", (str, int), convert=str)
+        text = Field("text")
+        user_name = Field("contact.name", default="")
+
+    def test_single(self):
+        """
+        Без пути к элементам все тело -- один элемент
+        """
+        self.assertEqual(
+            self.Payload.loads('{"contact": {"phone": 7}, "text": "hi"}'),
+            [{"phone_number": "7", "text": "hi", "user_name": ""}]
+        )
+
+    def test_errors(self):
+        """
+        Отсутствие обязательного поля, неверный тип и неверный json
+        """
+        for body in ('{"text": "hi"}',
+                     '{"contact": {"phone": []}, "text": "hi"}',
+                     '{"contact": '):
+            with self.assertRaises(SchemaError):
+                self.Payload.loads(body)
+
+    def test_batch(self):
+        """
+        Из тела вебхука WhatsApp разбираются текстовые сообщения и сообщения
+        с вложениями, статусы и прочие сообщения пропускаются
+        """
+        messages = WhatsappGateway.payload_schema.loads(
+            read_payload("whatsapp_batch.json")
+        )
+        self.assertTrue(all(isinstance(m, Message) for m in messages))
+        self.assertEqual(
+            [(m.phone_number, m.text) for m in messages],
+            [("79876543210", "Здравствуйте, сообщение 1"),
+             ("79876543210", "Здравствуйте, сообщение 2"),
+             ("79876543211", ""),
+             ("79876543211", "Здравствуйте, сообщение 4")]
+        )
+        media = messages[2].media
+        self.assertEqual(
+            (media.media_id, media.content_type), ("1", "image/jpeg")
+        )
+        self.assertIsNone(messages[0].media)
+
+    def test_when_set(self):
+        """
+        Условие when может содержать множество допустимых значений
+        """
+        class Payload(Schema):
+            items = "*"
+            when = {"type": frozenset(("a", "b"))}
+            text = Field("text")
+
+        self.assertEqual(
+            Payload.loads('[{"type": "a", "text": "1"}, '
+                          '{"type": "c", "text": "2"}, '
+                          '{"type": ["a"], "text": "3"}, '
+                          '{"type": "b", "text": "4"}]'),
+            [{"text": "1"}, {"text": "4"}]
+        )
+
+
+class StubWhatsappGateway(WhatsappGateway):
+    def send_message(self, message):
+        pass
+
+
+class SchemaGatewayTestCase(BaseTestCase):
+    """
+    Разбор запроса шлюзом со схемой
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.gateway = StubWhatsappGateway(mock.MagicMock(), mock.MagicMock())
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+
+    def make_request(self, body: bytes):
+        request = mock.MagicMock(spec=web.Request)
+        request.read = AsyncMock(return_value=body)
+        return request
+
+    def test_parse_messages(self):
+        messages = self.loop.run_until_complete(self.gateway.parse_messages(
+            self.make_request(read_payload("whatsapp_batch.json"))
+        ))
+        self.assertEqual(len(messages), 4)
+
+    def test_bad_request(self):
+        with self.assertRaises(web.HTTPBadRequest):
+            self.loop.run_until_complete(self.gateway.parse_messages(
+                self.make_request(b'{"entry": {}}')
+            ))
@@ -0,0 +1,112 @@
+"""
+Тесты для поискового индекса в памяти
+"""
+import asyncio
+import datetime
+import types
+
+from oneweb_helpdesk_chat.storage.domain import Channel
+from oneweb_helpdesk_chat.storage.search import (
+    Indexer, InvertedIndex, SearchDocument, SearchQuery
+)
+from tests.utils import BaseTestCase
+
+
+class InvertedIndexTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.storage.search.InvertedIndex`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.index = InvertedIndex()
+        self.started_at = datetime.datetime(2020, 1, 1)
+        self.loop.run_until_complete(self.index.add([
+            SearchDocument(
+                1, 1, 1, Channel.WHATSAPP, self.started_at,
+                "Не приходит код подтверждения"
+            ),
+            SearchDocument(
+                2, 2, 2, Channel.VIBER,
+                self.started_at + datetime.timedelta(days=1),
+                "Код, код и еще раз код подтверждения"
+            ),
+            SearchDocument(
+                3, 2, 2, Channel.VIBER,
+                self.started_at + datetime.timedelta(days=2),
+                "Спасибо"
+            ),
+        ]))
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+
+    def find(self, query: SearchQuery):
+        return [
+            message_id
+            for message_id, _ in self.loop.run_until_complete(
+                self.index.find(query)
+            )
+        ]
+
+    def test_ranked(self):
+        """
+        Найдены должны быть сообщения, содержащие все слова запроса, сначала
+        более релевантные
+        """
+        self.assertEqual(self.find(SearchQuery("код ПОДТВЕРЖДЕНИЯ")), [2, 1])
+        self.assertEqual(self.find(SearchQuery("код спасибо")), [])
+
+    def test_filters(self):
+        """
+        Фильтры по каналу, клиенту и дате
+        """
+        self.assertEqual(
+            self.find(SearchQuery("код", channel=Channel.WHATSAPP)), [1]
+        )
+        self.assertEqual(self.find(SearchQuery("код", customer_id=2)), [2])
+        self.assertEqual(
+            self.find(SearchQuery(
+                "код", date_to=self.started_at + datetime.timedelta(hours=1)
+            )),
+            [1]
+        )
+
+    def test_pagination(self):
+        """
+        Постраничная навигация по результатам
+        """
+        self.assertEqual(self.find(SearchQuery("код", limit=1, offset=1)), [1])
+
+    def test_add_twice(self):
+        """
+        Повторное добавление документа не меняет индекс
+        """
+        ranked = self.loop.run_until_complete(
+            self.index.find(SearchQuery("код"))
+        )
+        self.loop.run_until_complete(self.index.add([SearchDocument(
+            2, 2, 2, Channel.VIBER, self.started_at, "Код"
+        )]))
+        self.assertEqual(
+            self.loop.run_until_complete(self.index.find(SearchQuery("код"))),
+            ranked
+        )
+
+    def test_submit(self):
+        """
+        Документ для индексации строится по внешним ключам, без загрузки
+        клиента диалога
+        """
+        indexer = Indexer(self.index)
+        indexer.submit(types.SimpleNamespace(
+            id=4, dialog_id=3, dialog=types.SimpleNamespace(customer_id=5),
+            channel=Channel.VIBER, created_at=self.started_at, text="код"
+        ))
+        document = indexer.queue.get_nowait()
+        self.assertEqual(
+            (document.message_id, document.dialog_id, document.customer_id),
+            (4, 3, 5)
+        )
@@ -0,0 +1,164 @@
+"""
+Тесты для эфемерных сигналов
+"""
+import asyncio
+from unittest import mock
+
+from oneweb_helpdesk_chat import signals
+from oneweb_helpdesk_chat.broker import LocalBroker
+from oneweb_helpdesk_chat.connections import Connection, ConnectionRegistry
+from oneweb_helpdesk_chat.limits import RateLimiter
+from oneweb_helpdesk_chat.queues import TailRepository
+from tests.utils import AsyncMock, BaseTestCase
+
+
+class SignalHubTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.signals.SignalHub`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.registry = ConnectionRegistry(TailRepository(), lambda m: {})
+        self.mark_read_many = AsyncMock()
+        self.receipts = signals.ReadReceipts(self.mark_read_many)
+        self.hub = signals.SignalHub(
+            self.registry, self.receipts,
+            limiter=RateLimiter("test_signals", 1, 3)
+        )
+        self.registry.signals = self.hub
+        self.sender = self.make_connection(1)
+        self.receiver = self.make_connection(2)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+
+    def make_connection(self, user_id: int, **kwargs) -> Connection:
+        connection = Connection(mock.MagicMock(), user_id, **kwargs)
+        self.registry.register(connection)
+        self.loop.run_until_complete(self.registry.subscribe(connection, "1"))
+        return connection
+
+    def command(self, connection: Connection, action: str,
+                dialog_id: int = 1):
+        self.loop.run_until_complete(self.registry.handle_command(
+            connection, {"command": action, "dialog_id": dialog_id}
+        ))
+
+    def drain(self, connection: Connection) -> list:
+        frames = []
+        while not connection.outbox.empty():
+            frames.append(connection.outbox.get_nowait())
+        return frames
+
+    def test_coalesce(self):
+        """
+        Повторные сигналы отправителя за интервал рассылки схлопываются, сам
+        отправитель свои сигналы не получает
+        """
+        self.command(self.sender, "typing")
+        self.command(self.sender, "typing")
+        self.command(self.sender, "read")
+        self.hub.flush()
+
+        self.assertEqual(self.drain(self.receiver), [
+            {"type": "signal", "dialog_id": 1, "signal": "typing",
+             "user_id": 1},
+            {"type": "signal", "dialog_id": 1, "signal": "read",
+             "user_id": 1},
+        ])
+        self.assertEqual(self.drain(self.sender), [])
+
+    def test_not_subscribed(self):
+        self.command(self.sender, "typing", dialog_id=2)
+        self.hub.flush()
+
+        self.assertEqual(
+            self.drain(self.sender),
+            [{"type": "error", "error": "not subscribed"}]
+        )
+        self.assertEqual(self.drain(self.receiver), [])
+
+    def test_monitor(self):
+        """
+        Наблюдатель получает сигналы диалога, но сам отправлять их не может
+        """
+        monitor = Connection(mock.MagicMock(), 3)
+        self.registry.register(monitor)
+        self.loop.run_until_complete(self.registry.handle_command(
+            monitor, {"command": "subscribe", "dialog_id": 1,
+                      "mode": "monitor"}
+        ))
+        self.command(monitor, "typing")
+        self.command(self.sender, "typing")
+        self.hub.flush()
+
+        self.assertEqual(self.drain(monitor), [
+            {"type": "subscribed", "dialog_id": 1, "mode": "monitor"},
+            {"type": "error", "error": "read-only"},
+            {"type": "signal", "dialog_id": 1, "signal": "typing",
+             "user_id": 1},
+        ])
+        self.assertEqual(len(self.drain(self.receiver)), 1)
+        self.assertIn(monitor, self.registry.dialogs["1"])
+
+    def test_rate_limit(self):
+        """
+        Сигналы сверх допустимой частоты отбрасываются
+        """
+        dropped = signals.dropped_counter.get(reason="rate")
+        for dialog_id in range(5):
+            self.hub.publish(
+                str(dialog_id), signals.SignalType.TYPING, user_id=1
+            )
+
+        self.assertEqual(len(self.hub.pending), 3)
+        self.assertEqual(
+            signals.dropped_counter.get(reason="rate"), dropped + 2
+        )
+
+    def test_congested(self):
+        """
+        Соединению, которое не успевает читать кадры, сигналы не отправляются
+        """
+        slow = self.make_connection(3, outbox_limit=4)
+        slow.put({"type": "event"})
+        slow.put({"type": "event"})
+        dropped = signals.dropped_counter.get(reason="congested")
+
+        self.command(self.sender, "typing")
+        self.hub.flush()
+
+        self.assertEqual(len(self.drain(self.receiver)), 1)
+        self.assertEqual(len(self.drain(slow)), 2)
+        self.assertEqual(
+            signals.dropped_counter.get(reason="congested"), dropped + 1
+        )
+
+    def test_broker(self):
+        """
+        Сигналы пересылаются другим процессам одним кадром брокера
+        """
+        self.registry.broker = mock.MagicMock(spec=LocalBroker)
+        self.command(self.sender, "typing")
+        self.hub.flush()
+
+        frame, = self.registry.broker.publish.call_args[0]
+        self.assertEqual(frame["type"], "signals")
+        self.drain(self.receiver)
+        self.registry.handle_broker_frame(frame)
+        self.assertEqual(self.drain(self.receiver), frame["frames"])
+
+    def test_read_receipts(self):
+        """
+        Отметки о прочтении копятся и записываются одной пачкой
+        """
+        self.command(self.sender, "read")
+        self.command(self.receiver, "read")
+        self.command(self.receiver, "read")
+        self.loop.run_until_complete(self.receipts.flush())
+        self.loop.run_until_complete(self.receipts.flush())
+
+        self.mark_read_many.assert_called_once_with({(1, 1), (1, 2)})
@@ -0,0 +1,192 @@
+"""
+Тесты для трассировки и профилировщика
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.web_app import Application
+
+from oneweb_helpdesk_chat import logs, tracing
+from oneweb_helpdesk_chat.profiler import SamplingProfiler
+from tests.utils import BaseTestCase
+
+
+class TracerTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.tracing.Tracer`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.exporter = tracing.InMemoryExporter()
+        self.tracer = tracing.Tracer(self.exporter)
+
+    def test_nested(self):
+        """
+        Интервалы внутри трассы получают родителя, вне трассы не создаются
+        """
+        with self.tracer.span("outside") as span:
+            self.assertIsNone(span)
+        with self.tracer.trace("root", path="/") as root:
+            with self.tracer.span("child") as child:
+                child.set_attribute("count", 2)
+        self.assertEqual(self.exporter.names(), ["child", "root"])
+        self.assertEqual(child.parent_id, root.span_id)
+        self.assertEqual(child.trace_id, root.trace_id)
+        self.assertIsNone(tracing.current_span.get())
+
+        otlp = child.as_otlp()
+        self.assertEqual(otlp["parentSpanId"], root.span_id)
+        self.assertEqual(
+            otlp["attributes"],
+            [{"key": "count", "value": {"intValue": "2"}}]
+        )
+
+    def test_correlation_id(self):
+        correlation = logs.new_correlation_id()
+        token = logs.correlation_id.set(correlation)
+        try:
+            with self.tracer.trace("root") as root:
+                pass
+        finally:
+            logs.correlation_id.reset(token)
+        self.assertEqual(root.trace_id, correlation)
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.trace("root"):
+                raise ValueError("boom")
+        span, = self.exporter.spans
+        self.assertEqual(
+            span.as_otlp()["status"]["message"], "ValueError: boom"
+        )
+
+    def test_sampling(self):
+        self.tracer.sample_rate = 0
+        with self.tracer.trace("root") as root:
+            with self.tracer.span("child") as child:
+                pass
+        self.assertIsNone(root)
+        self.assertIsNone(child)
+        self.assertEqual(self.exporter.spans, [])
+
+    def test_executor(self):
+        """
+        Выполнение в пуле потоков покрывается интервалом, ожидание потока --
+        дочерним интервалом
+        """
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(1)
+
+        async def run():
+            with self.tracer.trace("root"):
+                return await self.tracer.run_in_executor(
+                    executor, "db.fetch", lambda x: x * 2, 21
+                )
+        try:
+            self.assertEqual(loop.run_until_complete(run()), 42)
+        finally:
+            executor.shutdown()
+            loop.close()
+        wait, fetch, root = self.exporter.spans
+        self.assertEqual(
+            [wait.name, fetch.name, root.name],
+            ["executor.wait", "db.fetch", "root"]
+        )
+        self.assertEqual(wait.parent_id, fetch.span_id)
+        self.assertEqual(fetch.parent_id, root.span_id)
+
+
+class ProfilerTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.profiler.SamplingProfiler`
+    """
+
+    def test_collapsed(self):
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(100))
+
+        thread = threading.Thread(target=busy_loop)
+        thread.start()
+        profiler = SamplingProfiler(interval=0.001)
+        try:
+            profiler.start(thread.ident)
+            with self.assertRaises(RuntimeError):
+                profiler.start(thread.ident)
+            time.sleep(0.05)
+            profiler.stop()
+        finally:
+            stop.set()
+            thread.join()
+        self.assertFalse(profiler.running)
+        self.assertGreater(profiler.samples, 0)
+        self.assertIn("tests.test_tracing:busy_loop", profiler.collapsed())
+
+
+class AdminEndpointsTestCase(AioHTTPTestCase, BaseTestCase):
+    """
+    Тесты для административных эндпоинтов профилировщика и трассировки
+    запросов
+    """
+
+    async def get_application(self) -> Application:
+        from oneweb_helpdesk_chat import app
+        return await app.make_app()
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.exporter = tracing.InMemoryExporter()
+        tracing.tracer.exporter = self.exporter
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        tracing.tracer.exporter = None
+
+    @unittest_run_loop
+    async def test_profiler(self):
+        start = self.app.router["profiler-start"].url_for()
+        stop = self.app.router["profiler-stop"].url_for()
+        # без токена в настройках эндпоинты недоступны
+        response = await self.client.post(start)
+        self.assertEqual(response.status, 404)
+
+        with patch("oneweb_helpdesk_chat.config.ADMIN_TOKEN", "secret"):
+            response = await self.client.post(
+                start, headers={"Authorization": "Bearer wrong"}
+            )
+            self.assertEqual(response.status, 403)
+
+            headers = {"Authorization": "Bearer secret"}
+            response = await self.client.post(
+                start.with_query(interval="0.001"), headers=headers
+            )
+            self.assertEqual(response.status, 200)
+            response = await self.client.post(start, headers=headers)
+            self.assertEqual(response.status, 409)
+            await asyncio.sleep(0.02)
+            response = await self.client.post(stop, headers=headers)
+            self.assertEqual(response.status, 200)
+            self.assertTrue(await response.text())
+
+    @unittest_run_loop
+    async def test_request_trace(self):
+        """
+        Запрос трассируется, идентификатор трассы -- идентификатор корреляции
+        """
+        correlation = logs.new_correlation_id()
+        response = await self.client.get(
+            self.app.router["metrics"].url_for(),
+            headers={"X-Request-Id": correlation}
+        )
+        self.assertEqual(response.status, 200)
+        span, = self.exporter.spans
+        self.assertEqual(span.name, "http.request")
+        self.assertEqual(span.trace_id, correlation)
+        self.assertEqual(span.attributes["status"], 200)
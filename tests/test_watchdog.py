@@ -0,0 +1,111 @@
+"""
+Тесты для сторожа цикла событий и журнала медленных запросов
+"""
+import asyncio
+import time
+from unittest.mock import patch
+
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.web_app import Application
+
+from oneweb_helpdesk_chat import storage
+from oneweb_helpdesk_chat.storage import database, querylog
+from oneweb_helpdesk_chat.watchdog import LoopWatchdog
+from tests.utils import BaseTestCase
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+class LoopWatchdogTestCase(BaseTestCase):
+    """
+    Тесты для :class:`oneweb_helpdesk_chat.watchdog.LoopWatchdog`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+
+    def test_stall(self):
+        """
+        Стек блокирующего вызова снимается, пока вызов выполняется
+        """
+        watchdog = LoopWatchdog(interval=0.01, threshold=0.1)
+
+        async def run():
+            watchdog.start()
+            await asyncio.sleep(0.05)
+            blocking_call()
+            await asyncio.sleep(0.05)
+            await watchdog.stop()
+
+        self.loop.run_until_complete(run())
+        stall, = watchdog.stalls
+        self.assertGreater(stall["blocked_ms"], 100)
+        self.assertIn("blocking_call", stall["stack"])
+        self.assertGreaterEqual(watchdog.max_lag, 0.2)
+
+
+class SlowQueryTestCase(BaseTestCase):
+    """
+    Тесты для :mod:`oneweb_helpdesk_chat.storage.querylog`
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        database.Base.metadata.create_all(database.engine())
+        database.ScopedAppSession.configure(bind=database.engine())
+        querylog.slow_queries.clear()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.loop.close()
+        database.ScopedAppSession.remove()
+        database.Base.metadata.drop_all(database.engine())
+
+    def test_origin(self):
+        """
+        В журнал попадает метод репозитория, из которого выполнен запрос
+        """
+        repository = storage.UserRepository()
+        with patch("oneweb_helpdesk_chat.config.SLOW_QUERY_MS", 1e-9):
+            self.loop.run_until_complete(repository.get_by_login("login"))
+        query, = querylog.slow_queries
+        self.assertEqual(query["origin"], "UserRepository.get_one_by_field")
+        self.assertIn("FROM users", query["statement"])
+
+    def test_disabled(self):
+        with patch("oneweb_helpdesk_chat.config.SLOW_QUERY_MS", 0):
+            self.loop.run_until_complete(
+                storage.UserRepository().get_by_login("login")
+            )
+        self.assertEqual(len(querylog.slow_queries), 0)
+
+
+class WatchdogEndpointTestCase(AioHTTPTestCase, BaseTestCase):
+    """
+    Тесты для эндпоинта ``/admin/watchdog``
+    """
+
+    async def get_application(self) -> Application:
+        from oneweb_helpdesk_chat import app
+        return await app.make_app()
+
+    @unittest_run_loop
+    async def test_watchdog(self):
+        with patch("oneweb_helpdesk_chat.config.ADMIN_TOKEN", "secret"):
+            response = await self.client.get(
+                self.app.router["watchdog"].url_for(),
+                headers={"Authorization": "Bearer secret"}
+            )
+        self.assertEqual(response.status, 200)
+        data = await response.json()
+        self.assertEqual(data["loop"]["stalls"], [])
+        self.assertIn("slow_queries", data)